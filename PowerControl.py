@@ -1,12 +1,17 @@
+import argparse
 import json
-import time
+import threading
 import paho.mqtt.client as mqtt
-from datetime import datetime
+from datetime import datetime, timedelta
+from mqttRouter import TopicRouter, parse_json
 
 # Configuration
 MQTT_BROKER = "192.168.86.54"     # Replace with your broker's IP/hostname
 MQTT_PORT = 1883
 MQTT_KEEPALIVE = 60
+MQTT_QOS = 1
+DATA_WAIT_SECONDS = 30  # How long a single run waits for retained prices and expensive hours
+PUBLISH_WAIT_SECONDS = 5  # How long a single run waits for its messages to be delivered before exiting
 
 # Topics from which we read data
 TOPIC_POWER_USAGE = "home/power/usage"                # kW (float)
@@ -19,6 +24,8 @@ BASE_TOPIC = "home/control"
 # Panel ovens: home/control/panel_oven/<device_name>/target_temp
 # Floor heating: home/control/floor/<device_name>/target_temp
 # Water heater: home/control/waterheater/onoff
+# Setpoints for every hour of the day, for devices to cache: home/control/schedule
+SCHEDULE_TOPIC = f"{BASE_TOPIC}/schedule"
 
 NORMAL_TEMPERATURES = {
     "toalett_panelovn": 22,
@@ -37,148 +44,287 @@ MINIMUM_TEMP = 14
 current_power_usage = None
 heating_prices = None
 expensive_hours = None
+inputs_changed = threading.Event()  # Set when prices or expensive hours arrive; the setpoints are recalculated
+setpoint_table = None  # Setpoints per hour of the day for the current inputs
+setpoint_table_inputs = None  # The inputs setpoint_table was built from
+last_published = {}  # topic -> payload last published, so unchanged setpoints are not sent again
 
 def on_connect(client, userdata, flags, rc=''):
     if rc == 0:
         print("Connected to MQTT Broker!")
         # Subscribe to required topics
-        client.subscribe(TOPIC_POWER_USAGE)
-        client.subscribe(TOPIC_POWER_PRICES)
-        client.subscribe(TOPIC_EXPENSIVE_HOURS)
+        for topic in router.subscriptions():
+            client.subscribe(topic)
+        # The broker may have lost retained setpoints while we were disconnected; publish them all again
+        last_published.clear()
+        inputs_changed.set()
     else:
         print(f"Failed to connect, return code {rc}")
 
+def on_power_usage(topic, value):
+    global current_power_usage
+    current_power_usage = value
+
+def on_power_prices(topic, value):
+    global heating_prices
+    heating_prices = value  # Array of floats for each hour
+    inputs_changed.set()
+
+def on_expensive_hours(topic, value):
+    global expensive_hours
+    expensive_hours = value  # Array of ints representing hours
+    inputs_changed.set()
+
+# Incoming topics; invalid payloads are rejected (and logged) by the router
+router = TopicRouter()
+router.route(TOPIC_POWER_USAGE, on_power_usage)
+router.route(TOPIC_POWER_PRICES, on_power_prices, parse=parse_json)
+router.route(TOPIC_EXPENSIVE_HOURS, on_expensive_hours, parse=parse_json)
+
 def on_message(client, userdata, msg):
-    global current_power_usage, heating_prices, expensive_hours
-    topic = msg.topic
-    payload = msg.payload.decode("utf-8")
-    
-    if topic == TOPIC_POWER_USAGE:
-        try:
-            current_power_usage = float(payload)
-        except ValueError:
-            print("Invalid power usage value received.")
-    elif topic == TOPIC_POWER_PRICES:
-        try:
-            heating_prices = json.loads(payload)  # Array of floats for each hour
-        except json.JSONDecodeError:
-            print("Invalid JSON for heating prices.")
-    elif topic == TOPIC_EXPENSIVE_HOURS:
-        try:
-            expensive_hours = json.loads(payload) # Array of ints representing hours
-        except json.JSONDecodeError:
-            print("Invalid JSON for expensive hours.")
-
-def calculate_setpoints():
+    router.on_message(client, userdata, msg)
+
+def build_setpoint_table(prices, chosen_hours, normal_temperatures=None, normal_floor_temps=None):
     """
-    This function performs the logic that was previously in HomeyScript:
-    - Determine if current hour is expensive or extremely expensive.
+    Precompute the setpoints for every hour of the day.
+
+    This is the logic that was previously in HomeyScript, evaluated once per hour
+    of the day when the inputs change:
+    - Determine if the hour is expensive or extremely expensive.
     - Adjust setpoints for panel ovens and floor heating.
     - Decide if water heater should be on/off.
+
+    As before, the price of an expensive hour h at hour H is prices[(h - H) % 24].
+
+    Args:
+        prices (list): Hourly prices; None for unknown hours.
+        chosen_hours (list): Expensive hours of the day.
+        normal_temperatures (dict, optional): Panel oven setpoints. Defaults to NORMAL_TEMPERATURES.
+        normal_floor_temps (dict, optional): Floor heating setpoints. Defaults to NORMAL_FLOOR_TEMPS.
+
+    Returns:
+        list: 24 setpoint dicts indexed by hour, or None if there are no valid prices.
+            Hours with the same setpoints share dicts; do not modify them.
+    """
+    normal_temperatures = NORMAL_TEMPERATURES if normal_temperatures is None else normal_temperatures
+    normal_floor_temps = NORMAL_FLOOR_TEMPS if normal_floor_temps is None else normal_floor_temps
+
+    # Compute average price
+    valid_prices = [p for p in prices if p is not None]
+    if not valid_prices:
+        return None
+    extreme_threshold = sum(valid_prices) / len(valid_prices) * 2
+
+    # Setpoints only depend on whether the hour is expensive
+    normal = {
+        "panel_ovens": dict(normal_temperatures),
+        "floor_heating": dict(normal_floor_temps),
+    }
+    reduced = {
+        "panel_ovens": {name: max(desired - 3, MINIMUM_TEMP) for name, desired in normal_temperatures.items()},
+        "floor_heating": {name: max(desired - 3, MINIMUM_TEMP) for name, desired in normal_floor_temps.items()},
+    }
+    expensive = set(chosen_hours)
+
+    table = []
+    for hour in range(24):
+        # The most expensive chosen hour; the first one listed wins a tie
+        most_expensive_hour, most_expensive_price = None, None
+        for h in chosen_hours:
+            idx = (h - hour) % 24
+            price = prices[idx] if idx < len(prices) else None
+            if price is not None and (most_expensive_price is None or price > most_expensive_price):
+                most_expensive_hour, most_expensive_price = h, price
+        is_extremely_expensive = (most_expensive_hour == hour and most_expensive_price > extreme_threshold)
+
+        devices = reduced if hour in expensive else normal
+        table.append({
+            "panel_ovens": devices["panel_ovens"],
+            "floor_heating": devices["floor_heating"],
+            "water_heater_on": hour not in expensive,
+            "is_extremely_expensive": is_extremely_expensive
+        })
+    return table
+
+def current_setpoint_table():
+    """Return the setpoint table for the current inputs, rebuilding it only when they changed."""
+    global setpoint_table, setpoint_table_inputs
+    inputs = (heating_prices, expensive_hours, NORMAL_TEMPERATURES, NORMAL_FLOOR_TEMPS)
+    if setpoint_table_inputs is None or any(new is not old for new, old in zip(inputs, setpoint_table_inputs)):
+        setpoint_table = build_setpoint_table(*inputs)
+        setpoint_table_inputs = inputs
+    return setpoint_table
+
+def calculate_setpoints(now=None):
+    """
+    Return the setpoints for the current hour from the precomputed table.
+
+    Args:
+        now (datetime, optional): Local time to calculate for. Defaults to now.
+
+    Returns:
+        dict: panel_ovens, floor_heating, water_heater_on and is_extremely_expensive,
+            or None without usable prices and expensive hours.
     """
     if heating_prices is None or expensive_hours is None:
         print("Insufficient data (prices or expensive hours) to calculate setpoints.")
         return None
-    
-    now = datetime.now()
-    current_hour = now.hour
 
-    # Compute average price
-    valid_prices = [p for p in heating_prices if p is not None]
-    if not valid_prices:
+    table = current_setpoint_table()
+    if table is None:
         print("No valid prices, cannot compute setpoints.")
         return None
-    avg_price = sum(valid_prices) / len(valid_prices)
-    extreme_threshold = avg_price * 2
-
-    # Identify the most expensive chosen hour from expensive_hours
-    chosen_hours_with_prices = []
-    for h in expensive_hours:
-        idx = (h - current_hour) % 24
-        price = heating_prices[idx] if 0 <= idx < len(heating_prices) else None
-        if price is not None:
-            chosen_hours_with_prices.append({"hour": h, "price": price})
-    chosen_hours_with_prices.sort(key=lambda x: x["price"], reverse=True)
-    most_expensive_hour = chosen_hours_with_prices[0] if chosen_hours_with_prices else None
-
-    is_extremely_expensive = False
-    if most_expensive_hour:
-        is_extremely_expensive = (most_expensive_hour["price"] > extreme_threshold and 
-                                  most_expensive_hour["hour"] == current_hour)
-
-    # Calculate setpoints for panel ovens
-    panel_ovens_setpoints = {}
-    for name, desired in NORMAL_TEMPERATURES.items():
-        if current_hour in expensive_hours:
-            target = max(desired - 3, MINIMUM_TEMP)
-        else:
-            target = desired
-        panel_ovens_setpoints[name] = target
-
-    # Calculate setpoints for floor heating
-    floor_setpoints = {}
-    for name, desired in NORMAL_FLOOR_TEMPS.items():
-        if current_hour in expensive_hours:
-            target = max(desired - 3, MINIMUM_TEMP)
-        else:
-            target = desired
-        floor_setpoints[name] = target
+    return table[(now or datetime.now()).hour]
+
+def setpoint_messages(setpoints):
+    """Return the (topic, payload) pairs that carry a set of setpoints."""
+    messages = []
+    # Panel oven target temps
+    for device_name, temp in setpoints["panel_ovens"].items():
+        messages.append((f"{BASE_TOPIC}/panel_oven/{device_name}/target_temp", str(temp)))
+
+    # Floor heating target temps
+    for device_name, temp in setpoints["floor_heating"].items():
+        messages.append((f"{BASE_TOPIC}/floor/{device_name}/target_temp", str(temp)))
 
-    # Water heater on/off
-    water_heater_on = current_hour not in expensive_hours
+    # Water heater state
+    messages.append((f"{BASE_TOPIC}/waterheater/onoff", "true" if setpoints["water_heater_on"] else "false"))
 
-    return {
-        "panel_ovens": panel_ovens_setpoints,
-        "floor_heating": floor_setpoints,
-        "water_heater_on": water_heater_on,
-        "is_extremely_expensive": is_extremely_expensive
-    }
+    # Extremely expensive state
+    messages.append((f"{BASE_TOPIC}/mode/extreme", "true" if setpoints["is_extremely_expensive"] else "false"))
+    return messages
 
 def publish_setpoints(client, setpoints):
-    # Publish panel oven target temps
-    for device_name, temp in setpoints["panel_ovens"].items():
-        topic = f"{BASE_TOPIC}/panel_oven/{device_name}/target_temp"
-        client.publish(topic, str(temp))
-        print(f"Published {temp} to {topic}")
+    """
+    Publish the setpoints whose values changed since they were last published.
 
-    # Publish floor heating target temps
-    for device_name, temp in setpoints["floor_heating"].items():
-        topic = f"{BASE_TOPIC}/floor/{device_name}/target_temp"
-        client.publish(topic, str(temp))
-        print(f"Published {temp} to {topic}")
+    Messages are retained, so devices and dashboards that connect later get the
+    current setpoint from the broker without another publish.
+
+    Args:
+        client (mqtt.Client): Connected MQTT client.
+        setpoints (dict): Setpoints from calculate_setpoints().
 
-    # Publish water heater state
-    waterheater_topic = f"{BASE_TOPIC}/waterheater/onoff"
-    client.publish(waterheater_topic, "true" if setpoints["water_heater_on"] else "false")
-    print(f"Published {setpoints['water_heater_on']} to {waterheater_topic}")
+    Returns:
+        list: MQTTMessageInfo of each message published.
+    """
+    published = []
+    for topic, payload in setpoint_messages(setpoints):
+        if last_published.get(topic) == payload:
+            continue
+        info = client.publish(topic, payload, qos=MQTT_QOS, retain=True)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            last_published[topic] = payload
+            published.append(info)
+            print(f"Published {payload} to {topic}")
+        else:
+            print(f"Failed to publish {payload} to {topic}, return code {info.rc}")
+    return published
 
-    # Publish extremely expensive state
-    extreme_topic = f"{BASE_TOPIC}/mode/extreme"
-    client.publish(extreme_topic, "true" if setpoints["is_extremely_expensive"] else "false")
-    print(f"Published {setpoints['is_extremely_expensive']} to {extreme_topic}")
+def publish_setpoint_table(client):
+    """
+    Publish the setpoints for every hour, retained, if they changed since the last publish.
 
+    Devices can cache the table and follow the hour themselves.
+
+    Args:
+        client (mqtt.Client): Connected MQTT client.
+
+    Returns:
+        MQTTMessageInfo: The published message, or None if it was unchanged or there is no table.
+    """
+    table = current_setpoint_table() if heating_prices is not None and expensive_hours is not None else None
+    if table is None:
+        return None
+    payload = json.dumps(table, separators=(",", ":"))
+    if last_published.get(SCHEDULE_TOPIC) == payload:
+        return None
+    info = client.publish(SCHEDULE_TOPIC, payload, qos=MQTT_QOS, retain=True)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        print(f"Failed to publish setpoint table to {SCHEDULE_TOPIC}, return code {info.rc}")
+        return None
+    last_published[SCHEDULE_TOPIC] = payload
+    print(f"Published setpoint table to {SCHEDULE_TOPIC}")
+    return info
+
+def wait_for_inputs(timeout):
+    """
+    Wait until both prices and expensive hours have been received.
+
+    Args:
+        timeout (float): Maximum seconds to wait.
+
+    Returns:
+        bool: True if both are available.
+    """
+    deadline = datetime.now() + timedelta(seconds=timeout)
+    while heating_prices is None or expensive_hours is None:
+        remaining = (deadline - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return False
+        inputs_changed.wait(remaining)
+        inputs_changed.clear()
+    return True
+
+def run_once(client):
+    """Calculate and publish the setpoints once, as soon as the retained inputs have arrived."""
+    if not wait_for_inputs(DATA_WAIT_SECONDS):
+        print(f"No prices or expensive hours received within {DATA_WAIT_SECONDS} s.")
+    setpoints = calculate_setpoints()
+    if setpoints:
+        published = publish_setpoints(client, setpoints)
+        published.append(publish_setpoint_table(client))
+        for info in filter(None, published):
+            info.wait_for_publish(PUBLISH_WAIT_SECONDS)
+
+def run_resident(client):
+    """
+    Keep the setpoints current until interrupted.
+
+    They are recalculated when new prices or expensive hours arrive and at the
+    start of every hour; only the topics whose values changed are published.
+    """
+    calculated_hour = None
+    while True:
+        now = datetime.now()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        if inputs_changed.is_set() or hour != calculated_hour:
+            # Cleared first, so inputs arriving during the calculation trigger another one
+            inputs_changed.clear()
+            calculated_hour = hour
+            setpoints = calculate_setpoints(now)
+            if setpoints:
+                publish_setpoints(client, setpoints)
+                publish_setpoint_table(client)
+        until_next_hour = (hour + timedelta(hours=1) - datetime.now()).total_seconds()
+        inputs_changed.wait(max(until_next_hour, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish heating setpoints from power prices and expensive hours.")
+    parser.add_argument("--resident", action="store_true",
+                        help="Keep running and republish changed setpoints when the inputs or the hour change, instead of running once.")
+    args = parser.parse_args()
 
-if __name__ == "__main__":
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
 
     client.connect(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
 
-    # Start MQTT loop to process messages
+    # Start MQTT loop to process messages; it also reconnects after a dropped connection
     client.loop_start()
+    try:
+        if args.resident:
+            run_resident(client)
+        else:
+            run_once(client)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.disconnect()
+        client.loop_stop()
 
-    # Give a few seconds to receive initial data from MQTT
-    time.sleep(5)
 
-    # Run logic once (if you want this periodically, you can loop or schedule it)
-    setpoints = calculate_setpoints()
-    if setpoints:
-        publish_setpoints(client, setpoints)
-
-    # If this script should just run once and exit, stop the loop:
-    # If you want it to run continuously and update periodically, you could:
-    # - Use a while True loop with a sleep interval
-    # - Or run it from cron every 5 minutes
-    client.loop_stop()
-    client.disconnect()
+if __name__ == "__main__":
+    main()
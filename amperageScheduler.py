@@ -0,0 +1,143 @@
+import logging
+import time
+from collections import deque
+
+RATE_WINDOW_SECONDS = 15 * 60  # Zaptec installation updates are limited to one per 15 minutes
+UPDATES_PER_WINDOW = 1
+SAFETY_UPDATES = 0  # Extra updates per window for urgent reductions; above 0 exceeds Zaptec's limit, so opt in
+
+
+class AmperageScheduler:
+    """
+    Rate-limit-aware queue for charging current updates.
+
+    Requests are coalesced: only the latest requested amperage is kept, and a
+    request equal to the current setting cancels what is pending. At most
+    `updates_per_window` updates are sent in any `window_seconds`. By default that
+    is the whole budget: every request waits for the window and the latest one is
+    sent when it opens. Setting `safety_updates` above zero is an explicit opt-in to
+    exceed the API limit: an urgent request that lowers the current may then use
+    one of those reserved updates, so an overload right after an update is
+    corrected at once. Routine reductions wait like increases, which keeps the
+    reserve free for overloads. An increase is only sent once every update in the window,
+    including safety updates, has expired, so raised and lowered currents cannot
+    oscillate within the rate limit.
+
+    The caller sends the command returned by `next_command` and reports the
+    outcome with `sent`; failed sends do not use up the window.
+    """
+
+    def __init__(self, window_seconds=RATE_WINDOW_SECONDS, updates_per_window=UPDATES_PER_WINDOW, safety_updates=SAFETY_UPDATES, min_step=1):
+        """
+        Args:
+            window_seconds (float): Length of the rate-limit window in seconds.
+            updates_per_window (int): Updates allowed per window.
+            safety_updates (int): Additional updates per window reserved for urgent reductions.
+                Each one breaks the Zaptec rate limit, so the default is none.
+            min_step (int): Smallest change in amperes worth an update.
+        """
+        self.window_seconds = window_seconds
+        self.updates_per_window = updates_per_window
+        self.safety_updates = safety_updates
+        self.min_step = min_step
+        self.current = None  # Last amperage the charger accepted
+        self.pending = None  # Latest requested amperage not yet sent
+        self.urgent = False  # Whether the pending request may use a safety update
+        self._sent = deque()  # Times of successful updates within the window
+        self._in_flight = None
+        self.requested_count = 0
+        self.coalesced_count = 0
+        self.safety_count = 0
+        self.failed_count = 0
+
+    def request(self, amperage, urgent=False):
+        """
+        Ask for a charging current; replaces any request that has not been sent yet.
+
+        Args:
+            amperage (int): Desired charging current in amperes.
+            urgent (bool): The load is over its limit, so a reduction may use a safety
+                update. Kept while later requests still lower the current.
+        """
+        self.requested_count += 1
+        if self.pending is not None and self.pending != amperage:
+            self.coalesced_count += 1
+        if self.current is not None and abs(amperage - self.current) < self.min_step:
+            self.pending = None  # Already in effect
+            self.urgent = False
+        else:
+            self.pending = amperage
+            self.urgent = (urgent or self.urgent) and self._lowering()
+
+    def next_command(self, timestamp=None):
+        """
+        Return the amperage to send now, or None if nothing is pending or the rate limit forbids it.
+
+        Args:
+            timestamp (float, optional): Current time. Defaults to now.
+
+        Returns:
+            int: Amperage to send, or None.
+        """
+        if self.pending is None or self._in_flight is not None:
+            return None
+        timestamp = time.time() if timestamp is None else timestamp
+        self._expire(timestamp)
+        if len(self._sent) < self.updates_per_window:
+            safety = False
+        elif self.urgent and len(self._sent) < self.updates_per_window + self.safety_updates:
+            safety = True
+        else:
+            return None
+        self._in_flight = (self.pending, safety)
+        return self.pending
+
+    def sent(self, amperage, success, timestamp=None):
+        """
+        Report the outcome of a command returned by `next_command`.
+
+        Args:
+            amperage (int): The amperage that was sent.
+            success (bool): Whether the charger accepted it.
+            timestamp (float, optional): Time of the update. Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        in_flight, self._in_flight = self._in_flight, None
+        if not success:
+            self.failed_count += 1
+            return
+        self._sent.append(timestamp)
+        self.current = amperage
+        if in_flight is not None and in_flight[1]:
+            self.safety_count += 1
+            logging.info(f"Charging current lowered to {amperage}A using a safety update.")
+        if self.pending == amperage:
+            self.pending = None
+            self.urgent = False
+
+    def seconds_until_allowed(self, timestamp=None):
+        """
+        Return how long the pending request has to wait for the rate limit.
+
+        Args:
+            timestamp (float, optional): Current time. Defaults to now.
+
+        Returns:
+            float: Seconds to wait (0 if it can be sent now), or None if nothing is pending.
+        """
+        if self.pending is None:
+            return None
+        timestamp = time.time() if timestamp is None else timestamp
+        self._expire(timestamp)
+        allowed = self.updates_per_window + (self.safety_updates if self.urgent else 0)
+        if len(self._sent) < allowed:
+            return 0.0
+        # The oldest update that has to expire before the count drops below the limit
+        return self._sent[len(self._sent) - allowed] + self.window_seconds - timestamp
+
+    def _lowering(self):
+        return self.current is not None and self.pending is not None and self.pending < self.current
+
+    def _expire(self, timestamp):
+        while self._sent and self._sent[0] <= timestamp - self.window_seconds:
+            self._sent.popleft()
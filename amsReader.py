@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+AMS_API_BASE_URL = "http://192.168.86.34"
+MIN_SAMPLE_INTERVAL = 1.0  # The AMS reader refreshes data.json about once per second
+DEFAULT_BUFFER_SIZE = 900  # 15 minutes of samples at the fastest rate
+
+
+class AmsClient:
+    """
+    Shared keep-alive client for the AMS Leser HTTP API.
+
+    One pooled connection is reused for every poll. A background poller can sample
+    `data.json` at a fixed rate into a ring buffer, and consumers read the buffered
+    samples instead of issuing their own HTTP requests. Polls are conditional when
+    the reader sends an ETag or Last-Modified header. `poll` may be called from
+    several threads; requests are serialised, since they share one session.
+    """
+
+    def __init__(self, api_base_url=AMS_API_BASE_URL, sample_interval=10, buffer_size=DEFAULT_BUFFER_SIZE, timeout=5):
+        """
+        Args:
+            api_base_url (str): Base URL of the AMS Leser API.
+            sample_interval (float): Seconds between background polls (minimum 1).
+            buffer_size (int): Number of recent samples to keep.
+            timeout (int): Request timeout in seconds.
+        """
+        self.endpoint = f"{api_base_url}/data.json"
+        self.sample_interval = max(float(sample_interval), MIN_SAMPLE_INTERVAL)
+        self.timeout = timeout
+        self.samples = deque(maxlen=buffer_size)  # (timestamp, watts)
+        self.http = requests.Session()
+        self.http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self._validators = {}
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()  # One request at a time on the shared session and validators
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.poll_count = 0
+        self.not_modified_count = 0
+        self.error_count = 0
+
+    def poll(self):
+        """
+        Fetch one reading from the AMS reader and add it to the buffer.
+
+        Returns:
+            float: Current power usage in watts, or None if the reader answered
+            304 Not Modified but no earlier reading is buffered.
+
+        Raises:
+            requests.RequestException: If the request fails.
+            ValueError: If the response does not contain a valid power value.
+        """
+        with self._poll_lock:
+            response = self.http.get(self.endpoint, headers=self._validators, timeout=self.timeout)
+            self.poll_count += 1
+            now = time.time()
+
+            if response.status_code == 304:
+                self.not_modified_count += 1
+                with self._lock:
+                    last = self.samples[-1] if self.samples else None
+                if last is None:
+                    self._validators = {}  # Nothing to repeat; ask unconditionally next time
+                    return None
+                # Unchanged since the last poll; record the same reading at the new time
+                current_power = last[1]
+            else:
+                response.raise_for_status()
+                current_power = float(response.json().get("w", 0.0))
+                self._validators = {}
+                if "ETag" in response.headers:
+                    self._validators["If-None-Match"] = response.headers["ETag"]
+                if "Last-Modified" in response.headers:
+                    self._validators["If-Modified-Since"] = response.headers["Last-Modified"]
+
+        self._record(now, current_power)
+        return current_power
+
+    def add_listener(self, callback):
+        """
+        Call `callback(timestamp, watts)` for every new sample.
+
+        Args:
+            callback (callable): Function receiving each sample.
+        """
+        self._listeners.append(callback)
+
+    def latest(self, max_age=None):
+        """
+        Return the most recent buffered reading.
+
+        Args:
+            max_age (float, optional): Ignore readings older than this many seconds.
+
+        Returns:
+            float: Power usage in watts, or None if no (fresh enough) reading exists.
+        """
+        with self._lock:
+            if not self.samples:
+                return None
+            timestamp, current_power = self.samples[-1]
+        if max_age is not None and time.time() - timestamp > max_age:
+            return None
+        return current_power
+
+    def recent(self, seconds):
+        """
+        Return buffered samples from the last `seconds` seconds.
+
+        Args:
+            seconds (float): Length of the window.
+
+        Returns:
+            list: (timestamp, watts) tuples, oldest first.
+        """
+        cutoff = time.time() - seconds
+        with self._lock:
+            samples = list(self.samples)
+        return [sample for sample in samples if sample[0] >= cutoff]
+
+    def start(self):
+        """Start polling in a background thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ams-poller", daemon=True)
+        self._thread.start()
+        logging.info(f"Polling {self.endpoint} every {self.sample_interval:.1f} seconds.")
+
+    def stop(self):
+        """Stop the background poller and release the connection."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.timeout + self.sample_interval)
+        self.http.close()
+
+    def _record(self, timestamp, current_power):
+        with self._lock:
+            self.samples.append((timestamp, current_power))
+        for callback in self._listeners:
+            try:
+                callback(timestamp, current_power)
+            except Exception as e:
+                logging.error(f"AMS sample listener failed: {e}")
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except (requests.RequestException, ValueError) as e:
+                self.error_count += 1
+                logging.error(f"Error fetching power usage: {e}")
+            # Keep a fixed rate regardless of how long the request took
+            next_poll += self.sample_interval
+            delay = next_poll - time.monotonic()
+            if delay < 0:
+                next_poll = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
@@ -0,0 +1,624 @@
+import argparse
+import ast
+import contextlib
+import importlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that must not be imported at startup (they cost seconds on a Pi Zero)
+HEAVY_MODULES = ["pandas", "numpy", "entsoe"]
+STARTUP_SCRIPTS = ["priceLoad", "priceTest"]
+
+STARTUP_PROBE = """
+import resource, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+heavy = [name for name in {heavy!r} if name in sys.modules]
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(repr((elapsed, rss_kb, heavy)))
+"""
+
+# Suite results are kept per machine so a Pi is only compared with itself
+RESULTS_DIR = os.getenv("BENCH_RESULTS_DIR", os.path.join(HERE, "bench_results"))
+REGRESSION_THRESHOLD = 1.25  # Fail if a benchmark is this much slower than its baseline
+BASELINE_RUNS = 5  # Saved runs the baseline is the median of
+SUITE_REPEAT = 5  # Timing rounds per benchmark; the fastest round is reported
+MQTT_RATE = 1000  # Messages per second the dispatch benchmark is judged against
+
+
+def measure_startup(module, repeat=5):
+    """
+    Import a script in fresh interpreters and measure import time and peak RSS.
+
+    Args:
+        module (str): Module name of the script, e.g. 'priceLoad'.
+        repeat (int): Number of fresh interpreters to start.
+
+    Returns:
+        dict: Median and max import time in seconds, peak RSS in MB and any heavy modules imported.
+    """
+    env = dict(os.environ)
+    env.setdefault("ENTSOE_API_KEY", "benchmark")
+    env.setdefault("PRICE_CACHE_DIR", os.path.join(HERE, ".bench_price_cache"))
+    code = STARTUP_PROBE.format(module=module, heavy=HEAVY_MODULES)
+
+    times, rss, heavy = [], [], set()
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=HERE, env=env, capture_output=True, text=True, check=True
+        ).stdout.strip().splitlines()[-1]
+        elapsed, rss_kb, heavy_loaded = ast.literal_eval(output)
+        times.append(elapsed)
+        rss.append(rss_kb / 1024)
+        heavy.update(heavy_loaded)
+
+    return {
+        "median_s": statistics.median(times),
+        "max_s": max(times),
+        "peak_rss_mb": max(rss),
+        "heavy_modules": sorted(heavy),
+    }
+
+
+class FakeMessage:
+    """Stand-in for a ServiceBusReceivedMessage; the body is a generator of byte sections like the SDK's."""
+
+    def __init__(self, body):
+        self._body = body
+
+    @property
+    def body(self):
+        return iter((self._body,))
+
+
+class FakeReceiver:
+    """
+    Local stand-in for a Service Bus subscription receiver.
+
+    Serves pre-built charger observations and sleeps `latency` seconds per
+    receive or complete call to model the broker round trip.
+    """
+
+    def __init__(self, messages, latency=0.001):
+        self.messages = messages
+        self.latency = latency
+        self.position = 0
+        self.completed = 0
+
+    def __iter__(self):
+        while self.position < len(self.messages):
+            yield from self.receive_messages(max_message_count=1)
+
+    def receive_messages(self, max_message_count=1, max_wait_time=None):
+        time.sleep(self.latency)
+        batch = self.messages[self.position:self.position + max_message_count]
+        self.position += len(batch)
+        return batch
+
+    def complete_message(self, message):
+        time.sleep(self.latency)
+        self.completed += 1
+
+
+def fake_charger_messages(count, seed=1):
+    """Build `count` Zaptec observations with a realistic mix of StateIds."""
+    rng = random.Random(seed)
+    # Chargers publish many observations; only a few are used by the controller
+    state_ids = [201, 202, 270, 501, 502, 503, 507, 508, 509, 510, 511, 513, 519, 553, 554, 708, 710, 711, 712, 800, 804, 808, 809]
+    messages = []
+    for index in range(count):
+        state_id = rng.choice(state_ids)
+        body = json.dumps({
+            "ChargerId": "00000000-0000-0000-0000-000000000000",
+            "StateId": state_id,
+            "Timestamp": f"2024-01-01T00:{index // 60 % 60:02d}:{index % 60:02d}.000",
+            "ValueAsString": f"{rng.uniform(0, 32):.3f}",
+        }).encode("utf-8")
+        messages.append(FakeMessage(body))
+    return messages
+
+
+def measure_zaptec_consumer(count=20000, latency=0.001, batch_size=100):
+    """
+    Measure Zaptec Service Bus consumer throughput against a local stand-in for the bus.
+
+    Compares the old loop (one message per receive, full JSON decode, one
+    completion call per message) with ZaptecConsumer.
+
+    Args:
+        count (int): Messages to consume.
+        latency (float): Simulated round trip per broker call in seconds.
+        batch_size (int): ZaptecConsumer batch size.
+
+    Returns:
+        dict: Messages per second for the old loop and the consumer in both settle modes.
+    """
+    from zaptec import ZaptecConsumer, message_bytes
+
+    messages = fake_charger_messages(count)
+    results = {}
+
+    receiver = FakeReceiver(messages, latency)
+    start = time.perf_counter()
+    for message in receiver:
+        json.loads(b"".join(message.body).decode("utf-8"))
+        receiver.complete_message(message)
+    results["per_message_msgs_per_s"] = count / (time.perf_counter() - start)
+
+    for receive_and_delete in (False, True):
+        receiver = FakeReceiver(messages, latency)
+        consumer = ZaptecConsumer(receiver_factory=lambda **kwargs: contextlib.nullcontext(receiver), batch_size=batch_size, receive_and_delete=receive_and_delete)
+        start = time.perf_counter()
+        while receiver.position < count:
+            consumer.process_batch(receiver, receiver.receive_messages(max_message_count=batch_size))
+        mode = "receive_and_delete" if receive_and_delete else "peek_lock"
+        results[f"batched_{mode}_msgs_per_s"] = count / (time.perf_counter() - start)
+    results["decoded_fraction"] = consumer.decoded_count / count
+    return results
+
+
+SUITE = []  # (name, params, setup) in registration order
+
+
+def suite_benchmark(name, params=(None,)):
+    """
+    Register a suite benchmark.
+
+    The decorated setup function is called once per parameter and returns the
+    zero-argument callable that is timed; work done in setup is not measured.
+
+    Args:
+        name (str): Benchmark name; the parameter is appended as name[param].
+        params (tuple): Sizes to run, usually a realistic one and a scaled-up one.
+    """
+    def register(setup):
+        SUITE.append((name, params, setup))
+        return setup
+    return register
+
+
+def import_controller():
+    """Import priceLoad with benchmark defaults for its environment and quiet logging."""
+    os.environ.setdefault("ENTSOE_API_KEY", "benchmark")
+    os.environ.setdefault("PRICE_CACHE_DIR", os.path.join(HERE, ".bench_price_cache"))
+    os.environ.setdefault("CAPACITY_STATE_FILE", "")  # Never touch the live capacity tariff state
+    controller = importlib.import_module("priceLoad")
+    # priceLoad logs plans and clamped currents; writing them out would be timed too
+    logging.getLogger().setLevel(logging.ERROR)
+    return controller
+
+
+def bench_start():
+    """Return a fixed local midnight so plans are the same on every run."""
+    from priceLoad import LOCAL_TZ
+    return LOCAL_TZ.localize(datetime(2024, 1, 15))
+
+
+def fake_prices(slots, start, resolution_minutes=15, seed=1):
+    """
+    Build a PriceStore with `slots` prices that wander and peak in the morning and evening.
+
+    Args:
+        slots (int): Number of price slots.
+        start (datetime): Start of the first slot (timezone-aware).
+        resolution_minutes (int): Slot length in minutes.
+        seed (int): Random seed.
+
+    Returns:
+        PriceStore: The prices.
+    """
+    from priceStore import PriceStore
+
+    rng = random.Random(seed)
+    level = 80.0
+    items = []
+    for index in range(slots):
+        when = start + timedelta(minutes=index * resolution_minutes)
+        hour = when.hour + when.minute / 60.0
+        level = max(level + rng.gauss(0, 1.0), 10.0)
+        shape = 1 + 0.5 * math.exp(-((hour - 8) ** 2) / 2.0) + 0.7 * math.exp(-((hour - 18) ** 2) / 3.0)
+        items.append((when.astimezone(timezone.utc), level * shape * rng.uniform(0.9, 1.1)))
+    store = PriceStore(resolution_minutes=resolution_minutes)
+    store.update(items)
+    return store
+
+
+def fake_shedder(devices, seed=1):
+    """Build a LoadShedder with `devices` devices of mixed size and priority that may switch at once."""
+    from loadShedding import LoadShedder
+
+    rng = random.Random(seed)
+    shedder = LoadShedder(10000, hysteresis=500, settle_seconds=0)
+    for index in range(devices):
+        shedder.add_device(f"bench/device_{index}", rng.choice((300, 500, 800, 1200, 2000)), priority=rng.randint(0, 3))
+    return shedder
+
+
+def fake_readings(count, centre=10000, spread=1500, seed=1):
+    """Return `count` meter readings in watts around `centre`."""
+    rng = random.Random(seed)
+    return [centre + rng.uniform(-spread, spread) for _ in range(count)]
+
+
+@suite_benchmark("charging_plan", params=(96, 672))
+def setup_charging_plan(slots):
+    """Cheapest charging slots over a 15-minute price day or week, as recomputed on a plan cache miss."""
+    controller = import_controller()
+    start = bench_start()
+    prices = fake_prices(slots, start)
+    deadline = start + timedelta(minutes=15 * slots)
+    return lambda: controller.build_charging_schedule(prices, start, deadline)
+
+
+@suite_benchmark("charging_plan_cached", params=(96,))
+def setup_charging_plan_cached(slots):
+    """plan_charging_schedule as called every control cycle, served from the plan cache."""
+    controller = import_controller()
+    start = bench_start()
+    prices = fake_prices(slots, start)
+    controller.plan_charging_schedule(start, prices)
+    return lambda: controller.plan_charging_schedule(start, prices)
+
+
+@suite_benchmark("water_heater_plan", params=(96, 672))
+def setup_water_heater_plan(slots):
+    """Water heater dynamic programme over a 15-minute price day or week."""
+    controller = import_controller()
+    start = bench_start()
+    prices = fake_prices(slots, start)
+    return lambda: controller.build_water_heater_plan(prices, start)
+
+
+@suite_benchmark("water_heater_cached", params=(96,))
+def setup_water_heater_cached(slots):
+    """schedule_water_heater as called every control cycle, served from the plan cache."""
+    controller = import_controller()
+    start = bench_start()
+    prices = fake_prices(slots, start)
+    controller.schedule_water_heater(prices, start, 'on')
+    return lambda: controller.schedule_water_heater(prices, start, 'on')
+
+
+def fake_heating(devices, seed=1):
+    """Give PowerControl `devices` heaters, half panel ovens and half floors, and a day of prices."""
+    import PowerControl
+
+    rng = random.Random(seed)
+    ovens = devices // 2
+    PowerControl.NORMAL_TEMPERATURES = {f"panelovn_{index}": rng.choice((18, 20, 22)) for index in range(ovens)}
+    PowerControl.NORMAL_FLOOR_TEMPS = {f"gulvvarme_{index}": 21.5 for index in range(devices - ovens)}
+    PowerControl.heating_prices = [rng.uniform(20, 300) for _ in range(24)]
+    PowerControl.expensive_hours = [7, 8, 9, 17, 18, 19, 20]
+    return PowerControl
+
+
+@suite_benchmark("setpoints", params=(5, 50))
+def setup_setpoints(devices):
+    """PowerControl.calculate_setpoints with the house's 5 heaters or 50, as called every hour."""
+    return fake_heating(devices).calculate_setpoints
+
+
+@suite_benchmark("setpoint_table", params=(5, 50))
+def setup_setpoint_table(devices):
+    """Rebuilding the per-hour setpoint table, as done when new prices or expensive hours arrive."""
+    controller = fake_heating(devices)
+    inputs = (controller.heating_prices, controller.expensive_hours, controller.NORMAL_TEMPERATURES, controller.NORMAL_FLOOR_TEMPS)
+    return lambda: controller.build_setpoint_table(*inputs)
+
+
+@suite_benchmark("desired_amperage")
+def setup_desired_amperage(_):
+    """Charging current for one reading: calculate_desired_amperage and adjust_charging_for_water_heater."""
+    controller = import_controller()
+    readings = fake_readings(1024)
+    position = [0]
+
+    def tick():
+        load = readings[position[0] & 1023]
+        position[0] += 1
+        controller.calculate_desired_amperage(load, 2000)
+        return controller.adjust_charging_for_water_heater(load, controller.MAX_TOTAL_LOAD, load, 2000, capacity_limit=9000)
+    return tick
+
+
+@suite_benchmark("rolling_update", params=(1, 100))
+def setup_rolling_update(rate):
+    """One meter reading into a full 15-minute rolling window at `rate` readings per second, with its summary."""
+    from rollingStats import RollingStats
+    from priceLoad import ROLLING_WINDOW_SECONDS
+
+    stats = RollingStats(window_seconds=ROLLING_WINDOW_SECONDS, max_rate=rate)
+    readings = fake_readings(4096)
+    step = 1.0 / rate
+    for index in range(stats.capacity):
+        stats.add(readings[index & 4095], index * step)
+    position = [stats.capacity]
+
+    def tick():
+        index = position[0]
+        position[0] += 1
+        stats.add(readings[index & 4095], index * step)
+        return stats.summary()
+    return tick
+
+
+@suite_benchmark("mqtt_dispatch", params=(6, 50))
+def setup_mqtt_dispatch(devices):
+    """TopicRouter dispatch of a stream of meter, price and per-device power messages."""
+    from mqttRouter import TopicRouter, parse_text
+
+    controller = import_controller()
+    router = TopicRouter()
+    sink = lambda topic, value: None
+    router.route("ams/price/+", sink)
+    router.route(controller.AMS_METER_TOPIC, sink)
+    router.route("home/water_heater/power", sink)
+    router.route(f"{controller.MQTT_TOPIC}/+/+/state", sink, parse=parse_text)
+    for index in range(devices):
+        router.route(f"home/device_{index}/power", sink)
+
+    rng = random.Random(1)
+    messages = []
+    for index in range(1024):
+        kind = rng.random()
+        if kind < 0.5:
+            topic = controller.AMS_METER_TOPIC
+        elif kind < 0.55:
+            topic = f"ams/price/{rng.randrange(24)}"
+        elif kind < 0.6:
+            topic = f"{controller.MQTT_TOPIC}/floor_heating/floor_{rng.randrange(1, 6)}/state"
+        else:
+            topic = f"home/device_{rng.randrange(devices)}/power"
+        payload = b"on" if topic.endswith("/state") else f"{rng.uniform(0, 12000):.1f}".encode()
+        messages.append((topic.encode(), payload))
+    position = [0]
+
+    def tick():
+        topic, payload = messages[position[0] & 1023]
+        position[0] += 1
+        return router.dispatch(topic, payload)
+    return tick
+
+
+@suite_benchmark("load_shedding", params=(6, 50))
+def setup_load_shedding(devices):
+    """LoadShedder.decide for a fluctuating reading around the limit, applying what it switches."""
+    shedder = fake_shedder(devices)
+    readings = fake_readings(1024)
+    position = [0]
+
+    def tick():
+        index = position[0]
+        position[0] += 1
+        changes = shedder.decide(readings[index & 1023], float(index))
+        for topic, state in changes.items():
+            shedder.set_state(topic, state, float(index))
+        return changes
+    return tick
+
+
+@suite_benchmark("control_tick", params=(6, 50))
+def setup_control_tick(devices):
+    """
+    The in-process work of one control cycle with `devices` switchable loads.
+
+    Cached plans, the load prediction, load shedding and the charging current;
+    meter, MQTT and Zaptec I/O are left out.
+    """
+    controller = import_controller()
+    start = bench_start()
+    prices = fake_prices(192, start)
+    shedder = fake_shedder(devices)
+    readings = fake_readings(1024)
+    from rollingStats import RollingStats
+    stats = RollingStats(window_seconds=controller.ROLLING_WINDOW_SECONDS)
+    for index, reading in enumerate(readings):
+        stats.add(reading, float(index))
+    snapshot = controller.shared_state.snapshot()._replace(prices=prices, rolling=stats.summary(), water_heater_power=2000.0)
+    position = [0]
+
+    def tick():
+        index = position[0]
+        position[0] += 1
+        now = start + timedelta(minutes=index & 511)
+        load = readings[index & 1023]
+        controller.plan_charging_schedule(now, prices)
+        controller.schedule_water_heater(prices, now, 'on')
+        average_load = controller.predict_window_load(snapshot, now)
+        for topic, state in shedder.decide(load, float(index)).items():
+            shedder.set_state(topic, state, float(index))
+        return controller.adjust_charging_for_water_heater(average_load, controller.MAX_TOTAL_LOAD, load, snapshot.water_heater_power, capacity_limit=9000)
+    return tick
+
+
+def time_callable(func, repeat=SUITE_REPEAT):
+    """
+    Time a callable, choosing the number of calls per round automatically.
+
+    Args:
+        func (callable): Zero-argument callable.
+        repeat (int): Timing rounds.
+
+    Returns:
+        dict: Fastest and median time per call in microseconds, and the calls per round.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    rounds = [elapsed / number * 1e6 for elapsed in timer.repeat(repeat, number)]
+    return {"min_us": min(rounds), "median_us": statistics.median(rounds), "calls": number}
+
+
+def run_suite(pattern=None, repeat=SUITE_REPEAT):
+    """
+    Run the registered suite benchmarks.
+
+    Args:
+        pattern (str, optional): Only run benchmarks whose name contains this.
+        repeat (int): Timing rounds per benchmark.
+
+    Returns:
+        dict: Benchmark name -> timing from time_callable.
+    """
+    results = {}
+    for name, params, setup in SUITE:
+        for param in params:
+            full_name = name if param is None else f"{name}[{param}]"
+            if pattern and pattern not in full_name:
+                continue
+            results[full_name] = time_callable(setup(param), repeat)
+    return results
+
+
+def results_path(results_dir=RESULTS_DIR):
+    """Return the suite history file for this machine."""
+    return os.path.join(results_dir, f"{platform.node() or 'unknown'}.json")
+
+
+def load_history(path):
+    """Return the saved suite runs in `path`, oldest first, or an empty list."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable benchmark history {path}: {e}")
+        return []
+
+
+def git_commit():
+    """Return the current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_run(path, suite_results):
+    """
+    Append a suite run to the history file.
+
+    Args:
+        path (str): History file.
+        suite_results (dict): Results from run_suite.
+    """
+    history = load_history(path)
+    history.append({
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": suite_results,
+    })
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def find_regressions(suite_results, history, threshold=REGRESSION_THRESHOLD, runs=BASELINE_RUNS):
+    """
+    Compare suite results with the saved runs of the same machine.
+
+    The baseline of a benchmark is the median of its fastest round over the last
+    `runs` saved runs that include it; benchmarks without history are skipped.
+
+    Args:
+        suite_results (dict): Results from run_suite.
+        history (list): Saved runs from load_history.
+        threshold (float): Slowdown factor that counts as a regression.
+        runs (int): Saved runs the baseline is taken from.
+
+    Returns:
+        list: (name, baseline microseconds, current microseconds) for each regression.
+    """
+    regressions = []
+    for name, result in suite_results.items():
+        previous = [run["results"][name]["min_us"] for run in history if name in run.get("results", {})][-runs:]
+        if not previous:
+            continue
+        baseline = statistics.median(previous)
+        if result["min_us"] > baseline * threshold:
+            regressions.append((name, baseline, result["min_us"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark script startup, the Zaptec consumer and the control loop.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per script (default: 5).")
+    parser.add_argument("--max-seconds", type=float, default=None, help="Fail if a median import takes longer.")
+    parser.add_argument("--bus-messages", type=int, default=20000, help="Messages for the Zaptec consumer benchmark (0 skips it).")
+    parser.add_argument("--bus-latency-ms", type=float, default=1.0, help="Simulated Service Bus round trip (default: 1 ms).")
+    parser.add_argument("--skip-startup", action="store_true", help="Do not measure script startup.")
+    parser.add_argument("--suite", default="", metavar="PATTERN", help="Only run suite benchmarks whose name contains PATTERN.")
+    parser.add_argument("--no-suite", action="store_true", help="Do not run the suite benchmarks.")
+    parser.add_argument("--save", action="store_true", help="Append the suite results to this machine's history.")
+    parser.add_argument("--results-dir", default=RESULTS_DIR, help=f"Directory of suite histories (default: {RESULTS_DIR}).")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"Slowdown against the saved baseline that fails the run (default: {REGRESSION_THRESHOLD}).")
+    args = parser.parse_args()
+
+    failed = False
+    results = {}
+    for module in [] if args.skip_startup else STARTUP_SCRIPTS:
+        result = measure_startup(module, args.repeat)
+        results[module] = result
+        print(
+            f"{module:<12} import median {result['median_s'] * 1000:8.1f} ms  "
+            f"max {result['max_s'] * 1000:8.1f} ms  peak RSS {result['peak_rss_mb']:6.1f} MB"
+        )
+        if result["heavy_modules"]:
+            print(f"  heavy modules imported at startup: {', '.join(result['heavy_modules'])}")
+            failed = True
+        if args.max_seconds is not None and result["median_s"] > args.max_seconds:
+            print(f"  slower than the {args.max_seconds:.2f} s budget")
+            failed = True
+
+    if args.bus_messages:
+        result = measure_zaptec_consumer(args.bus_messages, args.bus_latency_ms / 1000.0)
+        results["zaptec_consumer"] = result
+        print(
+            f"zaptec bus   per message {result['per_message_msgs_per_s']:10.0f} msg/s  "
+            f"batched peek-lock {result['batched_peek_lock_msgs_per_s']:10.0f} msg/s  "
+            f"batched receive-and-delete {result['batched_receive_and_delete_msgs_per_s']:10.0f} msg/s"
+        )
+
+    if not args.no_suite:
+        suite_results = run_suite(args.suite)
+        results["suite"] = suite_results
+        for name, result in suite_results.items():
+            print(f"{name:<26} {result['min_us']:12.2f} us  (median {result['median_us']:.2f} us, {result['calls']} calls per round)")
+        for name, result in suite_results.items():
+            if name.startswith("mqtt_dispatch"):
+                print(f"  {name}: {1e6 / result['min_us']:.0f} msg/s, {result['min_us'] * MQTT_RATE / 1e4:.2f}% of a core at {MQTT_RATE} msg/s")
+
+        path = results_path(args.results_dir)
+        for name, baseline, current in find_regressions(suite_results, load_history(path), args.threshold):
+            print(f"  regression: {name} {current:.2f} us against a baseline of {baseline:.2f} us")
+            failed = True
+        if args.save:
+            save_run(path, suite_results)
+            print(f"Saved suite results to {path}")
+
+    print(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
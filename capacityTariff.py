@@ -0,0 +1,258 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+# Capacity tariff steps (effekttrinn) in kW, as used by most Norwegian grid companies
+DEFAULT_TIERS = [2, 5, 10, 15, 20, 25, 50, 75, 100]
+TOP_DAYS = 3  # The tariff is the average of the highest hour on each of the three highest days
+MAX_SAMPLE_GAP = 300  # Do not integrate across gaps longer than this many seconds
+MIN_REMAINING_SECONDS = 60  # Treat the last minute of the hour as a minute when projecting
+CAPACITY_STATE_FILE = os.getenv("CAPACITY_STATE_FILE", "capacity_state.json")
+
+
+class CapacityTariff:
+    """
+    Tracks the monthly capacity tariff from the live meter stream.
+
+    Power readings are integrated (trapezoid rule) into the energy of the current
+    hour. When an hour ends it updates today's highest hour; when a day ends its
+    highest hour goes into a min-heap holding the month's top days. The energy of
+    the current hour is predicted by assuming the present load continues, and the
+    hour only needs throttling when that prediction would set a new peak for the
+    month (or, with `within_step`, raise the average into a higher tariff step).
+    """
+
+    def __init__(self, tz, tiers=DEFAULT_TIERS, top_days=TOP_DAYS, within_step=True, state_path=CAPACITY_STATE_FILE):
+        """
+        Args:
+            tz (tzinfo): Local timezone; hours and days follow local time.
+            tiers (list): Upper bounds of the tariff steps in kW, ascending.
+            top_days (int): Number of days averaged by the tariff.
+            within_step (bool): Allow new peaks that keep the average within the current tariff step.
+            state_path (str, optional): JSON file keeping the month's day peaks across restarts.
+        """
+        self.tz = tz
+        self.tiers = tiers
+        self.top_days = top_days
+        self.within_step = within_step
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self.month = None  # (year, month)
+        self.day = None  # local date of today
+        self.hour_start = None  # epoch seconds of the current hour
+        self.hour_energy = 0.0  # kWh so far in the current hour
+        self.today_max = 0.0  # highest complete hour today in kWh
+        self.top = []  # min-heap of the highest day peaks this month (completed days)
+        self._last = None  # (timestamp, watts)
+        if state_path:
+            self._load()
+
+    def add(self, watts, timestamp=None):
+        """
+        Integrate a power reading into the current hour.
+
+        Args:
+            watts (float): Current power usage in watts.
+            timestamp (float, optional): Time of the reading. Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            hour_start = timestamp - timestamp % 3600
+            if self.hour_start is None:
+                self._start_hour(hour_start)
+            elif hour_start > self.hour_start:
+                if self._last is not None and hour_start - self._last[0] <= MAX_SAMPLE_GAP:
+                    # Split the interval at the hour boundary
+                    boundary_watts = self._interpolate(hour_start, watts, timestamp)
+                    self._integrate(self._last[0], self._last[1], hour_start, boundary_watts)
+                    self._last = (hour_start, boundary_watts)
+                self._finish_hour()
+                self._start_hour(hour_start)
+            elif timestamp < self.hour_start:
+                return  # Late reading from a finished hour
+
+            if self._last is not None and 0 < timestamp - self._last[0] <= MAX_SAMPLE_GAP:
+                self._integrate(self._last[0], self._last[1], timestamp, watts)
+            self._last = (timestamp, watts)
+
+    def predict_hour_energy(self, current_power=None, timestamp=None):
+        """
+        Predict the energy of the current hour if the load stays at `current_power`.
+
+        Args:
+            current_power (float, optional): Load to assume for the rest of the hour. Defaults to the last reading.
+            timestamp (float, optional): Current time. Defaults to now.
+
+        Returns:
+            float: Predicted kWh for the hour.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if current_power is None:
+                current_power = self._last[1] if self._last else 0.0
+            return self.hour_energy + current_power / 1000.0 * self._remaining_hours(timestamp)
+
+    def allowed_hour_energy(self):
+        """
+        Return the most energy the current hour may use without raising the tariff step.
+
+        An hour at or below today's highest hour changes nothing, and neither does
+        one below the smallest of the month's top days. With `within_step`, an hour
+        that keeps the average of the top days within the current step is allowed too.
+
+        Returns:
+            float: Allowed kWh for the current hour.
+        """
+        with self._lock:
+            return self._allowed()
+
+    def power_limit(self, current_power=None, timestamp=None):
+        """
+        Return the highest average load for the rest of the hour that avoids a new tariff step.
+
+        Args:
+            current_power (float, optional): Present load. Defaults to the last reading.
+            timestamp (float, optional): Current time. Defaults to now.
+
+        Returns:
+            float: Load limit in watts, or None if the hour is not projected to raise the tariff.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if current_power is None:
+                current_power = self._last[1] if self._last else 0.0
+            remaining = self._remaining_hours(timestamp)
+            allowed = self._allowed()
+            if self.hour_energy + current_power / 1000.0 * remaining <= allowed:
+                return None
+            return max(allowed - self.hour_energy, 0.0) / remaining * 1000.0
+
+    def monthly_peak(self):
+        """
+        Return the current tariff basis: the average of the highest hour on the top days, in kW.
+
+        Returns:
+            float: Average of the top day peaks, including today so far.
+        """
+        with self._lock:
+            values = heapq.nlargest(self.top_days, self.top + [max(self.today_max, self.hour_energy)])
+        return sum(values) / len(values) if values else 0.0
+
+    def tier(self, average_kw=None):
+        """
+        Return the tariff step for an average peak.
+
+        Args:
+            average_kw (float, optional): Average of the top day peaks. Defaults to the current value.
+
+        Returns:
+            int: Index into `tiers`.
+        """
+        average_kw = self.monthly_peak() if average_kw is None else average_kw
+        for index, bound in enumerate(self.tiers):
+            if average_kw <= bound:
+                return index
+        return len(self.tiers) - 1
+
+    def _allowed(self):
+        # Today only counts if it beats the smallest of the month's top days
+        threshold = max(self.today_max, self.top[0] if len(self.top) >= self.top_days else 0.0)
+        if not self.within_step:
+            return threshold
+        others = heapq.nlargest(self.top_days - 1, self.top)
+        count = min(self.top_days, len(self.top) + 1)
+        current = (sum(heapq.nlargest(self.top_days, self.top + [self.today_max]))) / count
+        bound = self.tiers[self.tier(current)]
+        # Largest today-peak that keeps the average within the current step
+        within_step = bound * count - sum(others)
+        return max(threshold, within_step)
+
+    def _remaining_hours(self, timestamp):
+        if self.hour_start is None:
+            return 1.0
+        remaining = self.hour_start + 3600 - timestamp
+        return max(remaining, MIN_REMAINING_SECONDS) / 3600.0
+
+    def _interpolate(self, at, watts, timestamp):
+        last_time, last_watts = self._last
+        if timestamp <= last_time:
+            return watts
+        return last_watts + (watts - last_watts) * (at - last_time) / (timestamp - last_time)
+
+    def _integrate(self, t0, w0, t1, w1):
+        self.hour_energy += (w0 + w1) / 2.0 * (t1 - t0) / 3600.0 / 1000.0
+
+    def _start_hour(self, hour_start):
+        local = datetime.fromtimestamp(hour_start, self.tz)
+        month = (local.year, local.month)
+        if self.day is not None and local.date() != self.day:
+            self._finish_day()
+        if month != self.month:
+            if self.month is not None:
+                logging.info(f"Capacity tariff for {self.month[0]}-{self.month[1]:02d}: {self.monthly_peak():.2f} kW.")
+            self.month = month
+            self.top = []
+            self.today_max = 0.0
+        self.day = local.date()
+        self.hour_start = hour_start
+        self.hour_energy = 0.0
+
+    def _finish_hour(self):
+        if self.hour_energy > self.today_max:
+            self.today_max = self.hour_energy
+            logging.info(f"New highest hour today: {self.hour_energy:.2f} kWh.")
+        self._save()
+
+    def _finish_day(self):
+        if self.today_max > 0:
+            if len(self.top) < self.top_days:
+                heapq.heappush(self.top, self.today_max)
+            elif self.today_max > self.top[0]:
+                heapq.heapreplace(self.top, self.today_max)
+        self.today_max = 0.0
+
+    def _save(self):
+        if not self.state_path:
+            return
+        state = {
+            "month": list(self.month),
+            "day": self.day.isoformat(),
+            "today_max": self.today_max,
+            "top": sorted(self.top, reverse=True),
+        }
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logging.error(f"Could not save capacity tariff state to {self.state_path}: {e}")
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable capacity tariff state {self.state_path}: {e}")
+            return
+
+        now = datetime.now(self.tz)
+        if tuple(state.get("month", ())) != (now.year, now.month):
+            return
+        self.month = (now.year, now.month)
+        self.top = list(state.get("top", []))[:self.top_days]
+        heapq.heapify(self.top)
+        if state.get("day") == now.date().isoformat():
+            self.day = now.date()
+            self.today_max = state.get("today_max", 0.0)
+        else:
+            # The saved day has ended while we were not running
+            self.today_max = state.get("today_max", 0.0)
+            self._finish_day()
+        logging.info(f"Loaded capacity tariff state: top days {sorted(self.top, reverse=True)}, today {self.today_max:.2f} kWh.")
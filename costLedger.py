@@ -0,0 +1,187 @@
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+COST_LEDGER_FILE = os.getenv("COST_LEDGER_FILE", "cost_ledger.bin")
+RECORD = struct.Struct("<qdd")  # slot start epoch, kWh, price per MWh (NaN if unknown)
+KWH_PER_MWH = 1000.0
+MAX_SAMPLE_GAP = 300  # Do not integrate across gaps longer than this many seconds
+
+
+class CostLedger:
+    """
+    Incremental energy and cost accumulator.
+
+    Power samples are integrated with the trapezoid rule into the kWh of the
+    current price slot; an interval crossing a slot boundary is split there. When
+    a slot ends its energy is priced and added to the day and month totals, and a
+    24-byte record is appended to the ledger file. Prices are per MWh, as ENTSO-E
+    publishes them, and are recorded that way; costs are in `currency`. Each sample costs O(1) and no
+    raw samples are kept. On start-up the current month is rebuilt from the file.
+    """
+
+    def __init__(self, tz, price_of, slot_seconds=3600, path=COST_LEDGER_FILE, currency="EUR"):
+        """
+        Args:
+            tz (tzinfo): Local timezone; days and months follow local time.
+            price_of (callable): Returns the price per MWh for a UTC epoch (slot start), or None if unknown.
+            slot_seconds (int): Length of a price slot in seconds.
+            path (str, optional): Append-only ledger file. None keeps everything in memory.
+            currency (str): Currency of the prices, used in log lines.
+        """
+        self.tz = tz
+        self.price_of = price_of
+        self.currency = currency
+        self.slot_seconds = slot_seconds
+        self.path = path
+        self._lock = threading.Lock()
+        self.slot_start = None
+        self.slot_kwh = 0.0
+        self._slot_price = None
+        self.day = None  # local date
+        self.day_kwh = self.day_cost = 0.0
+        self.month = None  # (year, month)
+        self.month_kwh = self.month_cost = 0.0
+        self.unpriced_kwh = 0.0  # Energy in slots without a known price this month
+        self._last = None  # (timestamp, watts)
+        if path:
+            self._replay()
+
+    def add(self, watts, timestamp=None):
+        """
+        Integrate a power sample.
+
+        Args:
+            watts (float): Power usage in watts.
+            timestamp (float, optional): Time of the sample. Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if self._last is not None and timestamp <= self._last[0]:
+                return  # Duplicate or out-of-order sample
+            if self.slot_start is None:
+                self.slot_start = timestamp - timestamp % self.slot_seconds
+
+            last = self._last
+            self._last = (timestamp, watts)
+            if last is None or timestamp - last[0] > MAX_SAMPLE_GAP:
+                self._advance(timestamp)
+                return
+
+            t0, w0 = last
+            while timestamp >= self.slot_start + self.slot_seconds:
+                boundary = self.slot_start + self.slot_seconds
+                boundary_watts = w0 + (watts - w0) * (boundary - t0) / (timestamp - t0)
+                self.slot_kwh += (w0 + boundary_watts) / 2.0 * (boundary - t0) / 3.6e6
+                self._close_slot()
+                self._open_slot(boundary)
+                t0, w0 = boundary, boundary_watts
+            self.slot_kwh += (w0 + watts) / 2.0 * (timestamp - t0) / 3.6e6
+
+    def totals(self):
+        """
+        Return energy and cost so far, including the current (partial) slot.
+
+        Returns:
+            dict: {'slot': (kWh, cost), 'day': (kWh, cost), 'month': (kWh, cost)}; cost is in `currency`, None if the slot price is unknown.
+        """
+        with self._lock:
+            price = self._current_price()
+            slot_cost = None if price is None else self.slot_kwh * price / KWH_PER_MWH
+            extra = slot_cost or 0.0
+            day_kwh, day_cost = self.day_kwh, self.day_cost
+            month_kwh, month_cost = self.month_kwh, self.month_cost
+            if self.slot_start is not None:
+                local = datetime.fromtimestamp(self.slot_start, self.tz)
+                if local.date() != self.day:
+                    day_kwh = day_cost = 0.0
+                if (local.year, local.month) != self.month:
+                    month_kwh = month_cost = 0.0
+            return {
+                "slot": (self.slot_kwh, slot_cost),
+                "day": (day_kwh + self.slot_kwh, day_cost + extra),
+                "month": (month_kwh + self.slot_kwh, month_cost + extra),
+            }
+
+    def close(self):
+        """Record the current partial slot, e.g. on shutdown."""
+        with self._lock:
+            if self.slot_start is not None and self.slot_kwh > 0:
+                self._close_slot()
+                self.slot_kwh = 0.0
+
+    def _current_price(self):
+        # Look the price up once per slot, and again while it is still unknown
+        if self._slot_price is None and self.slot_start is not None:
+            self._slot_price = self.price_of(self.slot_start)
+        return self._slot_price
+
+    def _advance(self, timestamp):
+        # Skip to the slot containing `timestamp` without integrating the gap
+        slot_start = timestamp - timestamp % self.slot_seconds
+        if slot_start != self.slot_start:
+            if self.slot_kwh > 0:
+                self._close_slot()
+            self._open_slot(slot_start)
+
+    def _open_slot(self, slot_start):
+        self.slot_start = slot_start
+        self.slot_kwh = 0.0
+        self._slot_price = None
+
+    def _close_slot(self):
+        price = self._current_price()
+        self._account(self.slot_start, self.slot_kwh, price)
+        if self.path:
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(RECORD.pack(int(self.slot_start), self.slot_kwh, math.nan if price is None else price))
+            except OSError as e:
+                logging.error(f"Could not append to cost ledger {self.path}: {e}")
+
+    def _account(self, slot_start, kwh, price):
+        local = datetime.fromtimestamp(slot_start, self.tz)
+        month = (local.year, local.month)
+        if month != self.month:
+            if self.month is not None:
+                logging.info(f"Energy for {self.month[0]}-{self.month[1]:02d}: {self.month_kwh:.2f} kWh, cost {self.month_cost:.2f} {self.currency}.")
+            self.month = month
+            self.month_kwh = self.month_cost = self.unpriced_kwh = 0.0
+        if local.date() != self.day:
+            if self.day is not None:
+                logging.info(f"Energy for {self.day}: {self.day_kwh:.2f} kWh, cost {self.day_cost:.2f} {self.currency}.")
+            self.day = local.date()
+            self.day_kwh = self.day_cost = 0.0
+
+        self.day_kwh += kwh
+        self.month_kwh += kwh
+        if price is None or math.isnan(price):
+            self.unpriced_kwh += kwh
+        else:
+            self.day_cost += kwh * price / KWH_PER_MWH
+            self.month_cost += kwh * price / KWH_PER_MWH
+
+    def _replay(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.warning(f"Could not read cost ledger {self.path}: {e}")
+            return
+
+        now = datetime.now(self.tz)
+        usable = len(data) - len(data) % RECORD.size  # Ignore a torn final record
+        count = 0
+        for slot_start, kwh, price in RECORD.iter_unpack(data[:usable]):
+            local = datetime.fromtimestamp(slot_start, self.tz)
+            if (local.year, local.month) == (now.year, now.month):
+                self._account(slot_start, kwh, price)
+                count += 1
+        if count:
+            logging.info(f"Loaded {count} cost ledger records: {self.month_kwh:.2f} kWh, cost {self.month_cost:.2f} {self.currency} this month.")
@@ -0,0 +1,237 @@
+import logging
+import math
+import threading
+import time
+from array import array
+
+DEFAULT_RESOLUTION = 50  # Watts per knapsack unit
+
+
+class Device:
+    """A switchable load known to the shedder."""
+
+    def __init__(self, topic, watts, priority=0, min_on_seconds=0, min_off_seconds=0):
+        """
+        Args:
+            topic (str): MQTT topic of the device.
+            watts (float): Power saved by switching the device off.
+            priority (int): Importance; devices with a lower priority are shed first.
+            min_on_seconds (float): Minimum time on before the device may be shed.
+            min_off_seconds (float): Minimum time off before the device may be switched back on.
+        """
+        self.topic = topic
+        self.watts = watts
+        self.priority = priority
+        self.min_on_seconds = min_on_seconds
+        self.min_off_seconds = min_off_seconds
+        self.state = 'on'
+        self.changed_at = 0.0
+
+    def can_switch(self, timestamp):
+        """Return True if the device has been in its current state long enough to switch."""
+        dwell = self.min_on_seconds if self.state == 'on' else self.min_off_seconds
+        return timestamp - self.changed_at >= dwell
+
+
+class LoadShedder:
+    """
+    Chooses which devices to switch off so the total load stays under a limit.
+
+    When the load is too high, the devices to shed are picked with a covering
+    knapsack: cover the excess while shedding the lowest priorities and, within
+    a priority, the fewest devices. Every device costs more than all devices of
+    a lower priority put together. The solution is reused while the devices are
+    unchanged and it still covers the excess without overshooting by more than
+    the hysteresis, so a fluctuating meter stream rarely triggers a new solve.
+    Shed devices are switched back on, most important first, once there is room
+    for them below the limit minus the hysteresis.
+    """
+
+    def __init__(self, limit, hysteresis=500, resolution=DEFAULT_RESOLUTION, settle_seconds=15):
+        """
+        Args:
+            limit (float): Maximum total load in watts.
+            hysteresis (float): Headroom in watts kept free when switching shed devices back on.
+            resolution (float): Watts per knapsack unit; coarser is faster.
+            settle_seconds (float): How long after a switch the meter may not yet reflect it.
+        """
+        self.limit = limit
+        self.hysteresis = hysteresis
+        self.settle_seconds = settle_seconds
+        self.resolution = resolution
+        self.devices = {}
+        self.shed = set()  # Topics switched off by the shedder
+        self._lock = threading.Lock()
+        self._version = 0
+        self._cached_key = None
+        self._cached_choice = []
+        self._cached_need = 0
+        self._cached_watts = 0.0
+        self.solve_count = 0
+
+    def add_device(self, topic, watts, priority=0, min_on_seconds=0, min_off_seconds=0):
+        """
+        Register a device (or replace its settings).
+
+        Args:
+            topic (str): MQTT topic of the device.
+            watts (float): Initial estimate of the power saved by switching it off.
+            priority (int): Importance; lower is shed first.
+            min_on_seconds (float): Minimum on time before shedding.
+            min_off_seconds (float): Minimum off time before switching back on.
+        """
+        with self._lock:
+            self.devices[topic] = Device(topic, watts, priority, min_on_seconds, min_off_seconds)
+            self._version += 1
+
+    def update_watts(self, topic, watts):
+        """
+        Update the measured power of a device.
+
+        Args:
+            topic (str): MQTT topic of the device.
+            watts (float): Power saved by switching it off.
+        """
+        with self._lock:
+            device = self.devices.get(topic)
+            if device is None or device.watts == watts:
+                return
+            device.watts = watts
+            self._version += 1
+
+    def set_state(self, topic, state, timestamp=None):
+        """
+        Record that a device was switched (by the shedder or anything else).
+
+        Args:
+            topic (str): MQTT topic of the device.
+            state (str): 'on' or 'off'.
+            timestamp (float, optional): Time of the switch. Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            device = self.devices.get(topic)
+            if device is None or device.state == state:
+                return
+            device.state = state
+            device.changed_at = timestamp
+            if state == 'on':
+                self.shed.discard(topic)
+            self._version += 1
+
+    def is_shed(self, topic):
+        """Return True if the shedder is currently holding the device off."""
+        with self._lock:
+            return topic in self.shed
+
+    def decide(self, current_power, timestamp=None, restore=True, limit=None):
+        """
+        Decide which devices to switch for the current load.
+
+        Args:
+            current_power (float): Current total load in watts.
+            timestamp (float, optional): Time of the reading. Defaults to now.
+            restore (bool): Also switch shed devices back on when there is room.
+            limit (float, optional): Load limit for this reading, e.g. a lower capacity-tariff limit. Defaults to `limit`.
+
+        Returns:
+            dict: topic -> 'on' or 'off' for the devices that should change state.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            limit = self.limit if limit is None else limit
+            excess = self._projected(current_power, timestamp) - limit
+            if excess > 0:
+                choice = self._choose(excess, timestamp)
+                self.shed.update(choice)
+                return {topic: 'off' for topic in choice}
+            if restore:
+                return {topic: 'on' for topic in self._restore(-excess - self.hysteresis, timestamp)}
+            return {}
+
+    def _projected(self, current_power, timestamp):
+        # Switches the meter has not caught up with yet
+        for device in self.devices.values():
+            if timestamp - device.changed_at < self.settle_seconds:
+                current_power += device.watts if device.state == 'on' else -device.watts
+        return current_power
+
+    def _choose(self, excess, timestamp):
+        need = int(math.ceil(excess / self.resolution))
+        candidates = [
+            device for device in self.devices.values()
+            if device.state == 'on' and device.watts > 0 and device.can_switch(timestamp)
+        ]
+        key = (self._version, tuple(device.topic for device in candidates))
+        if key == self._cached_key and self._still_fits(need, excess):
+            return self._cached_choice
+
+        self.solve_count += 1
+        available = sum(device.watts for device in candidates)
+        if available < excess:
+            # Cannot get under the limit; shed everything that may be shed
+            choice = [device.topic for device in candidates]
+            if candidates:
+                logging.warning(f"Shedding all {len(candidates)} switchable devices still leaves the load {excess - available:.0f} W above the limit.")
+        else:
+            choice = self._cover(candidates, need)
+
+        self._cached_key, self._cached_choice, self._cached_need = key, choice, need
+        self._cached_watts = sum(self.devices[topic].watts for topic in choice)
+        return choice
+
+    def _still_fits(self, need, excess):
+        # Reuse the last answer while it still covers the excess without shedding much more than needed
+        slack = int(self.hysteresis // self.resolution)
+        return self._cached_watts >= excess and need >= self._cached_need - slack
+
+    def _cover(self, candidates, need):
+        # Lexicographic cost: any device outweighs all devices of lower priority together
+        base = len(candidates) + 1
+        rank = {priority: i for i, priority in enumerate(sorted({device.priority for device in candidates}))}
+
+        inf = math.inf
+        best = [inf] * (need + 1)  # best[w]: cheapest cost covering at least w units
+        best[0] = 0
+        parents = []  # per device: parents[i][w] = cell the device was added to, or -1
+        for device in candidates:
+            units = max(int(device.watts // self.resolution), 1)
+            cost = base ** rank[device.priority]
+            parent = array('i', [-1]) * (need + 1)
+            for w in range(need, -1, -1):
+                if best[w] == inf:
+                    continue
+                target = min(need, w + units)
+                if best[w] + cost < best[target]:
+                    best[target] = best[w] + cost
+                    parent[target] = w
+            parents.append(parent)
+
+        if best[need] == inf:
+            # Rounding down to whole units left the excess uncovered; shed everything
+            return [device.topic for device in candidates]
+
+        choice = []
+        w = need
+        for device, parent in zip(reversed(candidates), reversed(parents)):
+            if w == 0:
+                break
+            if parent[w] >= 0:
+                choice.append(device.topic)
+                w = parent[w]
+        return choice
+
+    def _restore(self, headroom, timestamp):
+        restored = []
+        waiting = sorted(
+            (self.devices[topic] for topic in self.shed if topic in self.devices),
+            key=lambda device: (-device.priority, device.watts)
+        )
+        for device in waiting:
+            if device.watts <= headroom and device.can_switch(timestamp):
+                headroom -= device.watts
+                restored.append(device.topic)
+        for topic in restored:
+            self.shed.discard(topic)
+        return restored
+
@@ -0,0 +1,312 @@
+import bisect
+import logging
+import math
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from a fast in-process stage to a slow HTTP call with retries
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_SAMPLES = 1024  # Observations kept per histogram for the p50/p90/p99 lines
+QUANTILES = (0.5, 0.9, 0.99)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, extra=None):
+    """Render a label set as {name="value",...}; empty if there are none."""
+    items = list(labels) + list(extra or ())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in items) + "}"
+
+
+def format_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count, e.g. of retries or reconnects."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Add `amount` (default 1) to the count."""
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield f"{name}_total{format_labels(labels)} {format_value(self.value)}"
+
+
+class Histogram:
+    """
+    Distribution of observations in fixed cumulative buckets, Prometheus style.
+
+    The last `recent` observations are also kept in a ring buffer so the endpoint
+    can show p50/p90/p99 directly, without a Prometheus server to compute them
+    from the buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, recent=RECENT_SAMPLES):
+        """
+        Args:
+            buckets (tuple): Upper bounds of the buckets, increasing; +Inf is added.
+            recent (int): Observations kept for the quantiles.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._recent = array('d', bytes(8 * recent))
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observation."""
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._recent[self.count % len(self._recent)] = value
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Return the q-quantile of the recent observations (nearest-rank).
+
+        Args:
+            q (float): Quantile between 0 and 1.
+
+        Returns:
+            float: The quantile, or None if nothing was observed.
+        """
+        with self._lock:
+            recent = sorted(self._recent[:min(self.count, len(self._recent))])
+        if not recent:
+            return None
+        rank = int(math.ceil(q * len(recent))) - 1
+        return recent[min(max(rank, 0), len(recent) - 1)]
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            yield f"{name}_bucket{format_labels(labels, [('le', format_value(bound))])} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {format_value(total)}"
+        yield f"{name}_count{format_labels(labels)} {count}"
+
+
+class Span:
+    """Context manager that times its block into a histogram, also when the block raises."""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.histogram
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class CallbackValue:
+    """A counter or gauge read from existing state each time the metrics are rendered."""
+
+    def __init__(self, read, suffix=""):
+        self.read = read
+        self.suffix = suffix
+
+    def samples(self, name, labels):
+        try:
+            value = self.read()
+        except Exception as e:
+            logging.debug(f"Metric {name} could not be read: {e}")
+            value = None
+        yield f"{name}{self.suffix}{format_labels(labels)} {format_value(value)}"
+
+
+class MetricsRegistry:
+    """
+    Named counters, histograms and timing spans, rendered in the Prometheus text format.
+
+    Metrics are created on first use and identified by name and labels, so the
+    hot path holds on to the returned object or looks it up again cheaply.
+    Counts that other objects already keep (e.g. the Zaptec scheduler's) are
+    registered as callbacks and read only when the metrics are rendered.
+    """
+
+    def __init__(self, prefix="powercontrol"):
+        """
+        Args:
+            prefix (str): Prepended to every metric name.
+        """
+        self.prefix = prefix
+        self._families = {}  # name -> (type, help, {labels: metric})
+        self._index = {}  # (kind, name, labels) -> metric, read without the lock
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted(labels.items())) if len(labels) > 1 else tuple(labels.items())
+        metric = self._index.get((kind, name, key))
+        if metric is not None:
+            return metric
+        with self._lock:
+            family = self._families.setdefault(f"{self.prefix}_{name}", (kind, help_text, {}))
+            if family[0] != kind:
+                raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+                self._index[(kind, name, key)] = metric
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        """
+        Return the counter `name` with the given labels, creating it if needed.
+
+        Args:
+            name (str): Metric name without the prefix or the _total suffix.
+            help_text (str): Description shown on the endpoint.
+            **labels: Label values.
+
+        Returns:
+            Counter: The counter.
+        """
+        return self._get("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Return the histogram `name` with the given labels, creating it if needed.
+
+        Args:
+            name (str): Metric name without the prefix.
+            help_text (str): Description shown on the endpoint.
+            buckets (tuple): Bucket upper bounds for a new histogram.
+            **labels: Label values.
+
+        Returns:
+            Histogram: The histogram.
+        """
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def counter_callback(self, name, read, help_text="", **labels):
+        """Expose a count kept elsewhere; `read()` is called when the metrics are rendered."""
+        self._get("counter", name, help_text, labels, lambda: CallbackValue(read, "_total"))
+
+    def gauge_callback(self, name, read, help_text="", **labels):
+        """Expose a current value kept elsewhere; `read()` is called when the metrics are rendered."""
+        self._get("gauge", name, help_text, labels, lambda: CallbackValue(read))
+
+    def span(self, name, help_text="", **labels):
+        """
+        Return a context manager that times its block into the histogram `name`.
+
+        Args:
+            name (str): Histogram name, e.g. 'stage_seconds'.
+            help_text (str): Description shown on the endpoint.
+            **labels: Label values, e.g. stage='meter_poll'.
+
+        Returns:
+            Span: The context manager; it yields the histogram.
+        """
+        return Span(self.histogram(name, help_text, **labels))
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+
+        Histograms are followed by a summary of their recent observations
+        (<name>_recent{quantile="0.5"} and so on) for reading p50/p99 by eye.
+
+        Returns:
+            str: The metrics text.
+        """
+        with self._lock:
+            families = [(name, kind, help_text, list(metrics.items())) for name, (kind, help_text, metrics) in self._families.items()]
+
+        lines = []
+        for name, kind, help_text, metrics in sorted(families):
+            family_name = f"{name}_total" if kind == "counter" else name
+            if help_text:
+                lines.append(f"# HELP {family_name} {help_text}")
+            lines.append(f"# TYPE {family_name} {kind}")
+            for labels, metric in metrics:
+                lines.extend(metric.samples(name, labels))
+            if kind == "histogram":
+                lines.append(f"# TYPE {name}_recent summary")
+                for labels, metric in metrics:
+                    for q in QUANTILES:
+                        lines.append(f"{name}_recent{format_labels(labels, [('quantile', q)])} {format_value(metric.quantile(q))}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """Serves a registry as text on GET /metrics from a background thread."""
+
+    def __init__(self, registry, host="127.0.0.1", port=9108):
+        """
+        Args:
+            registry (MetricsRegistry): Metrics to serve.
+            host (str): Address to bind; 0.0.0.0 lets another host scrape it.
+            port (int): Port to listen on.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Start serving; returns False (and logs) if the port cannot be bound."""
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would flood the log
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logging.error(f"Metrics endpoint could not listen on {self.host}:{self.port}: {e}")
+            return False
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return True
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,176 @@
+import json
+import logging
+import time
+
+TOPIC_CACHE_SIZE = 4096  # Resolved topics remembered before the cache is reset
+LOG_INTERVAL = 60  # Seconds between repeated log lines with the same key
+
+
+def parse_float(payload):
+    """Parse a numeric payload straight from bytes."""
+    return float(payload)
+
+
+def parse_json(payload):
+    """Parse a JSON payload straight from bytes."""
+    return json.loads(payload)
+
+
+def parse_text(payload):
+    """Decode a payload as UTF-8 text."""
+    return payload.decode("utf-8")
+
+
+def parse_raw(payload):
+    """Pass the payload bytes through unchanged."""
+    return payload
+
+
+class RateLimitedLog:
+    """Logs a message at most once per interval per key and counts what was suppressed."""
+
+    def __init__(self, interval=LOG_INTERVAL):
+        """
+        Args:
+            interval (float): Minimum seconds between log lines with the same key.
+        """
+        self.interval = interval
+        self._last = {}  # key -> (time logged, suppressed count)
+
+    def log(self, level, key, message):
+        """
+        Log `message` unless a line with the same key was logged within the interval.
+
+        Args:
+            level (int): Logging level, e.g. logging.INFO.
+            key (str): Groups messages for rate limiting, e.g. the topic.
+            message (str or callable): The message, or a function building it (only called when logged).
+        """
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None and now - last[0] < self.interval:
+            self._last[key] = (last[0], last[1] + 1)
+            return
+        if callable(message):
+            message = message()
+        if last is not None and last[1]:
+            message = f"{message} ({last[1]} similar suppressed)"
+        self._last[key] = (now, 0)
+        logging.log(level, message)
+
+
+class TopicRouter:
+    """
+    Dispatches MQTT messages to handlers registered per topic filter.
+
+    Exact topics are looked up in a dict; filters with `+` and `#` wildcards live
+    in a trie that is walked only the first time a topic is seen, after which the
+    resolved handlers are cached by the raw topic bytes. Payloads are parsed from
+    bytes without decoding to text first, and per-message logging is rate limited
+    so the paho network thread keeps up with per-second topics.
+    """
+
+    def __init__(self, log_interval=LOG_INTERVAL):
+        """
+        Args:
+            log_interval (float): Seconds between repeated log lines per topic.
+        """
+        self._exact = {}  # topic -> [(handler, parse)]
+        self._trie = {}  # level -> child node; '+' and '#' are wildcard children; None holds routes
+        self._cache = {}  # raw topic -> tuple of (handler, parse)
+        self._filters = []
+        self.log = RateLimitedLog(log_interval)
+        self.message_count = 0
+        self.unmatched_count = 0
+        self.error_count = 0
+        self.last_message_time = None
+
+    def route(self, topic_filter, handler, parse=parse_float):
+        """
+        Register a handler for a topic filter.
+
+        Args:
+            topic_filter (str): Topic, optionally with MQTT `+`/`#` wildcards.
+            handler (callable): Called as handler(topic, value) for each matching message.
+            parse (callable): Turns the payload bytes into the value; ValueError rejects the message.
+        """
+        if topic_filter not in self._filters:
+            self._filters.append(topic_filter)
+        if "+" in topic_filter or "#" in topic_filter:
+            node = self._trie
+            for level in topic_filter.split("/"):
+                node = node.setdefault(level, {})
+            node.setdefault(None, []).append((handler, parse))
+        else:
+            self._exact.setdefault(topic_filter, []).append((handler, parse))
+        self._cache.clear()
+
+    def subscriptions(self):
+        """Return the topic filters to subscribe to, in registration order."""
+        return list(self._filters)
+
+    def on_message(self, client, userdata, msg):
+        """paho on_message callback."""
+        # paho keeps the topic as bytes and decodes it on every access of msg.topic
+        raw_topic = getattr(msg, "_topic", None) or msg.topic
+        self.dispatch(raw_topic, msg.payload)
+
+    def dispatch(self, topic, payload):
+        """
+        Parse a message and call its handlers.
+
+        Args:
+            topic (bytes or str): The message topic.
+            payload (bytes): The message payload.
+
+        Returns:
+            int: Number of handlers called.
+        """
+        self.message_count += 1
+        self.last_message_time = time.time()
+        routes = self._cache.get(topic)
+        if routes is None:
+            routes = self._resolve(topic)
+
+        if not routes:
+            self.unmatched_count += 1
+            return 0
+
+        text_topic = None
+        called = 0
+        for handler, parse in routes:
+            if text_topic is None:
+                text_topic = topic.decode("utf-8") if isinstance(topic, bytes) else topic
+            try:
+                value = parse(payload)
+            except ValueError:
+                self.error_count += 1
+                self.log.log(logging.WARNING, ("payload", text_topic), lambda: f"Invalid payload on topic {text_topic}: {payload[:64]!r}")
+                continue
+            try:
+                handler(text_topic, value)
+                called += 1
+            except Exception as e:
+                self.error_count += 1
+                self.log.log(logging.ERROR, ("handler", text_topic), lambda: f"Handler for topic {text_topic} failed: {e}")
+        return called
+
+    def _resolve(self, topic):
+        text_topic = topic.decode("utf-8") if isinstance(topic, bytes) else topic
+        routes = list(self._exact.get(text_topic, ()))
+        self._match(self._trie, text_topic.split("/"), 0, routes)
+        if len(self._cache) >= TOPIC_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[topic] = routes = tuple(routes)
+        return routes
+
+    def _match(self, node, levels, depth, routes):
+        if "#" in node:
+            routes.extend(node["#"].get(None, ()))
+        if depth == len(levels):
+            routes.extend(node.get(None, ()))
+            return
+        for key in (levels[depth], "+"):
+            child = node.get(key)
+            if child is not None:
+                self._match(child, levels, depth + 1, routes)
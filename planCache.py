@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+
+
+def config_key(config):
+    """
+    Return a stable hash of a planner configuration.
+
+    Args:
+        config (dict): JSON-serialisable settings the plan depends on; other values are hashed by repr().
+
+    Returns:
+        str: Hex digest identifying the configuration.
+    """
+    encoded = json.dumps(config, sort_keys=True, default=repr).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class PlanCache:
+    """
+    Memoises derived plans (water heater, charging, ...) until the prices or settings change.
+
+    Each plan is stored under a name together with the price version and the
+    configuration hash it was computed from. Asking for a plan with the same
+    version and configuration returns the stored plan; anything else recomputes it.
+    """
+
+    def __init__(self):
+        self._entries = {}  # name -> ((price version, config hash), plan)
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, name, version, config, compute, valid=None):
+        """
+        Return the cached plan, computing it if the price version or configuration changed.
+
+        Args:
+            name (str): Plan name, e.g. 'water_heater'.
+            version (int): Version of the prices the plan is derived from (PriceStore.version).
+            config (dict): Settings the plan depends on.
+            compute (callable): Builds the plan; called without arguments on a miss.
+            valid (callable, optional): Called with the cached plan; returning False forces a recompute
+                (e.g. when the current time has run past the end of the plan).
+
+        Returns:
+            The cached or newly computed plan.
+        """
+        key = (version, config_key(config))
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is not None and entry[0] == key and (valid is None or valid(entry[1])):
+            with self._lock:
+                self.hits[name] = self.hits.get(name, 0) + 1
+            return entry[1]
+
+        plan = compute()
+        with self._lock:
+            self._entries[name] = (key, plan)
+            self.misses[name] = self.misses.get(name, 0) + 1
+        return plan
+
+    def invalidate(self, name=None):
+        """
+        Drop a cached plan, or all of them.
+
+        Args:
+            name (str, optional): Plan to drop. Defaults to all plans.
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def stats(self):
+        """
+        Return hit and miss counters per plan.
+
+        Returns:
+            dict: name -> {'hits': int, 'misses': int}
+        """
+        with self._lock:
+            names = set(self.hits) | set(self.misses)
+            return {name: {"hits": self.hits.get(name, 0), "misses": self.misses.get(name, 0)} for name in sorted(names)}
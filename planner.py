@@ -0,0 +1,340 @@
+import heapq
+import math
+
+
+def slots_for_energy(kwh_required, charger_power_w, slot_minutes=60):
+    """
+    Number of price slots needed to deliver the required energy.
+
+    Args:
+        kwh_required (float): Energy to deliver in kWh.
+        charger_power_w (float): Charging power in watts.
+        slot_minutes (int): Length of a price slot in minutes (60 or 15).
+
+    Returns:
+        int: Number of slots, rounded up.
+    """
+    if kwh_required <= 0:
+        return 0
+    kwh_per_slot = charger_power_w / 1000.0 * slot_minutes / 60.0
+    return int(math.ceil(kwh_required / kwh_per_slot - 1e-9))
+
+
+def _available(prices, start, end):
+    # Missing prices (None/NaN) are treated as unavailable slots
+    return [i for i in range(start, end) if prices[i] is not None and not math.isnan(prices[i])]
+
+
+def cheapest_slots(prices, slots_needed, start=0, end=None):
+    """
+    Pick the cheapest slots before the deadline, in time order. O(n log k).
+
+    Args:
+        prices (sequence): Price per slot.
+        slots_needed (int): Number of slots to pick.
+        start (int): First slot that may be used (e.g. the current slot).
+        end (int, optional): Deadline; slots from `end` on are not used. Defaults to all slots.
+
+    Returns:
+        list: Indices of the chosen slots, ascending. Fewer than `slots_needed` if not enough slots exist.
+    """
+    end = len(prices) if end is None else min(end, len(prices))
+    candidates = _available(prices, start, end)
+    return sorted(heapq.nsmallest(slots_needed, candidates, key=lambda i: (prices[i], i)))
+
+
+def cheapest_window(prices, slots_needed, start=0, end=None):
+    """
+    Pick the cheapest contiguous block of slots before the deadline. O(n).
+
+    Args:
+        prices (sequence): Price per slot.
+        slots_needed (int): Length of the block.
+        start (int): First slot that may be used.
+        end (int, optional): Deadline; slots from `end` on are not used. Defaults to all slots.
+
+    Returns:
+        list: Indices of the chosen block, or an empty list if no complete block with known prices fits.
+    """
+    end = len(prices) if end is None else min(end, len(prices))
+    if slots_needed <= 0 or end - start < slots_needed:
+        return []
+
+    best_start, best_cost = None, math.inf
+    window_cost, valid_run = 0.0, 0
+    for i in range(start, end):
+        price = prices[i]
+        if price is None or math.isnan(price):
+            window_cost, valid_run = 0.0, 0
+            continue
+        window_cost += price
+        valid_run += 1
+        if valid_run > slots_needed:
+            window_cost -= prices[i - slots_needed]
+            valid_run = slots_needed
+        if valid_run == slots_needed and window_cost < best_cost:
+            best_start, best_cost = i - slots_needed + 1, window_cost
+
+    if best_start is None:
+        return []
+    return list(range(best_start, best_start + slots_needed))
+
+
+def cheapest_runs(prices, slots_needed, min_run, start=0, end=None):
+    """
+    Pick the cheapest slots where every charging run lasts at least `min_run` slots.
+
+    Dynamic programme over (slot, slots chosen, in-run) states, O(n * k).
+
+    Args:
+        prices (sequence): Price per slot.
+        slots_needed (int): Number of slots to pick.
+        min_run (int): Minimum number of consecutive slots per run.
+        start (int): First slot that may be used.
+        end (int, optional): Deadline; slots from `end` on are not used. Defaults to all slots.
+
+    Returns:
+        list: Indices of the chosen slots, ascending, or an empty list if no feasible plan exists.
+    """
+    end = len(prices) if end is None else min(end, len(prices))
+    if slots_needed <= 0 or end <= start:
+        return []
+    if min_run <= 1:
+        return cheapest_slots(prices, slots_needed, start, end)
+    if slots_needed <= min_run:
+        return cheapest_window(prices, slots_needed, start, end)
+
+    n = end - start
+    k = slots_needed
+    cost = [math.inf if prices[start + i] is None or math.isnan(prices[start + i]) else prices[start + i] for i in range(n)]
+    prefix, missing = [0.0], [0]
+    for c in cost:
+        prefix.append(prefix[-1] + (0.0 if c == math.inf else c))
+        missing.append(missing[-1] + (c == math.inf))
+
+    inf = math.inf
+    # free[i][c]: best cost with c slots chosen among the first i, slot i-1 not in a run
+    # run[i][c]: best cost with c slots chosen among the first i, slot i-1 ending a run of >= min_run
+    free = [[inf] * (k + 1) for _ in range(n + 1)]
+    run = [[inf] * (k + 1) for _ in range(n + 1)]
+    free[0][0] = 0.0
+    for i in range(n):
+        for c in range(k + 1):
+            best = min(free[i][c], run[i][c])
+            if best == inf:
+                continue
+            # Leave slot i idle
+            if best < free[i + 1][c]:
+                free[i + 1][c] = best
+            # Start a new run covering slots i .. i+min_run-1
+            if free[i][c] < inf and i + min_run <= n and c + min_run <= k and missing[i + min_run] == missing[i]:
+                block = prefix[i + min_run] - prefix[i]
+                if free[i][c] + block < run[i + min_run][c + min_run]:
+                    run[i + min_run][c + min_run] = free[i][c] + block
+            # Extend the current run by slot i
+            if run[i][c] < inf and c + 1 <= k and run[i][c] + cost[i] < run[i + 1][c + 1]:
+                run[i + 1][c + 1] = run[i][c] + cost[i]
+
+    if min(free[n][k], run[n][k]) == inf:
+        return []
+
+    # Walk back through the table to recover the chosen slots
+    chosen = []
+    i, c = n, k
+    in_run = run[n][k] <= free[n][k]
+    while i > 0:
+        if in_run:
+            if c >= 1 and run[i - 1][c - 1] < inf and abs(run[i - 1][c - 1] + cost[i - 1] - run[i][c]) < 1e-9:
+                chosen.append(i - 1)
+                i, c = i - 1, c - 1
+            else:
+                # Run started with a block of min_run slots
+                chosen.extend(range(i - 1, i - min_run - 1, -1))
+                i, c = i - min_run, c - min_run
+                in_run = False
+        else:
+            value = free[i][c]
+            in_run = run[i - 1][c] <= free[i - 1][c] and abs(run[i - 1][c] - value) < 1e-9
+            i -= 1
+    return sorted(start + j for j in chosen)
+
+
+def plan_charging_slots(prices, kwh_required, charger_power_w, start=0, deadline=None, slot_minutes=60, contiguous=False, min_run=1):
+    """
+    Plan the cheapest charging slots that deliver the required energy before a deadline.
+
+    Args:
+        prices (sequence): Price per slot, in time order.
+        kwh_required (float): Energy to deliver in kWh.
+        charger_power_w (float): Charging power in watts.
+        start (int): First slot that may be used (the current slot).
+        deadline (int, optional): Slot index the charging must be finished by.
+        slot_minutes (int): Length of a price slot in minutes (60 or 15).
+        contiguous (bool): Charge in one uninterrupted block.
+        min_run (int): Minimum number of consecutive slots per charging run.
+
+    Returns:
+        list: Indices of the chosen slots, ascending.
+    """
+    slots_needed = slots_for_energy(kwh_required, charger_power_w, slot_minutes)
+    if contiguous:
+        return cheapest_window(prices, slots_needed, start, deadline)
+    return cheapest_runs(prices, slots_needed, min_run, start, deadline)
+
+
+class WaterHeaterPlan:
+    """
+    Precomputed on/off plan for the water heater, one entry per hour.
+
+    Looking up the state for a given time is a single index calculation.
+    """
+
+    def __init__(self, start_epoch, states, cost, slot_seconds=3600):
+        """
+        Args:
+            start_epoch (float): UTC epoch seconds of the first slot.
+            states (list): True (on) or False (off) per slot.
+            cost (float): Objective value of the plan.
+            slot_seconds (int): Slot length in seconds.
+        """
+        self.start_epoch = start_epoch
+        self.states = states
+        self.cost = cost
+        self.slot_seconds = slot_seconds
+
+    @property
+    def end_epoch(self):
+        return self.start_epoch + len(self.states) * self.slot_seconds
+
+    def state_at(self, when):
+        """
+        Return the planned state at `when`.
+
+        Args:
+            when (datetime): A timezone-aware time.
+
+        Returns:
+            str: 'on' or 'off', or None if `when` is outside the plan.
+        """
+        index = int((when.timestamp() - self.start_epoch) // self.slot_seconds)
+        if not 0 <= index < len(self.states):
+            return None
+        return 'on' if self.states[index] else 'off'
+
+
+def plan_water_heater(
+    prices,
+    slot_hours,
+    min_on_hours=12,
+    max_off_hours=4,
+    evening_hours=range(16, 23),
+    evening_max_off=3,
+    evening_max_consecutive_off=1,
+    must_on_hours=(5, 6),
+    high_price_threshold=100,
+    initial_off_hours=0,
+    initial_on_hours=0,
+    initial_evening_off=0,
+    hours_before=0
+):
+    """
+    Compute the cheapest feasible on/off plan for the water heater with dynamic programming.
+
+    Every hour the heater is on costs `price - high_price_threshold`, so hours below
+    the threshold are used whenever possible and expensive hours are skipped as far
+    as the constraints allow. The state is (hours off in a row, hours on today,
+    evening hours off today); all three are bounded, so the run time is linear in
+    the number of hours.
+
+    Args:
+        prices (sequence): Hourly prices in time order; None/NaN counts as the threshold price.
+        slot_hours (sequence): (local day, local hour) for each price.
+        min_on_hours (int): Minimum hours on per day; scaled down for partial days.
+        max_off_hours (int): Maximum hours off in a row (maxContinuousOffHoursWaterHeater in PowerControl.js).
+        evening_hours (range): Local hours that count as evening.
+        evening_max_off (int): Maximum evening hours off per day.
+        evening_max_consecutive_off (int): Maximum evening hours off in a row.
+        must_on_hours (tuple): Local hours that are always on (hot water before 07:00).
+        high_price_threshold (float): Price above which running the heater is avoided.
+        initial_off_hours (int): Hours the heater has already been off when the plan starts.
+        initial_on_hours (int): Hours the heater was on earlier on the first day.
+        initial_evening_off (int): Evening hours the heater was off earlier on the first day.
+        hours_before (int): Hours of the first day before the plan whose state is known;
+            they count towards the first day's `min_on_hours` together with `initial_on_hours`.
+
+    Returns:
+        list: True (on) or False (off) per hour, or None if no plan satisfies the constraints.
+    """
+    n = len(prices)
+    if n == 0:
+        return []
+
+    hours_per_day = {}
+    for day, _ in slot_hours:
+        hours_per_day[day] = hours_per_day.get(day, 0) + 1
+    required = {day: min(count, int(math.ceil(min_on_hours * count / 24.0))) for day, count in hours_per_day.items()}
+    # The first day also counts the hours already behind it
+    first_day = slot_hours[0][0]
+    first_count = hours_per_day[first_day]
+    required[first_day] = min(first_count + initial_on_hours, int(math.ceil(min_on_hours * (first_count + hours_before) / 24.0)))
+
+    def cost_of(price):
+        if price is None or math.isnan(price):
+            return 0.0
+        return price - high_price_threshold
+
+    # layer[state] = (cost, previous state, on) with state = (off streak, on today, evening off today)
+    layers = []
+    initial_state = (
+        min(initial_off_hours, max_off_hours),
+        min(initial_on_hours, required[first_day]),
+        min(initial_evening_off, evening_max_off)
+    )
+    current = {initial_state: (0.0, None, None)}
+    for i in range(n):
+        day, hour = slot_hours[i]
+        new_day = i > 0 and day != slot_hours[i - 1][0]
+        need_prev = required[slot_hours[i - 1][0]] if new_day else 0
+        on_cap = required[day]
+        evening = hour in evening_hours
+        step_cost = cost_of(prices[i])
+
+        nxt = {}
+        for state, (cost, _, _) in current.items():
+            off_streak, on_today, evening_off = state
+            if new_day:
+                if on_today < need_prev:
+                    continue
+                on_today, evening_off = 0, 0
+
+            # Heater on
+            candidate = (0, min(on_today + 1, on_cap), evening_off)
+            total = cost + step_cost
+            if candidate not in nxt or total < nxt[candidate][0]:
+                nxt[candidate] = (total, state, True)
+
+            # Heater off
+            if hour in must_on_hours or off_streak + 1 > max_off_hours:
+                continue
+            if evening and (evening_off + 1 > evening_max_off or off_streak + 1 > evening_max_consecutive_off):
+                continue
+            candidate = (off_streak + 1, on_today, evening_off + (1 if evening else 0))
+            if candidate not in nxt or cost < nxt[candidate][0]:
+                nxt[candidate] = (cost, state, False)
+
+        layers.append(nxt)
+        current = nxt
+
+    last_need = required[slot_hours[-1][0]]
+    finals = [(value[0], state) for state, value in current.items() if state[1] >= last_need]
+    if not finals:
+        return None
+
+    _, state = min(finals)
+    states = []
+    for layer in reversed(layers):
+        _, previous, on = layer[state]
+        states.append(on)
+        state = previous
+    states.reverse()
+    return states
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import requests
 import time
 import logging
@@ -7,10 +8,22 @@ import paho.mqtt.client as mqtt
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import pytz
-import pandas as pd
-from entsoe import EntsoePandasClient
 import json
 import logging
+import math
+from amsReader import AmsClient
+from amperageScheduler import RATE_WINDOW_SECONDS, AmperageScheduler
+from rollingStats import RollingStats
+from sharedState import SharedState
+from timeSeries import TimeSeriesStore
+from capacityTariff import CapacityTariff
+from loadShedding import LoadShedder
+from metrics import MetricsRegistry, MetricsServer
+from mqttRouter import TopicRouter
+from planCache import PlanCache
+from planner import WaterHeaterPlan, plan_charging_slots, plan_water_heater
+from priceStore import NoPriceData, PriceStore, cache_path, fetch_day_ahead_prices, fill_missing, local_hour_start
+from zaptec import PHASE_CURRENT_STATES, STATE_SESSION_ENERGY, STATE_TOTAL_CHARGE_POWER, ZaptecConsumer, service_bus_configured
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
@@ -28,8 +41,12 @@ password = os.getenv('ZAPTEC_PASSWORD')
 ZAPTEC_AUTH_URL = "https://api.zaptec.com/oauth/token"
 ZAPTEC_API_URL = "https://api.zaptec.com/api/installation/{installation_id}/update"
 ZAPTEC_API_KEY = os.getenv("ZAPTEC_API_KEY")
+ZAPTEC_TOKEN_REFRESH_MARGIN = 300  # Refresh the Zaptec access token this many seconds before it expires
 CHARGER_ID = os.getenv("ZAPTEC_CHARGER_ID")
 ENTSOE_API_KEY = os.getenv("ENTSOE_API_KEY")
+BIDDING_ZONE = '10YNO-2--------T'
+PRICE_CACHE_FILE = cache_path(BIDDING_ZONE)
+DAY_AHEAD_PUBLISH_HOUR = 13  # Next-day prices are published shortly before 13:00 CET
 MQTT_BROKER = os.getenv("MQTT_BROKER", "192.168.86.54")
 MQTT_PORT = "1883"
 TOTAL_DEVICES = 6  # 5 floors + 1 water heater
@@ -38,27 +55,109 @@ WATER_HEATER_POWER_TOPIC = f"{WATER_HEATER_TOPIC}/power"
 WATER_HEATER_PRIORITY_THRESHOLD = 20 * 60  # 20 minutes in seconds
 FLOOR_TOPICS = [f"{MQTT_TOPIC}/floor_heating/floor_{i}" for i in range(1, 6)]  # Topics for 5 floors
 FLOOR_WATTAGE = [500, 500, 500, 500, 500]  # Estimated wattage for each floor
+FLOOR_PRIORITIES = [1, 1, 1, 1, 1]  # Shedding priority per floor; lower is shed first
+WATER_HEATER_WATTAGE = 2000  # Estimated water heater draw until it is measured
+WATER_HEATER_SHED_PRIORITY = 2  # The water heater is shed after the floors
+DEVICE_MIN_ON_SECONDS = 60  # A device must be on this long before it may be shed
+DEVICE_MIN_OFF_SECONDS = 300  # A shed device stays off at least this long
+SHED_HYSTERESIS = 500  # Watts kept free below MAX_TOTAL_LOAD before shed devices are switched back on
+CAPACITY_WITHIN_STEP = True  # Allow new monthly peaks that stay within the current capacity tariff step
 AMS_METER_API_BASE_URL = "http://192.168.86.34"
+AMS_SAMPLE_INTERVAL = float(os.getenv("AMS_SAMPLE_INTERVAL", "10"))  # Seconds between AMS polls (down to 1)
+ROLLING_WINDOW_SECONDS = 15 * 60  # Window for the rolling load statistics
+CONTROL_INTERVAL = 60  # Seconds between full control cycles; overloads are handled as readings arrive
+PRICE_REFRESH_HOUR = 14  # Local hour when next-day ENTSO-E prices are fetched
 MAX_TOTAL_LOAD = 10000  # Maximum household load in watts
 NOMINAL_VOLTAGE = 230  # Voltage in volts
 MIN_AMPERAGE = 6  # Minimum charging current in amperes
 MAX_AMPERAGE = 32  # Maximum charging current in amperes
 BATTERY_TARGET_KWH = 29  # 50% of a 58 kWh battery
 CAR_CHARGER_POWER = 3680  # 16A at 230V ~= 3.7 kW
+CHARGE_DEADLINE_HOUR = 9  # Car must be charged by this local hour (carChargeEndHour in PowerControl.js)
+CHARGE_CONTIGUOUS = False  # Charge in one uninterrupted block
+CHARGE_MIN_RUN_SLOTS = 1  # Minimum number of consecutive price slots per charging run
 LOCAL_TZ = pytz.timezone("Europe/Oslo")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # 0.0.0.0 lets Prometheus on another host scrape it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the metrics endpoint
+ZAPTEC_SAFETY_UPDATES = int(os.getenv("ZAPTEC_SAFETY_UPDATES", "0"))  # Opt-in updates beyond Zaptec's limit, for fuse overloads
 high_price_threshold = 100
+AMS_METER_TOPIC = "ams/meter/import/active"
+IMPACT_SETTLE_SECONDS = 2  # Ignore meter readings this soon after a device switches
+IMPACT_WINDOW_SECONDS = 15  # Stop attributing a step change to a switch after this long
+IMPACT_SMOOTHING = 0.3  # Weight of a new step-change observation in the impact estimate
+WATER_HEATER_MIN_ON_HOURS = 12  # Minimum hours on per day (dailyHeatingHours in PowerControl.js)
+WATER_HEATER_MAX_OFF_HOURS = 4  # Maximum hours off in a row (maxContinuousOffHoursWaterHeater in PowerControl.js)
+WATER_HEATER_EVENING_HOURS = range(16, 23)  # Evening hours with limited switching off
+WATER_HEATER_EVENING_MAX_OFF = 3  # Maximum evening hours off per day
+WATER_HEATER_EVENING_MAX_CONSECUTIVE_OFF = 1  # Maximum evening hours off in a row
+WATER_HEATER_MUST_ON_HOURS = (23, 0, 1, 2, 3, 4, 5, 6)  # Always on at night, so there is hot water by 07:00
 
 # Globals
-prices = {}
 cheapest_schedule = []
-last_zaptec_update = None
-water_heater_power = 0.0  # Initialize water heater power consumption
-last_consumption = 0.0  # Initialize last consumption
-LAST_ACTIVITY_TIME = time.time()
+plan_cache = PlanCache()  # Derived plans, recomputed only when prices or settings change
 water_heater_active_since = None
-water_heater_power = 0.0  # Initialize water_heater_power
-# Global variable to store rolling load values
-rolling_loads = []
+# Rolling load statistics over the last 15 minutes, sized for per-second readings from both MQTT and AMS polling
+rolling_loads = RollingStats(window_seconds=ROLLING_WINDOW_SECONDS, max_rate=2.0)
+meter_lock = threading.Lock()  # Serialises meter readings from the MQTT thread and the AMS poller
+# Values written by the MQTT thread and the AMS poller and read by the control loop.
+# Writers publish a new immutable snapshot; the control loop reads one snapshot per
+# cycle without locking, so it never sees half of a price update.
+shared_state = SharedState(
+    prices=PriceStore.load(PRICE_CACHE_FILE),  # ENTSO-E day-ahead prices (EUR/MWh); the planners read these
+    ams_prices=PriceStore(),  # Hourly prices per kWh from the AMS reader, kept for reference only
+    water_heater_power=0.0,
+    last_consumption=0.0,
+    last_activity=time.time(),
+    rolling=rolling_loads.summary(),
+    charger_power=None,  # W, from the Zaptec Service Bus
+    charger_current=None,  # A, highest phase current
+    session_energy=None,  # kWh charged in the current session
+)
+# Device impact estimation, fed from the AMS meter stream on the MQTT thread
+impact_lock = threading.Lock()
+device_impacts = {}  # topic -> estimated watts saved by switching the device off
+last_device_states = {}  # topic -> last state published ('on' or 'off')
+pending_transitions = {}  # topic -> (timestamp, state, meter reading before the switch)
+# Load shedding across all switchable devices
+load_shedder = LoadShedder(MAX_TOTAL_LOAD, hysteresis=SHED_HYSTERESIS, settle_seconds=IMPACT_WINDOW_SECONDS)
+for floor_topic, floor_watts, floor_priority in zip(FLOOR_TOPICS, FLOOR_WATTAGE, FLOOR_PRIORITIES):
+    load_shedder.add_device(floor_topic, floor_watts, floor_priority, DEVICE_MIN_ON_SECONDS, DEVICE_MIN_OFF_SECONDS)
+load_shedder.add_device(WATER_HEATER_TOPIC, WATER_HEATER_WATTAGE, WATER_HEATER_SHED_PRIORITY, DEVICE_MIN_ON_SECONDS, DEVICE_MIN_OFF_SECONDS)
+# Monthly capacity tariff (effekttrinn), integrated from the meter stream
+capacity_tariff = CapacityTariff(LOCAL_TZ, within_step=CAPACITY_WITHIN_STEP)
+# History of meter, device and charger data; per-second readings from both MQTT and AMS polling
+recorder = TimeSeriesStore(max_rate=2.0)
+# asyncio runtime, set while main() is running
+event_loop = None
+meter_event = None
+zaptec_task = None
+zaptec_timer = None
+# Charging current updates, coalesced and sent within the Zaptec rate limit
+zaptec_scheduler = AmperageScheduler(safety_updates=ZAPTEC_SAFETY_UPDATES)
+# Charger observations from the Zaptec Service Bus, when it is configured
+zaptec_consumer = ZaptecConsumer(charger_id=CHARGER_ID)
+# Stage timings and counters, served as text on METRICS_PORT; counts kept elsewhere are read on each scrape
+metrics = MetricsRegistry()
+metrics.counter_callback("zaptec_updates_requested", lambda: zaptec_scheduler.requested_count, "Charging current updates requested")
+metrics.counter_callback("zaptec_updates_dropped", lambda: zaptec_scheduler.coalesced_count, "Charging current requests replaced before they were sent")
+metrics.counter_callback("zaptec_updates_failed", lambda: zaptec_scheduler.failed_count, "Charging current updates the Zaptec API did not accept")
+metrics.counter_callback("zaptec_safety_updates", lambda: zaptec_scheduler.safety_count, "Overload reductions sent with a reserved update")
+metrics.counter_callback("zaptec_bus_messages", lambda: zaptec_consumer.received_count, "Messages received from the Zaptec Service Bus")
+metrics.counter_callback("mqtt_messages_received", lambda: router.message_count, "MQTT messages dispatched by the router")
+metrics.counter_callback("mqtt_messages_published", lambda: publisher.sent_count, "MQTT messages handed to the client")
+metrics.counter_callback("mqtt_messages_deduplicated", lambda: publisher.deduplicated_count, "MQTT messages dropped as repeats of the last value")
+metrics.gauge_callback("load_watts", lambda: shared_state.get("last_consumption"), "Last meter reading")
+for plan_name in ("charging", "water_heater"):
+    metrics.counter_callback("plan_cache_hits", lambda name=plan_name: plan_cache.hits.get(name, 0), "Plans served from the plan cache", plan=plan_name)
+    metrics.counter_callback("plan_cache_misses", lambda name=plan_name: plan_cache.misses.get(name, 0), "Plans recomputed", plan=plan_name)
+
+def stage_span(stage):
+    """Time a stage of the control loop into the stage_seconds histogram."""
+    return metrics.span("stage_seconds", "Time spent in each stage of the control loop", stage=stage)
+
+def tick_span(kind):
+    """Time a control cycle or an overload reaction into the tick_seconds histogram."""
+    return metrics.span("tick_seconds", "Latency of control cycles and of reactions to overloads", kind=kind)
 
 def track_water_heater_priority(water_heater_power):
     """
@@ -84,31 +183,23 @@ def track_water_heater_priority(water_heater_power):
         water_heater_active_since = None  # Reset tracking
 
     return False
-def update_rolling_loads(current_power, window_size=15):
+def update_rolling_loads(current_power, timestamp=None):
     """
-    Updates the rolling load values and calculates the average over the last 15 minutes.
+    Adds a power reading to the rolling load statistics and returns their summary.
+
+    Call with `meter_lock` held.
 
     Args:
         current_power (float): Current power usage in watts.
-        window_size (int): The number of minutes to consider for the rolling average (default: 15).
+        timestamp (float, optional): Time of the reading. Defaults to now.
 
     Returns:
-        float: The average power usage over the rolling window.
+        RollingSummary: Statistics over the rolling window.
     """
-    global rolling_loads
-
-    # Add the current power reading to the rolling loads list
-    rolling_loads.append(current_power)
-
-    # Ensure the list doesn't exceed the window size
-    if len(rolling_loads) > window_size:
-        rolling_loads.pop(0)
-
-    # Calculate the average power usage
-    average_load = sum(rolling_loads) / len(rolling_loads)
-
-    logging.info(f"Updated rolling load average: {average_load:.2f} Watts over the last {len(rolling_loads)} minutes.")
-    return average_load
+    rolling_loads.add(current_power, timestamp)
+    rolling = rolling_loads.summary()
+    logging.debug(f"Updated rolling load average: {rolling.mean:.2f} Watts over {rolling.count} samples.")
+    return rolling
 
 def make_api_request(
     url,
@@ -119,7 +210,8 @@ def make_api_request(
     max_retries=3,
     initial_delay=5,
     timeout=10,
-    use_json=True
+    use_json=True,
+    session=None
 ):
     """
     Make an API request with retry logic.
@@ -134,6 +226,7 @@ def make_api_request(
         initial_delay (int): Initial delay between retries in seconds. Default is 5.
         timeout (int): Request timeout in seconds. Default is 10.
         use_json (bool): Whether to send the payload as JSON or form-encoded. Default is True.
+        session (requests.Session): Optional session to reuse pooled connections. Default is None.
 
     Returns:
         dict: Parsed JSON response from the API.
@@ -142,11 +235,12 @@ def make_api_request(
         Exception: If all retries fail or the response status is not successful.
     """
     delay = initial_delay
+    http = session or requests
 
     for attempt in range(max_retries):
         try:
             if method.upper() == "GET":
-                response = requests.get(url, headers=headers, params=params, timeout=timeout)
+                response = http.get(url, headers=headers, params=params, timeout=timeout)
             elif method.upper() in ["POST", "PUT"]:
                 # Choose between JSON and form-encoded payload
                 request_args = {"headers": headers, "timeout": timeout}
@@ -155,11 +249,11 @@ def make_api_request(
                 else:
                     request_args["data"] = payload
                 if method.upper() == "POST":
-                    response = requests.post(url, **request_args)
+                    response = http.post(url, **request_args)
                 else:
-                    response = requests.put(url, **request_args)
+                    response = http.put(url, **request_args)
             elif method.upper() == "DELETE":
-                response = requests.delete(url, headers=headers, timeout=timeout)
+                response = http.delete(url, headers=headers, timeout=timeout)
             else:
                 raise ValueError(f"Unsupported HTTP method: {method}")
 
@@ -173,13 +267,16 @@ def make_api_request(
             logging.error(f"Request params: {params}, payload: {payload} ")
   
         # Wait before retrying
+        if attempt + 1 < max_retries:
+            metrics.counter("http_retries", "HTTP requests retried after an error").inc()
         time.sleep(delay)
         delay *= 2  # Exponential backoff
 
+    metrics.counter("http_failures", "HTTP requests that failed after all retries").inc()
     logging.error(f"All retries failed for API URL: {url}")
     raise Exception(f"Failed to complete {method} request to {url} after {max_retries} attempts.")
 ###ZAPTEC
-def get_access_token():
+def get_access_token(session=None):
     username = os.getenv("ZAPTEC_USER")
     password = os.getenv("ZAPTEC_PASSWORD")
 
@@ -196,14 +293,15 @@ def get_access_token():
         "Content-Type": "application/x-www-form-urlencoded"
     }
 
-    return make_api_request(ZAPTEC_AUTH_URL, method="POST", headers=headers, payload=payload, use_json=False)
+    return make_api_request(ZAPTEC_AUTH_URL, method="POST", headers=headers, payload=payload, use_json=False, session=session)
 
-def refresh_access_token(refresh_token):
+def refresh_access_token(refresh_token, session=None):
     """
     Refresh the access token using the refresh token.
 
     Args:
         refresh_token (str): The refresh token to use for getting a new access token.
+        session (requests.Session): Optional session to reuse pooled connections.
 
     Returns:
         dict: The new access and refresh tokens.
@@ -219,13 +317,14 @@ def refresh_access_token(refresh_token):
         "Content-Type": "application/x-www-form-urlencoded"
     }
 
-    return make_api_request(ZAPTEC_AUTH_URL, method="POST", headers=headers, payload=payload, use_json=False)
-def get_installations(access_token):
+    return make_api_request(ZAPTEC_AUTH_URL, method="POST", headers=headers, payload=payload, use_json=False, session=session)
+def get_installations(access_token, session=None):
     """
     Fetch the list of installations associated with the given access token.
 
     Args:
         access_token (str): The access token for API authentication.
+        session (requests.Session): Optional session to reuse pooled connections.
 
     Returns:
         dict: The JSON response containing the list of installations.
@@ -238,45 +337,145 @@ def get_installations(access_token):
         "Authorization": f"Bearer {access_token}"
     }
 
-    return make_api_request(url, method="GET", headers=headers)
+    return make_api_request(url, method="GET", headers=headers, session=session)
+
+
+class ZaptecSession:
+    """
+    Cached, auto-refreshing Zaptec API session.
+
+    The access token is kept until it expires and is renewed in the background with
+    the refresh token shortly before that. The installation id is looked up once,
+    and all calls share one pooled `requests.Session`, so a steady-state update is a
+    single HTTP request.
+    """
+
+    def __init__(self, refresh_margin=ZAPTEC_TOKEN_REFRESH_MARGIN, pool_size=4):
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("https://", adapter)
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._refresh_token = None
+        self._expires_at = 0.0
+        self._installation_id = None
+        self._refresh_timer = None
+
+    def access_token(self):
+        """
+        Return a valid access token, doing a password grant only if none is cached.
+
+        Returns:
+            str: The access token.
+        """
+        with self._lock:
+            if self._access_token is None or time.time() >= self._expires_at:
+                logging.info("Requesting new Zaptec access token.")
+                self._store_tokens(get_access_token(session=self.http))
+            return self._access_token
+
+    def installation_id(self):
+        """
+        Return the id of the first installation, fetching it only once.
+
+        Returns:
+            str: The installation id.
+
+        Raises:
+            Exception: If no installations are found.
+        """
+        if self._installation_id is None:
+            installations_response = get_installations(self.access_token(), session=self.http)
+            if 'Data' in installations_response and installations_response['Data']:
+                self._installation_id = installations_response['Data'][0].get('Id')
+                logging.info(f"Using Installation ID: {self._installation_id}")
+            else:
+                raise Exception("No installations found or unexpected response format.")
+        return self._installation_id
+
+    def request(self, method, url, timeout=10, **kwargs):
+        """
+        Make an authenticated request, re-authenticating once if the token was rejected.
+
+        Args:
+            method (str): HTTP method.
+            url (str): The API endpoint URL.
+            timeout (int): Request timeout in seconds.
+            **kwargs: Passed on to `requests.Session.request`.
+
+        Returns:
+            requests.Response: The response.
+        """
+        headers = kwargs.pop("headers", {})
+        for attempt in range(2):
+            headers["Authorization"] = f"Bearer {self.access_token()}"
+            response = self.http.request(method, url, headers=headers, timeout=timeout, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            logging.warning("Zaptec access token rejected; re-authenticating.")
+            self.invalidate()
+        return response
+
+    def invalidate(self):
+        """Forget the cached access token so the next call re-authenticates."""
+        with self._lock:
+            self._access_token = None
+
+    def close(self):
+        """Stop background refreshes and release pooled connections."""
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        self.http.close()
+
+    def _store_tokens(self, tokens):
+        # Caller holds the lock
+        self._access_token = tokens["access_token"]
+        self._refresh_token = tokens.get("refresh_token", self._refresh_token)
+        expires_in = float(tokens.get("expires_in", 3600))
+        self._expires_at = time.time() + expires_in
+        self._schedule_refresh(max(expires_in - self.refresh_margin, 30))
+
+    def _schedule_refresh(self, delay):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        if not self._refresh_token:
+            return
+        self._refresh_timer = threading.Timer(delay, self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        try:
+            tokens = refresh_access_token(self._refresh_token, session=self.http)
+            with self._lock:
+                self._store_tokens(tokens)
+            logging.info("Refreshed Zaptec access token.")
+        except Exception as e:
+            # The current token stays in use until it expires; then a password grant is made.
+            logging.warning(f"Failed to refresh Zaptec access token: {e}")
+
+
+zaptec_session = ZaptecSession()
 
 def set_charging_amperage(amperage):
     """
     Set the available charging current for the entire installation.
 
+    Rate limiting is left to `zaptec_scheduler`; call this through schedule_zaptec_update().
+
     Args:
         amperage (int): Desired charging current in amperes.
 
+    Returns:
+        bool: True once the update was accepted.
+
     Raises:
         Exception: If the API call fails after retries.
     """
-    global last_zaptec_update, installation_id
-    now = datetime.now()
-
-    # Check rate limiting: ensure at least 15 minutes between updates
-    if last_zaptec_update and (now - last_zaptec_update) < timedelta(minutes=15):
-        logging.info("Skipping Zaptec update to comply with rate limiting.")
-        return
-
-    # Fetch access token
-    tokens = get_access_token()
-    access_token = tokens["access_token"]
-
-    # Retrieve installation details
-    installations_response = get_installations(access_token)
-
-    # Ensure installations are available
-    if 'Data' in installations_response and installations_response['Data']:
-        first_installation = installations_response['Data'][0]
-        installation_id = first_installation.get('Id')
-        logging.info(f"Using Installation ID: {installation_id}")
-    else:
-        raise Exception("No installations found or unexpected response format.")
-
     # API endpoint for updating available current
-    url = ZAPTEC_API_URL.format(installation_id=installation_id)
+    url = ZAPTEC_API_URL.format(installation_id=zaptec_session.installation_id())
     headers = {
-        "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
 
@@ -290,9 +489,10 @@ def set_charging_amperage(amperage):
 
     # Make API request
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = zaptec_session.request("POST", url, json=payload, headers=headers)
         response.raise_for_status()
         logging.info(f"Installation available current set to {amperage}A successfully.")
+        recorder.append("zaptec_current", amperage)
     except requests.exceptions.HTTPError as http_err:
         logging.error(f"HTTP error occurred: {http_err}")
         logging.error(f"Response content: {http_err.response.text}")
@@ -300,9 +500,7 @@ def set_charging_amperage(amperage):
     except requests.exceptions.RequestException as req_err:
         logging.error(f"Request error occurred: {req_err}")
         raise
-
-    # Update the timestamp of the last successful update
-    last_zaptec_update = now
+    return True
 def publish_device_state(topic, state):
     """
     Publish the desired state of a device to MQTT with error handling.
@@ -316,7 +514,8 @@ def publish_device_state(topic, state):
     """
     try:
         if mqtt_publish(topic, state):
-            logging.info(f"Successfully published state '{state}' to topic '{topic}'.")
+            logging.info(f"Queued state '{state}' for topic '{topic}'.")
+            record_device_transition(topic, state)
             return True
         else:
             logging.error(f"Failed to publish state '{state}' to topic '{topic}'.")
@@ -397,83 +596,193 @@ def assess_device_impact_new(current_power, topics, mqtt_client=client, threshol
 
     return device_states, floor_watts
 
-def assess_device_impact(current_power, topics, threshold_load=None):
+def record_device_transition(topic, state, timestamp=None):
     """
-    Assess the power impact of turning off devices controlled by MQTT topics.
+    Remember that a device was switched so the next meter readings can be attributed to it.
+
+    Args:
+        topic (str): MQTT topic of the device.
+        state (str): State that was published ('on' or 'off').
+        timestamp (float, optional): Time of the switch. Defaults to now.
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    load_shedder.set_state(topic, state, timestamp)
+    with impact_lock:
+        previous_state = last_device_states.get(topic)
+        last_device_states[topic] = state
+        if previous_state == state:
+            return
+        recorder.append(f"device.{topic}", 1.0 if state == 'on' else 0.0, timestamp)
+        last_consumption = shared_state.get("last_consumption")
+        if last_consumption <= 0:
+            return
+        pending_transitions[topic] = (timestamp, state, last_consumption)
+
+
+def update_device_impacts(current_power, timestamp=None):
+    """
+    Estimate per-device impact from step changes in the live meter stream.
+
+    Called for every `ams/meter/import/active` reading. A reading taken between
+    IMPACT_SETTLE_SECONDS and IMPACT_WINDOW_SECONDS after a single device switched
+    is compared with the reading from just before the switch, and the difference is
+    folded into that device's impact estimate. Overlapping switches are ambiguous
+    and are discarded.
+
+    Args:
+        current_power (float): Current power usage in watts.
+        timestamp (float, optional): Time of the reading. Defaults to now.
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    with impact_lock:
+        if not pending_transitions:
+            return
+
+        settled = []
+        for topic, (switched_at, state, baseline) in list(pending_transitions.items()):
+            elapsed = timestamp - switched_at
+            if elapsed > IMPACT_WINDOW_SECONDS:
+                del pending_transitions[topic]
+            elif elapsed >= IMPACT_SETTLE_SECONDS:
+                settled.append((topic, state, baseline))
+
+        if len(pending_transitions) > 1:
+            if settled:
+                logging.debug(f"Overlapping device switches {list(pending_transitions)}; discarding step change.")
+                for topic, _, _ in settled:
+                    del pending_transitions[topic]
+            return
+
+        for topic, state, baseline in settled:
+            del pending_transitions[topic]
+            step = baseline - current_power if state == 'off' else current_power - baseline
+            if step <= 0:
+                logging.debug(f"No load step observed after switching {topic} {state}.")
+                continue
+            previous = device_impacts.get(topic)
+            if previous is None:
+                device_impacts[topic] = step
+            else:
+                device_impacts[topic] = previous + IMPACT_SMOOTHING * (step - previous)
+            load_shedder.update_watts(topic, device_impacts[topic])
+            logging.info(f"Estimated impact of {topic}: {device_impacts[topic]:.2f} Watts (step {step:.2f} Watts)")
+
+
+def effective_load_limit(current_power):
+    """
+    Return the load limit for now: MAX_TOTAL_LOAD, or lower if the hour is heading for a new capacity peak.
 
     Args:
         current_power (float): Current power usage in watts.
-        topics (list): List of MQTT topics to control devices.
-        threshold_load (float, optional): Threshold load to determine if devices should remain off.
 
     Returns:
-        dict: Mapping of topics to their desired state ('on' or 'off').
+        float: Load limit in watts.
     """
-    device_states = {}
-    for topic in topics:
-        # Turn off the device
-        publish_device_state(topic, 'off')
-        time.sleep(5)  # Wait for power reading to stabilize
-
-        # Measure the impact
-        new_power = get_current_power_usage()
-        if new_power is None:
-            logging.warning(f"Power usage could not be fetched for topic {topic}. Skipping...")
-            continue
+    capacity_limit = capacity_tariff.power_limit(current_power)
+    if capacity_limit is None:
+        return MAX_TOTAL_LOAD
+    return min(capacity_limit, MAX_TOTAL_LOAD)
 
-        # Log the impact
-        impact = current_power - new_power
-        logging.info(f"Impact of turning off {topic}: {impact:.2f} Watts")
+def shed_devices(current_power, restore=True):
+    """
+    Decide which devices to switch for the current load.
 
-        # Check against the threshold_load if provided
-        if threshold_load is not None and new_power < threshold_load:
-            logging.info(f"Threshold load reached. Turning {topic} back on.")
-            publish_device_state(topic, 'on')
-            device_states[topic] = 'on'
-        else:
-            device_states[topic] = 'off'
+    The measured wattage, priority and dwell times of every device live in
+    `load_shedder`; this only asks it for the changes needed now.
+
+    Args:
+        current_power (float): Current power usage in watts.
+        restore (bool): Also switch shed devices back on when there is room.
 
-    return device_states
+    Returns:
+        dict: Mapping of topics that should change to their new state ('on' or 'off').
+    """
+    changes = load_shedder.decide(current_power, restore=restore, limit=effective_load_limit(current_power))
+    for topic, state in changes.items():
+        logging.info(f"Load shedding: switching {topic} {state} at {current_power:.2f} Watts.")
+    return changes
 
 
 # MQTT Handlers
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logging.info("Connected to MQTT broker.")
-        topics = [
-            "ams/meter/import/active",
-            "home/water_heater/power"
-        ]
-        for topic in topics:
+        for topic in router.subscriptions():
             client.subscribe(topic)
             logging.info(f"Subscribed to topic: {topic}")
     else:
         logging.error(f"Connection failed with code {rc}")
 
+def on_price(topic, price):
+    """
+    Store a price published on ams/price/<hour>.
+
+    The AMS reader publishes hourly prices per kWh, so they are kept apart from the
+    ENTSO-E prices: the planners and thresholds work in EUR/MWh at the store's
+    resolution, and their plan caches would be invalidated by every message.
+    """
+    hour = topic.rsplit("/", 1)[-1]
+    start = local_hour_start(hour, LOCAL_TZ)
+    shared_state.modify("ams_prices", lambda store: store.set(start, price, duration=3600))
+    logging.info(f"Price for hour {hour}: {price:.2f} currency per kWh")
+
+def on_meter_message(topic, current_power):
+    """Handle a reading from the AMS meter topic."""
+    handle_meter_reading(current_power)
+    router.log.log(logging.INFO, topic, lambda: f"Current power consumption: {current_power:.2f} Watts")
+
+def on_water_heater_power(topic, power):
+    """Track the measured water heater power."""
+    shared_state.update(water_heater_power=power)
+    recorder.append("water_heater_power", power)
+    if power > 0:
+        load_shedder.update_watts(WATER_HEATER_TOPIC, power)
+    router.log.log(logging.INFO, topic, lambda: f"Water heater power consumption: {power:.2f} Watts")
+
+# Incoming MQTT topics; the router parses payloads from bytes and rate-limits per-message logging
+router = TopicRouter()
+router.route("ams/price/+", on_price)
+router.route(AMS_METER_TOPIC, on_meter_message)
+router.route("home/water_heater/power", on_water_heater_power)
+
 def on_message(client, userdata, msg):
-    global LAST_ACTIVITY_TIME, last_consumption, prices, water_heater_power
-    LAST_ACTIVITY_TIME = time.time()
-    try:
-        topic = msg.topic
-        payload = msg.payload.decode("utf-8")
-        try:
-            payload = float(payload)
-        except ValueError:
-            logging.warning(f"Non-numeric payload received on topic {topic}: {payload}")
-            return
+    shared_state.update(last_activity=time.time())
+    router.on_message(client, userdata, msg)
 
-        if topic.startswith("ams/price/"):
-            hour = topic.split("/")[-1]
-            prices[hour] = payload
-            logging.info(f"Price for hour {hour}: {payload:.2f} currency per kWh")
-        elif topic == "ams/meter/import/active":
-            last_consumption = payload
-            logging.info(f"Current power consumption: {payload:.2f} Watts")
-        elif topic == "home/water_heater/power":
-            water_heater_power = payload
-            logging.info(f"Water heater power consumption: {payload:.2f} Watts")
-    except Exception as e:
-        logging.warning(f"Unexpected error processing message on topic {msg.topic}: {e}")
+def handle_meter_reading(current_power, timestamp=None):
+    """
+    Process a meter reading from MQTT or the AMS poller and wake the control loop.
+
+    Args:
+        current_power (float): Current power usage in watts.
+        timestamp (float, optional): Time of the reading. Defaults to now.
+    """
+    with stage_span("impact_assessment"):
+        update_device_impacts(current_power, timestamp)
+    capacity_tariff.add(current_power, timestamp)
+    recorder.append("ams_power", current_power, timestamp)
+    with meter_lock:
+        rolling = update_rolling_loads(current_power, timestamp)
+        shared_state.update(last_consumption=current_power, rolling=rolling)
+    if event_loop is not None:
+        try:
+            event_loop.call_soon_threadsafe(meter_event.set)
+        except RuntimeError:
+            pass  # Loop is shutting down
+
+def on_charger_states(states):
+    """Publish a batch of charger observations from the Zaptec Service Bus to the shared state."""
+    changes = {}
+    if STATE_TOTAL_CHARGE_POWER in states:
+        changes["charger_power"] = states[STATE_TOTAL_CHARGE_POWER]
+        recorder.append("zaptec_power", changes["charger_power"])
+    phase_currents = [states[state_id] for state_id in PHASE_CURRENT_STATES if state_id in states]
+    if phase_currents:
+        changes["charger_current"] = max(phase_currents)
+    if STATE_SESSION_ENERGY in states:
+        changes["session_energy"] = states[STATE_SESSION_ENERGY]
+    if changes:
+        shared_state.update(**changes)
 
 def on_disconnect(client, userdata, rc):
     logging.warning(f"Disconnected with return code {rc}. Attempting to reconnect...")
@@ -497,60 +806,172 @@ def exponential_backoff_retry(func, max_retries=3, initial_delay=5):
     raise Exception("All retries failed.")
 
 # Fetch ENTSO-E Day-Ahead Prices
-def fetch_entsoe_prices():
-    global prices
+def query_entsoe_prices(start, end):
+    """
+    Query ENTSO-E day-ahead prices for a time range.
+
+    Args:
+        start (datetime): Start of the range (timezone-aware).
+        end (datetime): End of the range (timezone-aware, exclusive).
+
+    Returns:
+        list: (slot start, price) pairs.
+    """
+    try:
+        return fetch_day_ahead_prices(ENTSOE_API_KEY, BIDDING_ZONE, start, end)
+    except NoPriceData:
+        raise
+    except ValueError as e:
+        logging.warning(f"Could not parse ENTSO-E response ({e}); falling back to entsoe-py.")
+        return query_entsoe_prices_pandas(start, end)
+
+def query_entsoe_prices_pandas(start, end):
+    """
+    Query ENTSO-E day-ahead prices through entsoe-py.
+
+    pandas and entsoe-py are imported here, on demand, because importing them at
+    startup costs several seconds and tens of MB on the Raspberry Pi Zero.
+
+    Args:
+        start (datetime): Start of the range (timezone-aware).
+        end (datetime): End of the range (timezone-aware, exclusive).
+
+    Returns:
+        list: (slot start, price) pairs.
+    """
+    import pandas as pd
+    from entsoe import EntsoePandasClient
+
     client = EntsoePandasClient(api_key=ENTSOE_API_KEY)
-    bidding_zone = '10YNO-2--------T'
+    prices_series = client.query_day_ahead_prices(BIDDING_ZONE, start=pd.Timestamp(start), end=pd.Timestamp(end))
+    return [(ts.to_pydatetime(), float(price)) for ts, price in prices_series.items() if not pd.isna(price)]
+
+def fetch_entsoe_prices(now=None):
+    """
+    Make sure prices for today (and tomorrow, once published) are available.
+
+    The window is whole local days, matching the day-ahead auctions. Prices
+    already in the on-disk cache are not fetched again, so ENTSO-E is only
+    queried for missing slots; a day that is not published yet is left for the
+    next refresh. The fetch fills a private copy of the prices, which
+    is merged into the shared state afterwards, so the MQTT thread can keep
+    publishing prices while the request is in flight.
+
+    Args:
+        now (datetime, optional): Current time. Defaults to now.
+    """
+    fetched_prices = shared_state.get("prices").copy()
+    version = fetched_prices.version
     try:
-        now = datetime.now(pytz.utc)
-        start = pd.Timestamp(now.replace(hour=0, minute=0, second=0))
-        end = start + timedelta(days=2)  # Fetch for 36 hours
-        prices_series = client.query_day_ahead_prices(bidding_zone, start=start, end=end)
-        prices.clear()
-        for ts, price in prices_series.items():
-            hour = ts.tz_convert(LOCAL_TZ).hour
-            day = ts.tz_convert(LOCAL_TZ).day
-            prices[f"{day}-{hour}"] = float(price)
-        logging.info("Fetched ENTSO-E day-ahead prices successfully.")
+        now = now or datetime.now(LOCAL_TZ)
+        # Auctions cover local days; tomorrow's only exists once it has been published
+        days = 2 if now.astimezone(LOCAL_TZ).hour >= DAY_AHEAD_PUBLISH_HOUR else 1
+        start = local_hour_start(0, LOCAL_TZ, now)
+        end = local_hour_start(24 * days, LOCAL_TZ, now)
+        fill_missing(fetched_prices, query_entsoe_prices, start, end, cache_path=PRICE_CACHE_FILE)
     except Exception as e:
         logging.error(f"Error fetching ENTSO-E prices: {e}")
+    # Merge whatever arrived, also when a later range failed
+    if fetched_prices.version != version:
+        prices = shared_state.modify("prices", lambda store: store.update(fetched_prices.items())).prices
+        logging.info(f"Fetched ENTSO-E day-ahead prices successfully ({len(prices)} slots of {prices.resolution_minutes} min).")
 
 # Plan Cheapest Charging Schedule
-def plan_charging_schedule():
+def plan_charging_schedule(now=None, prices=None):
+    """
+    Plan the cheapest charging slots between now and the next CHARGE_DEADLINE_HOUR.
+
+    The plan is served from `plan_cache`, so calling this every cycle only
+    recomputes it when new prices arrive or the deadline moves to the next day.
+
+    Args:
+        now (datetime, optional): Current local time. Defaults to now.
+        prices (PriceStore, optional): Prices to plan with. Defaults to the current shared prices.
+
+    Returns:
+        list: (local slot start, price) for each chosen slot.
+    """
     global cheapest_schedule
-    kwh_required = BATTERY_TARGET_KWH
-    total_hours = int(kwh_required / (CAR_CHARGER_POWER / 1000))  # Estimate required hours
+    now = now or datetime.now(LOCAL_TZ)
+    prices = shared_state.get("prices") if prices is None else prices
+    deadline = now.replace(hour=CHARGE_DEADLINE_HOUR, minute=0, second=0, microsecond=0)
+    if deadline <= now:
+        deadline += timedelta(days=1)
+
+    config = {
+        "deadline": deadline.isoformat(),
+        "kwh": BATTERY_TARGET_KWH,
+        "power": CAR_CHARGER_POWER,
+        "contiguous": CHARGE_CONTIGUOUS,
+        "min_run": CHARGE_MIN_RUN_SLOTS,
+    }
+    cheapest_schedule = plan_cache.get("charging", prices.version, config, lambda: build_charging_schedule(prices, now, deadline))
+    return cheapest_schedule
+
+def build_charging_schedule(prices, now, deadline):
+    """
+    Compute the cheapest charging slots between `now` and `deadline`.
 
-    # Sort prices
-    sorted_prices = sorted(prices.items(), key=lambda x: x[1])
-    cheapest_schedule = sorted_prices[:total_hours]
-    logging.info(f"Planned charging schedule: {cheapest_schedule}")
+    Args:
+        prices (PriceStore): Price store.
+        now (datetime): Current local time.
+        deadline (datetime): Time the charging must be finished by.
+
+    Returns:
+        list: (local slot start, price) for each chosen slot.
+    """
+    if not prices:
+        logging.warning("No prices available; cannot plan charging schedule.")
+        return []
+
+    chosen = plan_charging_slots(
+        prices.values,
+        kwh_required=BATTERY_TARGET_KWH,
+        charger_power_w=CAR_CHARGER_POWER,
+        start=max(prices.slot_index(now), 0),
+        deadline=max(prices.slot_index(deadline), 0),
+        slot_minutes=prices.resolution_minutes,
+        contiguous=CHARGE_CONTIGUOUS,
+        min_run=CHARGE_MIN_RUN_SLOTS
+    )
+    schedule = [(prices.slot_start(i).astimezone(LOCAL_TZ), prices.values[i]) for i in chosen]
+    logging.info(
+        f"Planned charging schedule until {deadline:%d.%m %H:%M}: "
+        f"{[(f'{ts:%d.%m %H:%M}', price) for ts, price in schedule]}"
+    )
+    return schedule
 
 # Fetch Current Power Usage
   
-def get_current_power_usage(api_base_url=AMS_METER_API_BASE_URL, timeout=5, fallback=0.0):
+ams_client = AmsClient(AMS_METER_API_BASE_URL, sample_interval=AMS_SAMPLE_INTERVAL)
+
+def get_current_power_usage(fallback=0.0, max_age=None):
     """
-    Fetch the current power usage from the AMS Leser HTTP API.
+    Return the current power usage, reading the shared AMS sample buffer.
+
+    The AMS reader is only polled directly when the buffer has no sample younger
+    than `max_age` (default: one sample interval).
 
     Args:
-        api_base_url (str): Base URL of the AMS Leser API.
-        timeout (int): Request timeout in seconds.
-        fallback (float): Value to return if the request fails.
+        fallback (float): Value to return if no reading can be obtained.
+        max_age (float, optional): Maximum age in seconds of a buffered reading.
 
     Returns:
         float: Current power usage in watts or the fallback value.
     """
-    endpoint = f"{api_base_url}/data.json"
-    try:
-        response = requests.get(endpoint, timeout=timeout)
-        response.raise_for_status()
-        data = response.json()
-        current_power = float(data.get("w", fallback))
-        logging.info(f"Current power usage: {current_power:.2f} Watts")
+    max_age = ams_client.sample_interval if max_age is None else max_age
+    current_power = ams_client.latest(max_age=max_age)
+    if current_power is not None:
         return current_power
-    except requests.RequestException as e:
+    try:
+        current_power = ams_client.poll()
+    except (requests.RequestException, ValueError) as e:
         logging.error(f"Error fetching power usage: {e}")
         return fallback
+    if current_power is None:
+        return fallback
+    logging.info(f"Current power usage: {current_power:.2f} Watts")
+    return current_power
 
 # Calculate Desired Amperage
 def calculate_desired_amperage(current_power_usage, water_heater_power, max_total_load=MAX_TOTAL_LOAD, nominal_voltage=NOMINAL_VOLTAGE, min_amperage=MIN_AMPERAGE, max_amperage=MAX_AMPERAGE):
@@ -585,136 +1006,318 @@ def calculate_desired_amperage(current_power_usage, water_heater_power, max_tota
     else:
         return int(desired_amperage)
 
-def schedule_water_heater(prices, current_time, water_heater_state, high_price_threshold=100):
-    # Initialize variables
-    total_on_hours = 0
-    evening_off_hours = 0
-    consecutive_off_hours = 0
-    schedule = {}
-
-    # Define time periods
-    evening_start = 16
-    evening_end = 23
-    night_start = 23
-    night_end = 7
-    day_start = 7
-    day_end = 16
-
-    # Helper function to extract hour from 'day-hour' key
-    def extract_hour(key):
-        try:
-            return int(key.split('-')[1])
-        except (IndexError, ValueError):
-            return None
-
-    # Evening scheduling (16:00 - 23:00)
-    for key in prices:
-        hour = extract_hour(key)
-        if hour is not None and evening_start <= hour <= evening_end:
-            if prices[key] > high_price_threshold and evening_off_hours < 3 and consecutive_off_hours < 1:
-                schedule[hour] = 'off'
-                evening_off_hours += 1
-                consecutive_off_hours += 1
-            else:
-                schedule[hour] = 'on'
-                total_on_hours += 1
-                consecutive_off_hours = 0
-
-    # Night scheduling (23:00 - 07:00)
-    for key in prices:
-        hour = extract_hour(key)
-        if hour is not None and (hour >= night_start or hour < night_end):
-            schedule[hour] = 'on'
-            total_on_hours += 1
-
-    # Ensure 2 hours on before 07:00
-    if schedule.get(5) == 'off' and schedule.get(6) == 'off':
-        schedule[5] = 'on'
-        schedule[6] = 'on'
-        total_on_hours += 2
-
-    # Daytime scheduling (07:00 - 16:00)
-    for key in prices:
-        hour = extract_hour(key)
-        if hour is not None and day_start <= hour < day_end:
-            if prices[key] > high_price_threshold:
-                schedule[hour] = 'off'
-            else:
-                schedule[hour] = 'on'
-                total_on_hours += 1
+def hourly_prices(prices, start_epoch):
+    """
+    Average the price store into hourly prices from `start_epoch` to the last stored slot.
+
+    Args:
+        prices (PriceStore): Price store (hourly or 15-minute slots).
+        start_epoch (int): UTC epoch seconds of the first hour.
+
+    Returns:
+        tuple: (hourly prices with NaN for unknown hours, (local date, local hour) per hour).
+    """
+    if prices.start is None:
+        return [], []
+    per_hour = max(3600 // prices.resolution, 1)
+    first = int((start_epoch - prices.start) // prices.resolution)
+    last = len(prices.values)
+    if last <= first:
+        return [], []
+    _, values = prices.slice(first, last)
+
+    hourly, slot_hours = [], []
+    for offset in range(0, len(values), per_hour):
+        known = [value for value in values[offset:offset + per_hour] if not math.isnan(value)]
+        hourly.append(sum(known) / len(known) if known else math.nan)
+        local = datetime.fromtimestamp(start_epoch + offset // per_hour * 3600, LOCAL_TZ)
+        slot_hours.append((local.date(), local.hour))
+    return hourly, slot_hours
+
+def water_heater_history(current_time):
+    """
+    Summarise the recorded water heater state of the full hours before the current one.
 
-    # Ensure minimum 12 hours of operation
-    if total_on_hours < 12:
-        additional_hours_needed = 12 - total_on_hours
-        # Turn on during the cheapest off hours
-        off_hours = [hour for hour, state in schedule.items() if state == 'off']
-        off_hours.sort(key=lambda x: prices[f"{current_time.day}-{x}"])
-        for hour in off_hours[:additional_hours_needed]:
-            schedule[hour] = 'on'
-            total_on_hours += 1
+    Switches are recorded on the f"device.{WATER_HEATER_TOPIC}" series. An hour
+    counts as on if the heater was on for at least half of the part of it with a
+    known state, and as unknown if less than half of it is known; unknown hours
+    end an off streak and count towards nothing.
 
-    # Determine the desired state for the current hour
-    current_hour = current_time.hour
-    desired_state = schedule.get(current_hour, water_heater_state)
-    print(desired_state)
-    return desired_state
+    Args:
+        current_time (datetime): Current local time.
 
-def mqtt_publish(topic, message, broker=MQTT_BROKER, port=1883, username=None, password=None):
+    Returns:
+        tuple: (hours off in a row up to now, hours on today, evening hours off today, known hours today).
     """
-    Publishes a message to an MQTT topic with error handling.
+    hour_start = int(current_time.timestamp()) // 3600 * 3600
+    midnight = int(current_time.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    first = min(midnight, hour_start - WATER_HEATER_MAX_OFF_HOURS * 3600)
+    # Look back a day further for the state in effect at the start
+    samples = recorder.range(f"device.{WATER_HEATER_TOPIC}", first - 86400, hour_start)
+
+    state = None
+    index = 0
+    while index < len(samples) and samples[index][0] <= first:
+        state = samples[index][1] > 0.5
+        index += 1
+
+    hours = []  # (hour start, True/False/None)
+    for start in range(first, hour_start, 3600):
+        end = start + 3600
+        position = start
+        known = on_seconds = 0.0
+        while True:
+            switch = samples[index][0] if index < len(samples) and samples[index][0] < end else end
+            if state is not None:
+                known += switch - position
+                if state:
+                    on_seconds += switch - position
+            if switch >= end:
+                break
+            position = switch
+            state = samples[index][1] > 0.5
+            index += 1
+        hours.append((start, on_seconds * 2 >= known if known >= 1800 else None))
+
+    off_streak = 0
+    for _, on in reversed(hours):
+        if on is not False:
+            break
+        off_streak += 1
+    today = [(start, on) for start, on in hours if start >= midnight]
+    on_today = sum(1 for _, on in today if on)
+    evening_off = sum(
+        1 for start, on in today
+        if on is False and datetime.fromtimestamp(start, LOCAL_TZ).hour in WATER_HEATER_EVENING_HOURS
+    )
+    known_today = sum(1 for _, on in today if on is not None)
+    return off_streak, on_today, evening_off, known_today
+
+def build_water_heater_plan(prices, current_time, high_price_threshold=100):
+    """
+    Plan the water heater from the current hour to the end of the known prices.
 
     Args:
-        topic (str): The MQTT topic to publish to.
-        message (str): The message payload.
-        broker (str): MQTT broker address.
-        port (int): MQTT broker port (default: 1883).
-        username (str): Optional MQTT username.
-        password (str): Optional MQTT password.
+        prices (PriceStore): Price store.
+        current_time (datetime): Current local time.
+        high_price_threshold (float): Price above which the heater is switched off where allowed.
 
     Returns:
-        bool: True if the message was published successfully, False otherwise.
+        WaterHeaterPlan: The plan, or None if there are no prices or no feasible plan.
     """
+    start_epoch = int(current_time.timestamp()) // 3600 * 3600
+    hourly, slot_hours = hourly_prices(prices, start_epoch)
+    if not hourly:
+        return None
+    # Continue from what the heater actually did, so limits hold across re-plans
+    off_streak, on_today, evening_off, known_today = water_heater_history(current_time)
+    states = plan_water_heater(
+        hourly,
+        slot_hours,
+        min_on_hours=WATER_HEATER_MIN_ON_HOURS,
+        max_off_hours=WATER_HEATER_MAX_OFF_HOURS,
+        evening_hours=WATER_HEATER_EVENING_HOURS,
+        evening_max_off=WATER_HEATER_EVENING_MAX_OFF,
+        evening_max_consecutive_off=WATER_HEATER_EVENING_MAX_CONSECUTIVE_OFF,
+        must_on_hours=WATER_HEATER_MUST_ON_HOURS,
+        high_price_threshold=high_price_threshold,
+        initial_off_hours=off_streak,
+        initial_on_hours=on_today,
+        initial_evening_off=evening_off,
+        hours_before=known_today
+    )
+    if states is None:
+        logging.warning("No water heater plan satisfies the constraints.")
+        return None
+    cost = sum(price for price, on in zip(hourly, states) if on and not math.isnan(price))
+    on_hours = sum(states)
+    logging.info(f"Planned water heater: {on_hours} of {len(states)} hours on, cost {cost:.2f}.")
+    return WaterHeaterPlan(start_epoch, states, cost)
+
+def water_heater_config(high_price_threshold):
+    """Return the settings the water heater plan depends on, for the plan cache key."""
+    return {
+        "threshold": high_price_threshold,
+        "min_on": WATER_HEATER_MIN_ON_HOURS,
+        "max_off": WATER_HEATER_MAX_OFF_HOURS,
+        "evening": [WATER_HEATER_EVENING_HOURS.start, WATER_HEATER_EVENING_HOURS.stop],
+        "evening_max_off": WATER_HEATER_EVENING_MAX_OFF,
+        "evening_max_consecutive_off": WATER_HEATER_EVENING_MAX_CONSECUTIVE_OFF,
+        "must_on": list(WATER_HEATER_MUST_ON_HOURS),
+    }
 
-    # Optional authentication
-    if username and password:
-        client.username_pw_set(username, password)
+def water_heater_plan(prices, current_time, high_price_threshold=100):
+    """
+    Return the water heater plan covering the current hour.
 
-    try:
-        client.connect(broker, port)
-        result, mid = client.publish(topic, message)
+    The plan is served from `plan_cache` and rebuilt only when the prices or the
+    water heater settings change, or the current time runs past its end.
 
-        if result == mqtt.MQTT_ERR_SUCCESS:
-            logging.info(f"Message '{message}' published to topic '{topic}' successfully.")
+    Args:
+        prices (PriceStore): Price store.
+        current_time (datetime): Current local time.
+        high_price_threshold (float): Price above which the heater is switched off where allowed.
+
+    Returns:
+        WaterHeaterPlan: The plan, or None if there is none.
+    """
+    return plan_cache.get(
+        "water_heater",
+        prices.version,
+        water_heater_config(high_price_threshold),
+        lambda: build_water_heater_plan(prices, current_time, high_price_threshold),
+        valid=lambda plan: plan is not None and plan.state_at(current_time) is not None
+    )
+
+def schedule_water_heater(prices, current_time, water_heater_state, high_price_threshold=100):
+    """
+    Return the planned water heater state for the current hour.
+
+    Args:
+        prices (PriceStore): Price store.
+        current_time (datetime): Current local time.
+        water_heater_state (str): State to use when no plan covers the current hour.
+        high_price_threshold (float): Price above which the heater is switched off where allowed.
+
+    Returns:
+        str: 'on' or 'off'.
+    """
+    plan = water_heater_plan(prices, current_time, high_price_threshold)
+    desired_state = plan.state_at(current_time) if plan else None
+    return desired_state or water_heater_state
+
+class MqttPublisher:
+    """
+    Long-lived publisher that batches outgoing messages over the shared MQTT client.
+
+    Messages are queued per topic (the latest value wins), values identical to the
+    last one sent are dropped, and the queue is flushed once per control cycle.
+    Published message ids are tracked until the broker acknowledges them; messages
+    that are not acknowledged within `ack_timeout` seconds are queued again.
+    """
+
+    def __init__(self, mqtt_client, qos=1, ack_timeout=30):
+        self.client = mqtt_client
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+        self._lock = threading.Lock()
+        self._pending = {}  # topic -> message waiting for the next flush
+        self._last_sent = {}  # topic -> last message handed to the client
+        self._inflight = {}  # mid -> (topic, message, sent_at)
+        self.sent_count = 0
+        self.acked_count = 0
+        self.deduplicated_count = 0
+        mqtt_client.on_publish = self.on_publish
+
+    def queue(self, topic, message):
+        """
+        Queue a message for the next flush unless it repeats the last value sent.
+
+        Args:
+            topic (str): The MQTT topic to publish to.
+            message (str): The message payload.
+
+        Returns:
+            bool: True if the message was queued, False if it was a duplicate.
+        """
+        with self._lock:
+            if self._last_sent.get(topic) == message:
+                # Also cancels a different value queued earlier in this cycle
+                self._pending.pop(topic, None)
+                self.deduplicated_count += 1
+                return False
+            self._pending[topic] = message
             return True
+
+    def flush(self):
+        """
+        Publish all queued messages in one batch.
+
+        Returns:
+            int: Number of messages handed to the client.
+        """
+        with self._lock:
+            self._requeue_expired()
+            if not self._pending:
+                return 0
+            if not self.client.is_connected():
+                logging.warning(f"MQTT client not connected; keeping {len(self._pending)} queued message(s).")
+                return 0
+
+            batch, self._pending = self._pending, {}
+            sent = 0
+            for topic, message in batch.items():
+                result, mid = self.client.publish(topic, message, qos=self.qos)
+                if result == mqtt.MQTT_ERR_SUCCESS:
+                    self._inflight[mid] = (topic, message, time.time())
+                    self._last_sent[topic] = message
+                    sent += 1
+                else:
+                    logging.error(f"Failed to publish message '{message}' to topic '{topic}'. Return code: {result}")
+                    self._pending.setdefault(topic, message)
+
+            self.sent_count += sent
+            logging.info(f"Flushed {sent} MQTT message(s), {len(self._inflight)} awaiting acknowledgement.")
+            return sent
+
+    def on_publish(self, client, userdata, mid):
+        """Paho callback: the broker acknowledged message `mid`."""
+        with self._lock:
+            if self._inflight.pop(mid, None) is not None:
+                self.acked_count += 1
+
+    def _requeue_expired(self):
+        # Caller holds the lock
+        now = time.time()
+        for mid, (topic, message, sent_at) in list(self._inflight.items()):
+            if now - sent_at > self.ack_timeout:
+                del self._inflight[mid]
+                self._last_sent.pop(topic, None)
+                self._pending.setdefault(topic, message)
+                logging.warning(f"No acknowledgement for '{message}' on topic '{topic}'; queued again.")
+
+
+publisher = MqttPublisher(client)
+
+
+def mqtt_publish(topic, message):
+    """
+    Queue a message on the shared publisher; it is sent on the next `publisher.flush()`.
+
+    Args:
+        topic (str): The MQTT topic to publish to.
+        message (str): The message payload.
+
+    Returns:
+        bool: True if the message was queued or is already the last value sent, False otherwise.
+    """
+    try:
+        if publisher.queue(topic, message):
+            logging.info(f"Message '{message}' queued for topic '{topic}'.")
         else:
-            logging.error(f"Failed to publish message '{message}' to topic '{topic}'. Return code: {result}")
-            return False
+            logging.debug(f"Message '{message}' unchanged for topic '{topic}'; not queued.")
+        return True
     except Exception as e:
-        logging.error(f"Failed to publish message '{message}' to topic '{topic}': {e}")
+        logging.error(f"Failed to queue message '{message}' for topic '{topic}': {e}")
         return False
-    finally:
-        client.disconnect()
 
 # Control Water Heater via MQTT
 def control_water_heater(state):
     print(state)
     if mqtt_publish(WATER_HEATER_TOPIC, state):
+        record_device_transition(WATER_HEATER_TOPIC, state)
         logging.info(f"Successfully set water heater state to {state}.")
     else:
         logging.error(f"Failed to set water heater state to {state}.")
 def charger_settings():
     # Define the API URL for retrieving chargers
     api_url = 'https://api.zaptec.com/api/chargers'
-    tokens = get_access_token()
-    access_token = tokens["access_token"]
-    # Set the headers, including the Authorization header with the bearer token
     headers = {
-        'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
 
     # Make the GET request to retrieve charger information
-    response = requests.get(api_url, headers=headers)
+    response = zaptec_session.request("GET", api_url, headers=headers)
     response.raise_for_status()  # Raise an error for bad status codes
 
     # Parse the JSON response to extract charger data
@@ -735,19 +1338,13 @@ def get_messaging_connection_details(installation_id):
     # Define the API URL for retrieving messaging connection details
     api_url = f'https://api.zaptec.com/api/installation/{installation_id}/messagingConnectionDetails'
     
-    # Retrieve the access token
-    tokens = get_access_token()
-    access_token = tokens["access_token"]
-    
-    # Set the headers, including the Authorization header with the bearer token
     headers = {
-        'Authorization': f'Bearer {access_token}',
         'Accept': 'application/json'
     }
     
     try:
         # Make the GET request to retrieve messaging connection details
-        response = requests.get(api_url, headers=headers)
+        response = zaptec_session.request("GET", api_url, headers=headers)
         response.raise_for_status()  # Raise an error for bad status codes
         
         # Parse the JSON response to extract connection details
@@ -775,19 +1372,13 @@ def get_user_group_messaging_connection_details(user_group_id):
     # Define the API URL for retrieving messaging connection details
     api_url = f'https://api.zaptec.com/api/userGroups/{user_group_id}/messagingConnectionDetails'
     
-    # Retrieve the access token
-    tokens = get_access_token()
-    access_token = tokens["access_token"]
-    
-    # Set the headers, including the Authorization header with the bearer token
     headers = {
-        'Authorization': f'Bearer {access_token}',
         'Accept': 'application/json'
     }
     
     try:
         # Make the GET request to retrieve messaging connection details
-        response = requests.get(api_url, headers=headers)
+        response = zaptec_session.request("GET", api_url, headers=headers)
         response.raise_for_status()  # Raise an error for bad status codes
         
         # Parse the JSON response to extract connection details
@@ -830,7 +1421,7 @@ def manage_car_charging(current_time, current_house_load, current_price, high_pr
     logging.info(f"Setting charging to {desired_amperage}A based on available power and price.")
     return desired_amperage
 
-def adjust_charging_for_water_heater(average_load, threshold_load, current_power, water_heater_power, nominal_voltage=230, min_amperage=6, max_amperage=32):
+def adjust_charging_for_water_heater(average_load, threshold_load, current_power, water_heater_power, nominal_voltage=230, min_amperage=6, max_amperage=32, capacity_limit=None):
     """
     Adjusts the charging amperage for the EV charger based on average load, water heater power,
     and the total threshold load.
@@ -843,6 +1434,7 @@ def adjust_charging_for_water_heater(average_load, threshold_load, current_power
         nominal_voltage (int): Nominal voltage in volts (default: 230).
         min_amperage (int): Minimum allowable charging current in amperes (default: 6).
         max_amperage (int): Maximum allowable charging current in amperes (default: 32).
+        capacity_limit (float, optional): Load limit for the rest of the hour when it is projected to set a new capacity-tariff peak.
 
     Returns:
         int: Desired charging amperage within the allowable range.
@@ -850,6 +1442,11 @@ def adjust_charging_for_water_heater(average_load, threshold_load, current_power
     # Calculate available capacity by subtracting average load and water heater power from the threshold
     available_capacity = threshold_load - average_load
 
+    # Throttle only when the hour is heading for a new capacity peak
+    if capacity_limit is not None and capacity_limit - current_power < available_capacity:
+        logging.info(f"Capacity tariff limits charging: {capacity_limit:.0f} W for the rest of the hour.")
+        available_capacity = capacity_limit - current_power
+
     # Include water heater power only if it's currently active
     #if water_heater_power > 0:
     #    logging.info(f"Including water heater power in calculation: {water_heater_power} W")
@@ -868,7 +1465,7 @@ def adjust_charging_for_water_heater(average_load, threshold_load, current_power
 
     logging.info(f"Calculated charging amperage: {int(desired_amperage)}A")
     return int(desired_amperage)
-def setup_mqtt_client(broker, port=1883, keepalive=60, username=None, password=None):
+def setup_mqtt_client(broker, port=1883, keepalive=60, username=None, password=None, topics=None, message_handler=None):
     """
     Sets up and connects an MQTT client with error handling and optional authentication,
     using MQTT version 3.1.1 for compatibility.
@@ -879,6 +1476,8 @@ def setup_mqtt_client(broker, port=1883, keepalive=60, username=None, password=N
         keepalive (int): Keepalive interval in seconds (default: 60).
         username (str): Optional MQTT username.
         password (str): Optional MQTT password.
+        topics (list): Optional topics to subscribe to on every (re)connect.
+        message_handler (callable): Optional on_message callback for the subscribed topics.
 
     Returns:
         mqtt.Client: Configured and connected MQTT client.
@@ -886,6 +1485,9 @@ def setup_mqtt_client(broker, port=1883, keepalive=60, username=None, password=N
     def on_connect(client, userdata, flags, rc):
         if rc == 0:
             logging.info("Connected to MQTT broker successfully.")
+            for topic in topics or []:
+                client.subscribe(topic)
+                logging.info(f"Subscribed to topic: {topic}")
         else:
             logging.error(f"Failed to connect to MQTT broker. Return code: {rc}")
 
@@ -900,14 +1502,16 @@ def setup_mqtt_client(broker, port=1883, keepalive=60, username=None, password=N
     def reconnect_mqtt_client(client):
         try:
             client.reconnect()
+            metrics.counter("mqtt_reconnects", "MQTT reconnect attempts", result="ok").inc()
             logging.info("Reconnected to MQTT broker.")
         except Exception as e:
+            metrics.counter("mqtt_reconnects", "MQTT reconnect attempts", result="failed").inc()
             logging.error(f"Reconnection failed: {e}")
             time.sleep(5)  # Retry after a delay
 
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
-    client.on_message = on_message
+    client.on_message = message_handler or on_message
 
     # Optional authentication
     if username and password:
@@ -995,77 +1599,311 @@ def setup_mqtt_client___(broker, port=1883, keepalive=60, username=None, passwor
     client.loop_start()
     return client
 
-# Main Function
+# Control loop
+
+async def run_blocking(func, *args):
+    """
+    Run a blocking call (HTTP, sleeps) in a worker thread so the control loop stays responsive.
+
+    Args:
+        func (callable): The blocking function.
+        *args: Arguments for `func`.
+
+    Returns:
+        The result of `func`, or None if it raised.
+    """
+    try:
+        return await asyncio.to_thread(func, *args)
+    except Exception as e:
+        logging.error(f"{func.__name__} failed: {e}")
+        return None
+
+def schedule_zaptec_update(amperage, urgent=False):
+    """
+    Request a charging current; it is sent as soon as the Zaptec rate limit allows.
+
+    Requests made while an update is in flight or the rate limit is exhausted are
+    coalesced, so only the latest one is sent. If ZAPTEC_SAFETY_UPDATES is set,
+    an urgent reduction may use one of those extra updates instead of waiting.
+
+    Args:
+        amperage (int): Desired charging current in amperes.
+        urgent (bool): The load is over MAX_TOTAL_LOAD, not just the capacity-tariff target.
+    """
+    zaptec_scheduler.request(amperage, urgent)
+    dispatch_zaptec_update()
+
+def dispatch_zaptec_update():
+    """Send the pending charging current now if allowed, otherwise wake up when the rate limit opens."""
+    global zaptec_task, zaptec_timer
+    if zaptec_task is not None and not zaptec_task.done():
+        return  # Dispatched again when the update in flight completes
+    if zaptec_timer is not None:
+        zaptec_timer.cancel()
+        zaptec_timer = None
+
+    amperage = zaptec_scheduler.next_command()
+    if amperage is not None:
+        zaptec_task = asyncio.create_task(send_zaptec_update(amperage))
+        zaptec_task.add_done_callback(on_zaptec_update_done)
+        return
+
+    wait = zaptec_scheduler.seconds_until_allowed()
+    if wait is not None:
+        logging.debug(f"Charging current {zaptec_scheduler.pending}A waits {wait:.0f} s for the Zaptec rate limit.")
+        zaptec_timer = asyncio.get_running_loop().call_later(wait, dispatch_zaptec_update)
+
+async def send_zaptec_update(amperage):
+    """Send one charging current update and report the outcome to the scheduler."""
+    with stage_span("zaptec_request"):
+        success = bool(await run_blocking(set_charging_amperage, amperage))
+    zaptec_scheduler.sent(amperage, success)
+    return success
+
+def on_zaptec_update_done(task):
+    # Send whatever was requested meanwhile; after a failure wait for the next control cycle
+    if not task.cancelled() and task.result() and zaptec_scheduler.pending is not None:
+        dispatch_zaptec_update()
+
+def predict_window_load(snapshot, current_time, window_seconds=RATE_WINDOW_SECONDS):
+    """
+    Predict the household load over the next charging-current rate-limit window.
+
+    Only one increase can be sent per window, so it is sized for the load the
+    window is expected to carry rather than the last reading: the larger of the
+    rolling mean and the EWMA (which follows recent changes faster), corrected
+    for the water heater switching on or off according to its plan.
+
+    Args:
+        snapshot (Snapshot): Shared state for this cycle.
+        current_time (datetime): Current local time.
+        window_seconds (float): Length of the window.
+
+    Returns:
+        float: Predicted load in watts, or None without meter readings.
+    """
+    rolling = snapshot.rolling
+    if not rolling.count:
+        return None
+    load = max(rolling.mean, rolling.ewma)
+
+    plan = water_heater_plan(snapshot.prices, current_time)
+    if plan is not None:
+        states = {plan.state_at(current_time), plan.state_at(current_time + timedelta(seconds=window_seconds))}
+        if 'on' in states and snapshot.water_heater_power <= 0:
+            load += WATER_HEATER_WATTAGE
+        elif 'on' not in states and snapshot.water_heater_power > 0:
+            load -= snapshot.water_heater_power
+    return load
+
+def react_to_overload(snapshot):
+    """
+    Shed devices and lower the charging current as soon as a reading exceeds the limit.
+
+    Only 'off' states are sent here; devices are switched back on by the regular control cycle.
+
+    Args:
+        snapshot (Snapshot): Shared state holding the reading that exceeded the limit.
+    """
+    current_power = snapshot.last_consumption
+    limit = effective_load_limit(current_power)
+    if limit < MAX_TOTAL_LOAD:
+        logging.warning(
+            f"Hour projected at {capacity_tariff.predict_hour_energy(current_power):.2f} kWh "
+            f"(allowed {capacity_tariff.allowed_hour_energy():.2f} kWh); shedding devices above {limit:.0f} W."
+        )
+    else:
+        logging.warning(f"Load {current_power:.2f} W exceeds {MAX_TOTAL_LOAD} W; shedding devices.")
+    for topic, state in shed_devices(current_power, restore=False).items():
+        publish_device_state(topic, state)
+    publisher.flush()
+
+    desired_amperage = adjust_charging_for_water_heater(
+        average_load=max(snapshot.rolling.mean or current_power, current_power),
+        threshold_load=MAX_TOTAL_LOAD,
+        current_power=current_power,
+        water_heater_power=snapshot.water_heater_power,
+        capacity_limit=capacity_tariff.power_limit(current_power)
+    )
+    # Only a real overload may use a safety update; capacity-tariff throttling waits for the window
+    schedule_zaptec_update(desired_amperage, urgent=current_power >= MAX_TOTAL_LOAD)
+
+async def control_cycle():
+    """Run one full control cycle: devices, charging current and water heater schedule."""
+    current_time = datetime.now(LOCAL_TZ)
+    with stage_span("meter_poll"):
+        current_power = await run_blocking(get_current_power_usage)
+    logging.info(f"Current power usage: {current_power} Watts")
+    # Everything shared with the MQTT thread is read from this one snapshot
+    snapshot = shared_state.snapshot()
+    # Check water heater priority
+    prioritize_water_heater = track_water_heater_priority(snapshot.water_heater_power)
+
+    if current_power is None:
+        return
+
+    # Rolling window is fed by every meter reading
+    rolling = snapshot.rolling
+    average_load = rolling.mean if rolling.count else current_power
+    if rolling.count:
+        logging.info(
+            f"Rolling load over {rolling.span_seconds / 60:.1f} minutes: "
+            f"mean {rolling.mean:.2f} W, max {rolling.max:.2f} W, p95 {rolling.p95:.2f} W"
+        )
+    if snapshot.charger_power is not None:
+        logging.info(
+            f"Charger drawing {snapshot.charger_power:.0f} W at up to {snapshot.charger_current or 0:.1f} A, "
+            f"session {snapshot.session_energy or 0:.2f} kWh"
+        )
+    logging.info(
+        f"Capacity tariff: hour projected at {capacity_tariff.predict_hour_energy(current_power):.2f} kWh, "
+        f"allowed {capacity_tariff.allowed_hour_energy():.2f} kWh, monthly peak {capacity_tariff.monthly_peak():.2f} kW"
+    )
+    if prioritize_water_heater:
+        print("Prioritizing water heater; reducing charging load.")
+        ###not implemented
+    # Shed or restore devices for the current load; floors are on unless shed
+    with stage_span("load_shedding"):
+        shed_devices(current_power)
+        for topic in FLOOR_TOPICS:
+            publish_device_state(topic, 'off' if load_shedder.is_shed(topic) else 'on')
+
+    # Adjust charging current to accommodate other devices over the next rate-limit window
+    with stage_span("zaptec_update"):
+        window_load = predict_window_load(snapshot, current_time)
+        desired_amperage = adjust_charging_for_water_heater(
+            average_load=average_load if window_load is None else window_load,
+            threshold_load=MAX_TOTAL_LOAD,
+            current_power=current_power,
+            water_heater_power=snapshot.water_heater_power,
+            capacity_limit=capacity_tariff.power_limit(current_power)
+        )
+        schedule_zaptec_update(desired_amperage)
+
+    # Plans come from the cache unless prices changed since the last cycle
+    with stage_span("charging_plan"):
+        plan_charging_schedule(current_time, snapshot.prices)
+
+    # Schedule water heater for cheaper periods
+    with stage_span("water_heater"):
+        desired_water_heater_state = schedule_water_heater(snapshot.prices, current_time, 'off')
+        if load_shedder.is_shed(WATER_HEATER_TOPIC):
+            desired_water_heater_state = 'off'
+        control_water_heater(desired_water_heater_state)
+
+    # Send this cycle's device states in one batch
+    with stage_span("mqtt_publish"):
+        publisher.flush()
+    with stage_span("recorder_flush"):
+        recorder.flush()
+
+async def control_loop():
+    """React to every meter reading and run a full control cycle every CONTROL_INTERVAL seconds."""
+    loop = asyncio.get_running_loop()
+    next_cycle = loop.time()
+    while True:
+        try:
+            await asyncio.wait_for(meter_event.wait(), timeout=max(next_cycle - loop.time(), 0))
+            meter_event.clear()
+            snapshot = shared_state.snapshot()
+            if snapshot.last_consumption >= effective_load_limit(snapshot.last_consumption):
+                with tick_span("overload"):
+                    react_to_overload(snapshot)
+        except asyncio.TimeoutError:
+            try:
+                with tick_span("cycle"):
+                    await control_cycle()
+            except Exception as e:
+                logging.error(f"Control cycle failed: {e}")
+            next_cycle = loop.time() + CONTROL_INTERVAL
+
+async def price_refresh_loop():
+    """Fetch prices and re-plan charging every day at PRICE_REFRESH_HOUR."""
+    while True:
+        now = datetime.now(LOCAL_TZ)
+        next_refresh = now.replace(hour=PRICE_REFRESH_HOUR, minute=0, second=0, microsecond=0)
+        if next_refresh <= now:
+            next_refresh += timedelta(days=1)
+        await asyncio.sleep((next_refresh - now).total_seconds())
+        await run_blocking(fetch_entsoe_prices)
+        plan_charging_schedule()
+        logging.info(f"Plan cache: {plan_cache.stats()}")
+        logging.info(
+            f"Zaptec updates: {zaptec_scheduler.requested_count} requested, {zaptec_scheduler.coalesced_count} coalesced, "
+            f"{zaptec_scheduler.safety_count} safety, {zaptec_scheduler.failed_count} failed."
+        )
+
+async def charger_status_loop():
+    """Log charger settings (optional) once per control interval."""
+    while True:
+        await run_blocking(charger_settings)
+        await asyncio.sleep(CONTROL_INTERVAL)
+
+async def run():
+    global event_loop, meter_event
+    shared_state.update(water_heater_power=2000)  # Initialize water heater power draw (2kW)
+    event_loop = asyncio.get_running_loop()
+    meter_event = asyncio.Event()
 
-def main():
-    global LAST_ACTIVITY_TIME, water_heater_power
-    water_heater_power = 2000  # Initialize water heater power draw (2kW)
     # MQTT Client Setup
     client = setup_mqtt_client(
         broker=MQTT_BROKER,
         port=1883,
         keepalive=60,
         username=username,  
-        password=password)  
+        password=password,
+        topics=router.subscriptions(),
+        message_handler=on_message)
+
+    # Local text endpoint with stage latencies and counters
+    metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    if metrics_server:
+        metrics_server.start()
+
+    # Start sampling the AMS reader in the background
+    ams_client.add_listener(lambda timestamp, watts: handle_meter_reading(watts, timestamp))
+    ams_client.start()
+
+    # Follow the charger over the Zaptec Service Bus
+    if service_bus_configured():
+        zaptec_consumer.add_listener(on_charger_states)
+        zaptec_consumer.start()
 
     # Fetch initial prices and plan schedule
-    fetch_entsoe_prices()
+    await run_blocking(fetch_entsoe_prices)
     plan_charging_schedule()
 
+    tasks = [
+        asyncio.create_task(control_loop()),
+        asyncio.create_task(price_refresh_loop()),
+        asyncio.create_task(charger_status_loop()),
+    ]
     try:
-        while True:
-            current_time = datetime.now(LOCAL_TZ)
-            current_power = get_current_power_usage()
-            logging.info(f"Current power usage: {current_power} Watts")
-            # Check water heater priority
-            prioritize_water_heater = track_water_heater_priority(water_heater_power)
-            
-            if current_power is not None:
-                # Update rolling window with current power usage
-                average_load = update_rolling_loads(current_power)
-                if prioritize_water_heater:
-                    print("Prioritizing water heater; reducing charging load.")
-                    ###not implemented
-                # Assess device impact and control devices
-                device_states = assess_device_impact(
-                    current_power=current_power,
-                    topics=FLOOR_TOPICS + [WATER_HEATER_TOPIC],
-                    threshold_load=MAX_TOTAL_LOAD
-                )
-                for topic, state in device_states.items():
-                    publish_device_state(topic, state)
-
-                # Adjust charging current to accommodate other devices
-                desired_amperage = adjust_charging_for_water_heater(
-                    average_load=average_load,
-                    threshold_load=MAX_TOTAL_LOAD,
-                    current_power=current_power,
-                    water_heater_power=water_heater_power
-                )
-                set_charging_amperage(desired_amperage)
-
-                # Schedule water heater for cheaper periods
-                desired_water_heater_state = schedule_water_heater(prices, current_time, 'off')
-                control_water_heater(desired_water_heater_state)
-
-            # Refresh prices at 2 PM
-            if current_time.hour == 14 and (current_time - timedelta(minutes=1)).hour != 14:
-                fetch_entsoe_prices()
-                plan_charging_schedule()
-
-            # Log charger settings (optional)
-            charger_settings()
-
-            time.sleep(60)  # Check every minute
-
-    except KeyboardInterrupt:
-        logging.info("Script terminated by user.")
+        await asyncio.gather(*tasks)
     finally:
+        for task in tasks:
+            task.cancel()
+        if zaptec_timer is not None:
+            zaptec_timer.cancel()
+        event_loop = None
+        publisher.flush()
+        ams_client.stop()
+        zaptec_consumer.stop()
+        if metrics_server:
+            metrics_server.stop()
+        recorder.close()
+        zaptec_session.close()
         client.loop_stop()
         client.disconnect()
 
+# Main Function
+
+def main():
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logging.info("Script terminated by user.")
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,532 @@
+import logging
+import math
+import os
+import struct
+import re
+import sys
+import xml.etree.ElementTree as ET
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+NAN = float("nan")
+
+ENTSOE_API_URL = "https://web-api.tp.entsoe.eu/api"
+PRICE_CACHE_DIR = os.getenv("PRICE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "price_cache"))
+
+# Cache file layout: header, then one little-endian float64 per slot (NaN = unknown)
+CACHE_MAGIC = b"PRC1"
+CACHE_HEADER = struct.Struct("<4sIqd")  # magic, resolution seconds, start epoch, fetched-at epoch
+
+
+def to_epoch(when):
+    """
+    Convert a timezone-aware datetime (or pandas Timestamp) to UTC epoch seconds.
+
+    Args:
+        when (datetime): Time to convert. Naive datetimes are taken as UTC.
+
+    Returns:
+        float: Seconds since the epoch.
+    """
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+class PriceStore:
+    """
+    Time-indexed price store backed by a contiguous float array.
+
+    Slot `i` covers `[start + i * resolution, start + (i + 1) * resolution)` in UTC,
+    so finding the current slot is a subtraction and a division, and the next N
+    hours are an array slice. Missing slots hold NaN. Hourly and 15-minute (MTU)
+    resolutions are both supported; prices delivered at a coarser resolution than
+    the store fill every slot they cover.
+    """
+
+    def __init__(self, resolution_minutes=60):
+        """
+        Args:
+            resolution_minutes (int): Slot length in minutes (60 or 15).
+        """
+        self.resolution = int(resolution_minutes * 60)
+        self.start = None  # UTC epoch seconds of slot 0
+        self.values = array('d')
+        self.version = 0  # Incremented every time prices change
+
+    @property
+    def resolution_minutes(self):
+        return self.resolution // 60
+
+    def __len__(self):
+        return len(self.values)
+
+    def __bool__(self):
+        return any(not math.isnan(value) for value in self.values)
+
+    def slot_index(self, when):
+        """
+        Return the index of the slot containing `when` (may be outside the stored range).
+
+        Args:
+            when (datetime): A timezone-aware time.
+
+        Returns:
+            int: Slot index, or None if the store is empty.
+        """
+        if self.start is None:
+            return None
+        return int((to_epoch(when) - self.start) // self.resolution)
+
+    def slot_start(self, index):
+        """
+        Return the UTC start time of slot `index`.
+
+        Args:
+            index (int): Slot index.
+
+        Returns:
+            datetime: Start of the slot in UTC.
+        """
+        return datetime.fromtimestamp(self.start + index * self.resolution, tz=timezone.utc)
+
+    def get(self, when):
+        """
+        Return the price of the slot containing `when`.
+
+        Args:
+            when (datetime): A timezone-aware time.
+
+        Returns:
+            float: The price, or None if it is not known.
+        """
+        index = self.slot_index(when)
+        if index is None or not 0 <= index < len(self.values):
+            return None
+        value = self.values[index]
+        return None if math.isnan(value) else value
+
+    def current(self, now=None):
+        """
+        Return the price of the current slot.
+
+        Args:
+            now (datetime, optional): Current time. Defaults to now.
+
+        Returns:
+            float: The price, or None if it is not known.
+        """
+        return self.get(now or datetime.now(timezone.utc))
+
+    def next_hours(self, hours, now=None):
+        """
+        Return the prices from the current slot and `hours` hours ahead.
+
+        Args:
+            hours (float): Length of the range in hours.
+            now (datetime, optional): Start of the range. Defaults to now.
+
+        Returns:
+            tuple: (index of the first slot, array of prices; NaN where unknown).
+        """
+        first = self.slot_index(now or datetime.now(timezone.utc))
+        if first is None:
+            return 0, array('d')
+        count = int(math.ceil(hours * 3600 / self.resolution))
+        return self.slice(first, first + count)
+
+    def slice(self, first, last):
+        """
+        Return the prices of slots `first` up to (not including) `last`.
+
+        Args:
+            first (int): First slot index.
+            last (int): Slot index to stop before.
+
+        Returns:
+            tuple: (first, array of prices; NaN where unknown or outside the stored range).
+        """
+        values = array('d', [NAN]) * max(last - first, 0)
+        lo, hi = max(first, 0), min(last, len(self.values))
+        if hi > lo:
+            values[lo - first:hi - first] = self.values[lo:hi]
+        return first, values
+
+    def items(self):
+        """
+        Iterate over known prices.
+
+        Yields:
+            tuple: (UTC slot start, price) in time order.
+        """
+        for index, value in enumerate(self.values):
+            if not math.isnan(value):
+                yield self.slot_start(index), value
+
+    def set(self, when, price, duration=None):
+        """
+        Set the price for the slot(s) starting at `when`.
+
+        Args:
+            when (datetime): Start of the price period (timezone-aware).
+            price (float): The price.
+            duration (int, optional): Length of the price period in seconds. Defaults to the store resolution.
+        """
+        self._set(to_epoch(when), float(price), duration or self.resolution)
+        self.version += 1
+
+    def update(self, items, duration=None):
+        """
+        Set many prices at once, bumping the version once.
+
+        If the items are spaced more finely than the store (e.g. 15-minute prices
+        arriving in an hourly store), the store is refined first.
+
+        Args:
+            items (iterable): (start time, price) pairs.
+            duration (int, optional): Length of each price period in seconds. Defaults to the store resolution.
+        """
+        items = sorted((to_epoch(when), float(price)) for when, price in items)
+        step = min((b[0] - a[0] for a, b in zip(items, items[1:]) if b[0] > a[0]), default=None)
+        if duration is None and step and step < self.resolution and self.resolution % step == 0:
+            self.refine(int(step // 60))
+        for epoch, price in items:
+            self._set(epoch, price, duration or self.resolution)
+        self.version += 1
+
+    def refine(self, resolution_minutes):
+        """
+        Switch to a finer resolution, repeating each known price over the new slots.
+
+        Args:
+            resolution_minutes (int): New slot length; must divide the current one.
+        """
+        resolution = int(resolution_minutes * 60)
+        if resolution >= self.resolution or self.resolution % resolution:
+            raise ValueError(f"Cannot refine {self.resolution_minutes} min slots to {resolution_minutes} min")
+        factor = self.resolution // resolution
+        refined = array('d')
+        for value in self.values:
+            refined.extend([value] * factor)
+        self.values = refined
+        self.resolution = resolution
+        self.version += 1
+
+    def missing_ranges(self, start, end):
+        """
+        Return the time ranges between `start` and `end` that have no price.
+
+        Args:
+            start (datetime): Start of the range (timezone-aware).
+            end (datetime): End of the range (timezone-aware, exclusive).
+
+        Returns:
+            list: (start, end) UTC datetime pairs of contiguous missing slots.
+        """
+        start_epoch, end_epoch = to_epoch(start), to_epoch(end)
+        if self.start is None:
+            return [(start.astimezone(timezone.utc), end.astimezone(timezone.utc))] if end_epoch > start_epoch else []
+
+        first = int((start_epoch - self.start) // self.resolution)
+        last = int(math.ceil((end_epoch - self.start) / self.resolution))
+        _, values = self.slice(first, last)
+        ranges = []
+        gap_start = None
+        for offset, value in enumerate(values):
+            if math.isnan(value):
+                if gap_start is None:
+                    gap_start = first + offset
+            elif gap_start is not None:
+                ranges.append((self.slot_start(gap_start), self.slot_start(first + offset)))
+                gap_start = None
+        if gap_start is not None:
+            ranges.append((self.slot_start(gap_start), self.slot_start(last)))
+        return ranges
+
+    def save(self, path, fetched_at=None):
+        """
+        Write the store to a cache file atomically.
+
+        Args:
+            path (str): Cache file path.
+            fetched_at (float, optional): Epoch of the last successful fetch. Defaults to now.
+        """
+        fetched_at = datetime.now(timezone.utc).timestamp() if fetched_at is None else fetched_at
+        values = array('d', self.values)
+        if sys.byteorder == "big":
+            values.byteswap()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, self.resolution, int(self.start or 0), fetched_at))
+            values.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, resolution_minutes=60):
+        """
+        Load a store from a cache file, or return an empty store if the file is missing or invalid.
+
+        Args:
+            path (str): Cache file path.
+            resolution_minutes (int): Resolution of the empty store returned when there is no cache.
+
+        Returns:
+            PriceStore: The loaded store.
+        """
+        store = cls(resolution_minutes)
+        try:
+            with open(path, "rb") as f:
+                magic, resolution, start, _ = CACHE_HEADER.unpack(f.read(CACHE_HEADER.size))
+                if magic != CACHE_MAGIC:
+                    raise ValueError("not a price cache file")
+                values = array('d')
+                values.frombytes(f.read())
+        except FileNotFoundError:
+            return store
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning(f"Ignoring unreadable price cache {path}: {e}")
+            return store
+
+        if sys.byteorder == "big":
+            values.byteswap()
+        store.resolution = resolution
+        store.start = start if len(values) else None
+        store.values = values
+        store.version += 1
+        logging.info(f"Loaded {len(values)} cached price slots from {path}.")
+        return store
+
+    def replace(self, items, resolution_minutes=None):
+        """
+        Replace all prices, optionally switching resolution.
+
+        Args:
+            items (iterable): (start time, price) pairs in any order.
+            resolution_minutes (int, optional): New slot length. Inferred from the data when omitted.
+        """
+        items = sorted((to_epoch(when), float(price)) for when, price in items)
+        if resolution_minutes is None and len(items) > 1:
+            step = min((b[0] - a[0] for a, b in zip(items, items[1:]) if b[0] > a[0]), default=self.resolution)
+            resolution_minutes = step // 60
+        if resolution_minutes:
+            self.resolution = int(resolution_minutes * 60)
+        self.start = None
+        self.values = array('d')
+        for epoch, price in items:
+            self._set(epoch, price, self.resolution)
+        self.version += 1
+
+    def clear(self):
+        """Remove all prices."""
+        self.start = None
+        self.values = array('d')
+        self.version += 1
+
+    def copy(self):
+        """Return an independent copy with the same prices and version."""
+        store = PriceStore()
+        store.resolution = self.resolution
+        store.start = self.start
+        store.values = array('d', self.values)
+        store.version = self.version
+        return store
+
+    __copy__ = copy
+
+    def _set(self, epoch, price, duration):
+        first_epoch = epoch - epoch % self.resolution
+        if self.start is None:
+            self.start = first_epoch
+        elif first_epoch < self.start:
+            # Grow at the front; rare, only when older prices arrive late
+            missing = int((self.start - first_epoch) // self.resolution)
+            self.values = array('d', [NAN] * missing) + self.values
+            self.start = first_epoch
+        first = int((first_epoch - self.start) // self.resolution)
+        last = first + max(int(duration // self.resolution), 1)
+        if last > len(self.values):
+            self.values.extend([NAN] * (last - len(self.values)))
+        for index in range(first, last):
+            self.values[index] = price
+
+
+def local_hour_start(hour, tz, now=None):
+    """
+    Return the start of `hour` today in the given timezone, for sources that key prices by hour of day.
+
+    Args:
+        hour (int): Hour of day (0-23); 24 and above fall on the following days, e.g. 24 is tomorrow's midnight.
+        tz (tzinfo): Local timezone (pytz or zoneinfo).
+        now (datetime, optional): Reference time. Defaults to now.
+
+    Returns:
+        datetime: Timezone-aware start of that hour.
+    """
+    now = (now or datetime.now(timezone.utc)).astimezone(tz)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0).replace(tzinfo=None)
+    naive = midnight + timedelta(hours=int(hour))
+    if hasattr(tz, "localize"):
+        return tz.localize(naive)
+    return naive.replace(tzinfo=tz)
+
+
+def cache_path(bidding_zone, cache_dir=PRICE_CACHE_DIR):
+    """
+    Return the cache file path for a bidding zone.
+
+    Args:
+        bidding_zone (str): ENTSO-E area code, e.g. '10YNO-2--------T'.
+        cache_dir (str): Directory holding the cache files.
+
+    Returns:
+        str: Path of the zone's cache file.
+    """
+    return os.path.join(cache_dir, f"{bidding_zone}.bin")
+
+
+def fill_missing(store, fetch, start, end, cache_path=None):
+    """
+    Fetch only the slots between `start` and `end` that the store does not have yet.
+
+    A range ENTSO-E has no prices for yet (NoPriceData, e.g. tomorrow before the
+    auction is published) is skipped and left missing for the next call. If a
+    fetch fails, the ranges fetched before it stay in the store and in the cache.
+
+    Args:
+        store (PriceStore): The price store to fill.
+        fetch (callable): `fetch(range_start, range_end)` returning (start time, price) pairs.
+        start (datetime): Start of the wanted range (timezone-aware).
+        end (datetime): End of the wanted range (timezone-aware, exclusive).
+        cache_path (str, optional): Cache file to save to when anything was fetched.
+
+    Returns:
+        int: Number of ranges fetched.
+    """
+    ranges = store.missing_ranges(start, end)
+    if not ranges:
+        logging.info("All requested prices are cached; nothing to fetch.")
+        return 0
+
+    fetched = 0
+    try:
+        for range_start, range_end in ranges:
+            logging.info(f"Fetching prices {range_start:%Y-%m-%d %H:%M} - {range_end:%Y-%m-%d %H:%M} UTC.")
+            try:
+                store.update(fetch(range_start, range_end))
+            except NoPriceData as e:
+                logging.info(f"No prices for {range_start:%Y-%m-%d %H:%M} - {range_end:%Y-%m-%d %H:%M} UTC yet: {e}")
+                continue
+            fetched += 1
+    finally:
+        if fetched and cache_path:
+            store.save(cache_path)
+    return fetched
+
+
+class NoPriceData(ValueError):
+    """ENTSO-E answered, but has no prices for the requested range (e.g. not published yet)."""
+
+
+def _parse_duration(text):
+    # ISO 8601 durations used by ENTSO-E: PT15M, PT30M, PT60M, P1D
+    match = re.fullmatch(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?)?", text.strip())
+    if not match:
+        raise ValueError(f"Unsupported resolution: {text}")
+    days, hours, minutes = (int(part or 0) for part in match.groups())
+    return timedelta(days=days, hours=hours, minutes=minutes)
+
+
+def _parse_time(text):
+    # ENTSO-E times look like 2024-01-01T23:00Z
+    return datetime.strptime(text.strip(), "%Y-%m-%dT%H:%MZ").replace(tzinfo=timezone.utc)
+
+
+def parse_day_ahead_xml(content):
+    """
+    Parse an ENTSO-E day-ahead price document (documentType A44) without pandas.
+
+    Curve type A03 documents leave out points whose price equals the previous one;
+    those are filled in.
+
+    Args:
+        content (bytes): The XML response body.
+
+    Returns:
+        list: (UTC slot start, price) pairs in time order.
+
+    Raises:
+        NoPriceData: If the document is an acknowledgement without prices.
+        ValueError: If the document cannot be parsed.
+    """
+    try:
+        root = ET.fromstring(content)
+    except ET.ParseError as e:
+        raise ValueError(f"Invalid ENTSO-E document: {e}")
+    namespace = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+
+    if root.tag.endswith("Acknowledgement_MarketDocument"):
+        reason = root.findtext(f".//{namespace}Reason/{namespace}text") or "unknown reason"
+        raise NoPriceData(f"ENTSO-E returned no data: {reason}")
+
+    slots = {}
+    for period in root.iter(f"{namespace}Period"):
+        start = _parse_time(period.findtext(f"{namespace}timeInterval/{namespace}start"))
+        end = _parse_time(period.findtext(f"{namespace}timeInterval/{namespace}end"))
+        step = _parse_duration(period.findtext(f"{namespace}resolution"))
+        count = int((end - start) / step)
+
+        points = {}
+        for point in period.iter(f"{namespace}Point"):
+            points[int(point.findtext(f"{namespace}position"))] = float(point.findtext(f"{namespace}price.amount"))
+
+        price = None
+        for position in range(1, count + 1):
+            price = points.get(position, price)
+            if price is not None:
+                slots[start + (position - 1) * step] = price
+
+    return sorted(slots.items())
+
+
+def fetch_day_ahead_prices(api_key, bidding_zone, start, end, session=None, timeout=30):
+    """
+    Fetch day-ahead prices straight from the ENTSO-E REST API.
+
+    This avoids importing pandas and entsoe-py, which take many seconds and tens
+    of MB on a Raspberry Pi Zero.
+
+    Args:
+        api_key (str): ENTSO-E security token.
+        bidding_zone (str): ENTSO-E area code, e.g. '10YNO-2--------T'.
+        start (datetime): Start of the range (timezone-aware).
+        end (datetime): End of the range (timezone-aware, exclusive).
+        session (requests.Session, optional): Session to reuse connections.
+        timeout (int): Request timeout in seconds.
+
+    Returns:
+        list: (UTC slot start, price) pairs in time order.
+
+    Raises:
+        requests.RequestException: If the request fails.
+        NoPriceData: If ENTSO-E has no prices for the range.
+        ValueError: If the document cannot be parsed.
+    """
+    params = {
+        "securityToken": api_key,
+        "documentType": "A44",
+        "in_Domain": bidding_zone,
+        "out_Domain": bidding_zone,
+        "contract_MarketAgreement.type": "A01",
+        "periodStart": start.astimezone(timezone.utc).strftime("%Y%m%d%H%M"),
+        "periodEnd": end.astimezone(timezone.utc).strftime("%Y%m%d%H%M"),
+    }
+    response = (session or requests).get(ENTSOE_API_URL, params=params, timeout=timeout)
+    if response.status_code >= 400 and b"Acknowledgement_MarketDocument" in response.content:
+        # ENTSO-E reports "no matching data" as an HTTP error with an XML reason
+        return parse_day_ahead_xml(response.content)
+    response.raise_for_status()
+    start_epoch, end_epoch = to_epoch(start), to_epoch(end)
+    return [(when, price) for when, price in parse_day_ahead_xml(response.content) if start_epoch <= when.timestamp() < end_epoch]
@@ -2,14 +2,17 @@ import os
 import paho.mqtt.client as mqtt
 import time
 import requests
-from datetime import datetime, timedelta
-from entsoe import EntsoePandasClient
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import threading
 import pytz
 import logging
-import pandas as pd
 import random
+from amsReader import AmsClient
+from costLedger import CostLedger
+from mqttRouter import TopicRouter
+from priceStore import PriceStore, cache_path, fetch_day_ahead_prices, fill_missing, local_hour_start
+from sharedState import SharedState
 
 # Configure logging
 logging.basicConfig(
@@ -28,22 +31,44 @@ load_dotenv()
 ENTSOE_API_KEY = os.getenv('ENTSOE_API_KEY')
 BROKER = os.getenv('MQTT_BROKER', '192.168.86.54')
 REBOOT_URL = os.getenv('REBOOT_URL', 'http://192.168.86.34/configuration')
+AMS_API_BASE_URL = os.getenv('AMS_API_BASE_URL', 'http://192.168.86.34')
+AMS_SAMPLE_INTERVAL = float(os.getenv('AMS_SAMPLE_INTERVAL', '10'))
+COST_SLOT_SECONDS = 15 * 60  # Ledger slot; divides every price resolution
+
+BIDDING_ZONE = '10YNO-2--------T'
+PRICE_CACHE_FILE = cache_path(BIDDING_ZONE)
 
 if not ENTSOE_API_KEY:
     logging.error("No ENTSOE_API_KEY found in environment variables.")
     raise ValueError("No ENTSOE_API_KEY found in environment variables.")
 
 # Globals
-LAST_ACTIVITY_TIME = time.time()
-prices = {}
-last_consumption = None
+# Written by the MQTT thread and the price-refresh thread; read as whole snapshots
+shared_state = SharedState(
+    prices=PriceStore.load(PRICE_CACHE_FILE),  # ENTSO-E day-ahead prices (EUR/MWh); the cost ledger prices slots from these
+    ams_prices=PriceStore(),  # Hourly prices per kWh from the AMS reader, kept for reference only
+    last_consumption=None,
+    last_activity=time.time(),
+)
 local_timezone = pytz.timezone('Europe/Oslo')
+ams_client = AmsClient(AMS_API_BASE_URL, sample_interval=AMS_SAMPLE_INTERVAL)
+# Energy and cost per price slot, day and month, integrated from every power sample.
+# Slots are 15 minutes, the finest price resolution, and each is priced from the
+# current store's ENTSO-E prices (EUR/MWh) when it closes, so hourly and 15-minute
+# prices both apply. Costs are in EUR.
+cost_ledger = CostLedger(
+    local_timezone,
+    lambda epoch: shared_state.get("prices").get(datetime.fromtimestamp(epoch, timezone.utc)),
+    slot_seconds=COST_SLOT_SECONDS,
+    currency="EUR"
+)
 
 # MQTT Handlers
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         logging.info("Connected to MQTT broker.")
-        client.subscribe("ams/meter/import/active")
+        for topic in router.subscriptions():
+            client.subscribe(topic)
     else:
         logging.error(f"Connection failed with code {rc}")
 
@@ -51,34 +76,52 @@ def on_disconnect(client, userdata, rc):
     logging.warning(f"Disconnected from MQTT broker with code {rc}. Reconnecting...")
     client.reconnect_delay_set(min_delay=5, max_delay=60)
 
+def on_price(topic, price):
+    # Per-kWh AMS prices must not reach the EUR/MWh store the cost ledger reads
+    hour = topic.rsplit("/", 1)[-1]
+    start = local_hour_start(hour, local_timezone)
+    shared_state.modify("ams_prices", lambda store: store.set(start, price, duration=3600))
+    logging.info(f"Price for hour {hour}: {price:.2f} currency per kWh")
+
+def on_meter_message(topic, consumption):
+    shared_state.update(last_consumption=consumption)
+    calculate_cost(consumption)
+    router.log.log(logging.INFO, topic, lambda: f"Current power consumption: {consumption:.2f} Watts")
+
+# Incoming MQTT topics; the router parses payloads from bytes and rate-limits per-message logging
+router = TopicRouter()
+router.route("ams/price/+", on_price)
+router.route("ams/meter/import/active", on_meter_message)
+
 def on_message(client, userdata, msg, properties=None):
-    global LAST_ACTIVITY_TIME, last_consumption, prices
-    LAST_ACTIVITY_TIME = time.time()
-    try:
-        topic = msg.topic
-        payload = float(msg.payload.decode("utf-8"))
-        
-        if topic.startswith("ams/price/"):
-            hour = topic.split("/")[-1]
-            prices[hour] = payload
-            logging.info(f"Price for hour {hour}: {payload:.2f} currency per kWh")
-        elif topic == "ams/meter/import/active":
-            last_consumption = payload
-            logging.info(f"Current power consumption: {payload:.2f} Watts")
-            calculate_cost(payload)
-    except ValueError as e:
-        logging.warning(f"Error processing message: {e}")
+    shared_state.update(last_activity=time.time())
+    router.on_message(client, userdata, msg)
 
 # Cost Calculation
-def calculate_cost(consumption):
-    current_time_local = datetime.now(local_timezone)
-    hour_str = str(current_time_local.hour)
-    if hour_str in prices:
-        current_price = prices[hour_str]
-        cost_per_hour = (consumption / 1000.0) * current_price
-        logging.info(f"Cost per hour at {current_price:.2f} currency/kWh: {cost_per_hour:.2f}")
-    else:
+def calculate_cost(consumption, timestamp=None):
+    """
+    Add a power sample to the cost ledger.
+
+    Args:
+        consumption (float): Power usage in watts.
+        timestamp (float, optional): Time of the sample. Defaults to now.
+    """
+    cost_ledger.add(consumption, timestamp)
+
+def log_cost():
+    """Log the energy used and its cost for the current price slot, day and month."""
+    totals = cost_ledger.totals()
+    slot_kwh, slot_cost = totals["slot"]
+    if slot_cost is None:
         logging.warning("No price data available for the current hour.")
+        slot_cost = 0.0
+    day_kwh, day_cost = totals["day"]
+    month_kwh, month_cost = totals["month"]
+    logging.info(
+        f"Energy and cost: slot {slot_kwh:.3f} kWh / {slot_cost:.2f} {cost_ledger.currency}, "
+        f"today {day_kwh:.2f} kWh / {day_cost:.2f} {cost_ledger.currency}, "
+        f"month {month_kwh:.1f} kWh / {month_cost:.2f} {cost_ledger.currency}"
+    )
 
 # AMS Reader Reboot
 def reboot_ams_reader():
@@ -100,41 +143,42 @@ def collect_entsoe_prices(max_retries=5):
     """
     Fetches ENTSO-E day-ahead prices with exponential backoff on failure.
 
+    Only slots of today's local day missing from the on-disk price cache are
+    requested. They are fetched into a private copy of the prices and merged into
+    the shared state afterwards, so readers never see a range half filled; ranges
+    that arrived are kept even if a later one fails.
+
     Args:
         max_retries (int): Maximum number of retry attempts.
 
     Global:
-        Updates the `prices` dictionary with fetched price data.
+        Adds fetched price data to the shared `prices` and the cache file.
     """
-    client_entsoe = EntsoePandasClient(api_key=ENTSOE_API_KEY)
-    bidding_zone = '10YNO-2--------T'
-    global prices
+    def query(range_start, range_end):
+        return fetch_day_ahead_prices(ENTSOE_API_KEY, BIDDING_ZONE, range_start, range_end)
 
     retries = 0
     backoff = 2  # Initial backoff time in seconds
 
     while retries < max_retries:
+        fetched_prices = shared_state.get("prices").copy()
+        version = fetched_prices.version
         try:
-            start = pd.Timestamp(datetime.now(pytz.utc).replace(hour=0, minute=0, second=0))
-            end = start + timedelta(days=1)
-            prices_series = client_entsoe.query_day_ahead_prices(bidding_zone, start=start, end=end)
-
-            # Clear and populate the prices dictionary
-            prices.clear()
-            for ts, price in prices_series.items():
-                try:
-                    hour = ts.tz_convert(local_timezone).hour
-                    prices[str(hour)] = float(price)
-                except Exception as e:
-                    logging.error(f"Invalid price data: {e}")
-
-            logging.info("Fetched ENTSO-E day-ahead prices successfully.")
+            # Today's local day, the span of one day-ahead auction
+            start = local_hour_start(0, local_timezone)
+            end = local_hour_start(24, local_timezone)
+            fill_missing(fetched_prices, query, start, end, cache_path=PRICE_CACHE_FILE)
             return  # Exit the function on success
 
         except requests.RequestException as e:
             logging.error(f"Connection error: {e}. Retrying in {backoff} seconds...")
         except Exception as e:
             logging.error(f"Error fetching ENTSO-E prices: {e}. Retrying in {backoff} seconds...")
+        finally:
+            # Keep the ranges that arrived, also when a later one failed
+            if fetched_prices.version != version:
+                shared_state.modify("prices", lambda store: store.update(fetched_prices.items()))
+                logging.info("Fetched ENTSO-E day-ahead prices successfully.")
 
         retries += 1
         time.sleep(backoff + random.uniform(0, 1))  # Add jitter to prevent synchronized retries
@@ -144,21 +188,24 @@ def collect_entsoe_prices(max_retries=5):
 
 # Fetch Prices from ENTSO-E
 def collect_entsoe_prices_old():
+    # pandas and entsoe-py are slow to import on the Pi Zero; load them only here
+    import pandas as pd
+    from entsoe import EntsoePandasClient
+
     client_entsoe = EntsoePandasClient(api_key=ENTSOE_API_KEY)
     bidding_zone = '10YNO-2--------T'
-    global prices
     try:
 #        start = pd.Timestamp(datetime.now(pytz.utc).replace(hour=0, minute=0, second=0), tz="UTC")
         start = pd.Timestamp(datetime.now(pytz.utc).replace(hour=0, minute=0, second=0))
         end = start + timedelta(days=1)
         prices_series = client_entsoe.query_day_ahead_prices(bidding_zone, start=start, end=end)
-        prices.clear()
+        slots = []
         for ts, price in prices_series.items():
             try:
-                hour = ts.tz_convert(local_timezone).hour
-                prices[str(hour)] = float(price)
+                slots.append((ts.to_pydatetime(), float(price)))
             except Exception as e:
                 logging.error(f"Invalid price data: {e}")
+        shared_state.modify("prices", lambda store: store.replace(slots))
         logging.info("Fetched ENTSO-E day-ahead prices successfully.")
     except Exception as e:
         logging.error(f"Error fetching ENTSO-E prices: {e}")
@@ -176,29 +223,30 @@ def schedule_price_updates():
         except Exception as e:
             logging.error(f"Error in price update thread: {e}")
 
-def get_current_power_usage(api_base_url="http://192.168.86.34", timeout=5):
+def get_current_power_usage(max_age=None):
     """
-    Fetch the current power usage from the AMS Leser HTTP API.
+    Return the current power usage from the shared AMS sample buffer.
+
+    Polls the AMS Leser HTTP API directly only if no sample younger than
+    `max_age` (default: one sample interval) is buffered.
 
     Args:
-        api_base_url (str): The base URL of the AMS Leser API.
-        timeout (int): Request timeout in seconds.
+        max_age (float, optional): Maximum age in seconds of a buffered reading.
 
     Returns:
-        float: Current power usage in Watts.
+        float: Current power usage in Watts, or None if the reader has no new reading yet.
 
     Raises:
         Exception: If the API call fails or returns invalid data.
     """
-    endpoint = f"{api_base_url}/data.json"
+    max_age = ams_client.sample_interval if max_age is None else max_age
+    current_power = ams_client.latest(max_age=max_age)
+    if current_power is not None:
+        return current_power
     try:
-        response = requests.get(endpoint, timeout=timeout)
-        response.raise_for_status()
-        data = response.json()
-
-        # Extracting the "power" value (ensure the API structure matches the docs)
-        current_power = float(data.get("w", 0.0))
-        logging.info(f"Current power usage fetched: {current_power} Watts")
+        current_power = ams_client.poll()
+        if current_power is not None:
+            logging.info(f"Current power usage fetched: {current_power} Watts")
         return current_power
     except requests.RequestException as e:
         logging.error(f"Failed to fetch power usage: {e}")
@@ -209,31 +257,35 @@ def get_current_power_usage(api_base_url="http://192.168.86.34", timeout=5):
 
 # Main Function
 def main():
-    global LAST_ACTIVITY_TIME
     collect_entsoe_prices()
     threading.Thread(target=schedule_price_updates, daemon=True).start()
+    # Integrate every sample the AMS poller takes, with its own timestamp
+    ams_client.add_listener(lambda timestamp, watts: calculate_cost(watts, timestamp))
+    ams_client.start()
 
     try:
         while True:
-            # Fetch current power usage directly from the AMS Leser API
+            # Read current power usage from the shared AMS sample buffer
             try:
-                current_power = get_current_power_usage()
-                calculate_cost(current_power)
-                LAST_ACTIVITY_TIME = time.time()
+                get_current_power_usage()
+                log_cost()
+                shared_state.update(last_activity=time.time())
             except Exception as e:
                 logging.warning(f"Failed to retrieve power usage: {e}")
 
             # Check for inactivity and attempt reboot if necessary
-            if time.time() - LAST_ACTIVITY_TIME > 300:
+            if time.time() - shared_state.get("last_activity") > 300:
                 reboot_ams_reader()
-                LAST_ACTIVITY_TIME = time.time()
+                shared_state.update(last_activity=time.time())
 
-            time.sleep(10)
+            time.sleep(ams_client.sample_interval)
     except KeyboardInterrupt:
         logging.info("Shutting down...")
+    finally:
+        ams_client.stop()
+        cost_ledger.close()
 
 def main_old():
-    global LAST_ACTIVITY_TIME
     #client = mqtt.Client()
     # Specify protocol version to enforce updated API
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
@@ -246,9 +298,9 @@ def main_old():
     threading.Thread(target=schedule_price_updates, daemon=True).start()
     try:
         while True:
-            if time.time() - LAST_ACTIVITY_TIME > 300:
+            if time.time() - shared_state.get("last_activity") > 300:
                 reboot_ams_reader()
-                LAST_ACTIVITY_TIME = time.time()
+                shared_state.update(last_activity=time.time())
             time.sleep(10)
     except KeyboardInterrupt:
         logging.info("Shutting down...")
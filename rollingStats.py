@@ -0,0 +1,155 @@
+import math
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import deque, namedtuple
+
+RollingSummary = namedtuple("RollingSummary", "count mean min max p95 ewma span_seconds")
+
+
+class RollingStats:
+    """
+    Time-windowed rolling statistics, cheap to update per sample.
+
+    Samples older than `window_seconds` are evicted as new ones arrive. Values are
+    kept in fixed-size arrays sized for the highest expected sample rate, the sum
+    is maintained incrementally and min/max use monotonic deques, all O(1)
+    amortised. Percentiles read from a sorted copy of the window, whose insert and
+    delete are O(n) in the window length: a binary search plus a list shift, which
+    for a 900-sample window is a memmove of a few kilobytes. The EWMA uses a time
+    constant so uneven sample spacing is handled.
+    """
+
+    def __init__(self, window_seconds=900, max_rate=1.0, ewma_seconds=60):
+        """
+        Args:
+            window_seconds (float): Length of the rolling window in seconds.
+            max_rate (float): Highest expected sample rate in samples per second.
+                Used to size the buffers; if samples arrive faster the oldest are
+                evicted early.
+            ewma_seconds (float): Time constant of the exponentially weighted mean.
+        """
+        self.window_seconds = window_seconds
+        self.ewma_seconds = ewma_seconds
+        self.capacity = int(math.ceil(window_seconds * max_rate)) + 1
+        self._values = array('d', bytes(8 * self.capacity))
+        self._times = array('d', bytes(8 * self.capacity))
+        self._head = 0  # sequence number of the oldest sample in the window
+        self._next = 0  # sequence number of the next sample
+        self._sum = 0.0
+        self._since_resum = 0
+        self._min = deque()  # (seq, value), values increasing
+        self._max = deque()  # (seq, value), values decreasing
+        self._sorted = []
+        self._ewma = None
+        self._last_time = None
+
+    def add(self, value, timestamp=None):
+        """
+        Add a sample and evict samples that have left the window.
+
+        Args:
+            value (float): The sample value.
+            timestamp (float, optional): Time of the sample. Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+
+        if self._next - self._head == self.capacity:
+            self._evict_oldest()
+
+        seq = self._next
+        slot = seq % self.capacity
+        self._values[slot] = value
+        self._times[slot] = timestamp
+        self._next += 1
+        self._sum += value
+        insort(self._sorted, value)
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((seq, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((seq, value))
+
+        if self._ewma is None:
+            self._ewma = value
+        else:
+            alpha = 1.0 - math.exp(-max(timestamp - self._last_time, 0.0) / self.ewma_seconds)
+            self._ewma += alpha * (value - self._ewma)
+        self._last_time = timestamp
+
+        cutoff = timestamp - self.window_seconds
+        while self._next - self._head > 1 and self._times[self._head % self.capacity] < cutoff:
+            self._evict_oldest()
+
+        # Recompute the sum now and then so floating-point error cannot accumulate
+        self._since_resum += 1
+        if self._since_resum >= self.capacity:
+            self._sum = math.fsum(self._sorted)
+            self._since_resum = 0
+
+    def __len__(self):
+        return self._next - self._head
+
+    def mean(self):
+        """Return the mean of the window, or None if it is empty."""
+        count = len(self)
+        return self._sum / count if count else None
+
+    def total(self):
+        """Return the sum of the window."""
+        return self._sum
+
+    def min(self):
+        """Return the smallest value in the window, or None if it is empty."""
+        return self._min[0][1] if self._min else None
+
+    def max(self):
+        """Return the largest value in the window, or None if it is empty."""
+        return self._max[0][1] if self._max else None
+
+    def percentile(self, p):
+        """
+        Return the p-th percentile of the window (nearest-rank).
+
+        Args:
+            p (float): Percentile between 0 and 100.
+
+        Returns:
+            float: The percentile value, or None if the window is empty.
+        """
+        if not self._sorted:
+            return None
+        rank = int(math.ceil(p / 100.0 * len(self._sorted))) - 1
+        return self._sorted[min(max(rank, 0), len(self._sorted) - 1)]
+
+    def ewma(self):
+        """Return the exponentially weighted moving average, or None if no samples were added."""
+        return self._ewma
+
+    def span_seconds(self):
+        """Return the time covered by the samples currently in the window."""
+        if not len(self):
+            return 0.0
+        return self._times[(self._next - 1) % self.capacity] - self._times[self._head % self.capacity]
+
+    def summary(self):
+        """
+        Return the window statistics as one immutable record.
+
+        Returns:
+            RollingSummary: count, mean, min, max, p95, ewma and span_seconds; mean to ewma are None if the window is empty.
+        """
+        return RollingSummary(len(self), self.mean(), self.min(), self.max(), self.percentile(95), self.ewma(), self.span_seconds())
+
+    def _evict_oldest(self):
+        seq = self._head
+        value = self._values[seq % self.capacity]
+        self._head += 1
+        self._sum -= value
+        del self._sorted[bisect_left(self._sorted, value)]
+        if self._min and self._min[0][0] == seq:
+            self._min.popleft()
+        if self._max and self._max[0][0] == seq:
+            self._max.popleft()
@@ -0,0 +1,78 @@
+import copy
+import threading
+from collections import namedtuple
+
+
+class SharedState:
+    """
+    Copy-on-write state shared between the MQTT thread, pollers and the control loop.
+
+    All values live in one immutable named tuple. A writer builds a new tuple
+    under a lock and swaps the reference in; a reader takes the current reference,
+    which is a single atomic load, so readers never block, never wait for writers
+    and always see every field from the same update. Mutable values (such as a
+    price store) are never changed in place once published: `modify` copies them,
+    applies the change to the copy and publishes the copy.
+    """
+
+    def __init__(self, **fields):
+        """
+        Args:
+            **fields: Field names and their initial values. The set of fields is fixed.
+        """
+        self._type = namedtuple("Snapshot", ["version", *fields])
+        self._lock = threading.Lock()  # Serialises writers only
+        self._snapshot = self._type(version=0, **fields)
+
+    def snapshot(self):
+        """
+        Return the current state without locking.
+
+        Returns:
+            Snapshot: Immutable named tuple with `version` (incremented by every update) and every field.
+        """
+        return self._snapshot
+
+    def get(self, name):
+        """Return the current value of one field without locking."""
+        return getattr(self._snapshot, name)
+
+    def update(self, **changes):
+        """
+        Publish new values for some fields.
+
+        Args:
+            **changes: Field names and their new values.
+
+        Returns:
+            Snapshot: The snapshot that was published.
+
+        Raises:
+            ValueError: If a field name is unknown.
+        """
+        with self._lock:
+            current = self._snapshot
+            self._snapshot = snapshot = current._replace(version=current.version + 1, **changes)
+        return snapshot
+
+    def modify(self, name, mutate):
+        """
+        Change a mutable field copy-on-write.
+
+        The field is copied, `mutate` is applied to the copy and the copy is
+        published, all under the writer lock so concurrent writers cannot lose
+        each other's changes. Keep `mutate` short; it must not block on I/O.
+
+        Args:
+            name (str): Field name.
+            mutate (callable): Called with the copy; its return value is ignored.
+
+        Returns:
+            Snapshot: The snapshot that was published.
+        """
+        with self._lock:
+            current = self._snapshot
+            value = copy.copy(getattr(current, name))
+            mutate(value)
+            self._snapshot = snapshot = current._replace(version=current.version + 1, **{name: value})
+        return snapshot
@@ -0,0 +1,567 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytz
+
+from zaptec import STATE_SESSION_ENERGY, STATE_TOTAL_CHARGE_POWER
+
+# Keep simulated runs away from the live capacity tariff state; set before priceLoad is imported
+os.environ.setdefault("CAPACITY_STATE_FILE", "")
+
+LOCAL_TZ = pytz.timezone("Europe/Oslo")
+STEP_SECONDS = 60  # One meter reading per simulated minute
+# Modules whose `time` and `datetime` are replaced by the simulated clock
+CLOCKED_MODULES = ["priceLoad", "amperageScheduler", "amsReader", "capacityTariff", "loadShedding", "mqttRouter", "rollingStats", "priceStore"]
+
+# Synthetic house
+FLOOR_DUTY_WINTER = 0.7  # Share of the time a floor thermostat calls for heat in January
+FLOOR_DUTY_SUMMER = 0.05
+FLOOR_COLD_DEFICIT_KWH = 1.0  # Heat a floor may fall behind by before it counts as cold
+TANK_CAPACITY_KWH = 12.0  # Heat the water heater can store
+TANK_LOSS_KW = 0.06
+HOT_WATER_DRAWS = {7: 3.0, 8: 1.0, 19: 2.0, 21: 2.5}  # Local hour -> kWh of hot water used in that hour
+EV_ARRIVAL_HOURS = (16, 19)  # The car is plugged in at a random time in this range...
+EV_DEPARTURE_HOUR = 7  # ...and leaves at this hour the next morning
+EV_NEED_KWH = (5.0, 30.0)
+
+
+class SimClock:
+    """Stand-in for the `time` module that returns simulated time."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass  # Retry delays cost no simulated time
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def clocked_datetime(clock):
+    """Return a datetime class whose now() follows `clock`."""
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.now, tz)
+
+    return SimDatetime
+
+
+class FakeResponse:
+    """Minimal requests.Response stand-in."""
+
+    def __init__(self, status_code=200, payload=None):
+        self.status_code = status_code
+        self.headers = {}
+        self._payload = payload or {}
+        self.text = json.dumps(self._payload)
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeBroker:
+    """
+    Stand-in for the MQTT broker.
+
+    Keeps the last payload published per topic, which the simulated devices
+    follow, and acknowledges publishes on the next acknowledge() call (paho calls
+    on_publish from its network thread, never from inside publish()).
+    """
+
+    def __init__(self):
+        self.retained = {}
+        self.on_publish = None
+        self.published_count = 0
+        self._mid = 0
+        self._unacked = []
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self._mid += 1
+        self.retained[topic] = payload
+        self.published_count += 1
+        self._unacked.append(self._mid)
+        return 0, self._mid
+
+    def acknowledge(self):
+        unacked, self._unacked = self._unacked, []
+        if self.on_publish is not None:
+            for mid in unacked:
+                self.on_publish(self, None, mid)
+
+
+class FakeAmsHttp:
+    """Stand-in for the AMS reader's data.json, serving the simulated meter."""
+
+    def __init__(self, house):
+        self.house = house
+
+    def get(self, url, headers=None, timeout=None):
+        return FakeResponse(200, {"w": self.house.load})
+
+    def close(self):
+        pass
+
+
+class FakeZaptecApi:
+    """Stand-in for the Zaptec API session; counts updates that break the 15-minute rate limit."""
+
+    def __init__(self, clock, rate_limit_seconds=15 * 60):
+        self.clock = clock
+        self.rate_limit_seconds = rate_limit_seconds
+        self.amperage = None
+        self.updates = []
+        self.rate_limit_violations = 0
+
+    def installation_id(self):
+        return "simulated-installation"
+
+    def request(self, method, url, json=None, headers=None, **kwargs):
+        if method == "POST" and json and "AvailableCurrent" in json:
+            if self.updates and self.clock.now - self.updates[-1] < self.rate_limit_seconds:
+                self.rate_limit_violations += 1
+            self.updates.append(self.clock.now)
+            self.amperage = json["AvailableCurrent"]
+        return FakeResponse(200, {})
+
+    def close(self):
+        pass
+
+
+class NullRecorder:
+    """Stand-in for the time-series store; keeps only the device switch series, in memory."""
+
+    def __init__(self):
+        self.series = {}
+
+    def append(self, series, value, timestamp=None):
+        if series.startswith("device."):
+            self.series.setdefault(series, []).append((timestamp, float(value)))
+        return True
+
+    def range(self, series, start, end):
+        return [(timestamp, value) for timestamp, value in self.series.get(series, ()) if start <= timestamp < end]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class House:
+    """
+    Synthetic household: base load, floor heating, a water heater tank and an EV.
+
+    Devices follow the states the controller publishes to the fake broker; the
+    charger draws the current last accepted by the fake Zaptec API.
+    """
+
+    def __init__(self, controller, broker, zaptec, base_load=None, seed=1):
+        """
+        Args:
+            controller (module): The priceLoad module.
+            broker (FakeBroker): Where device states are read from.
+            zaptec (FakeZaptecApi): Where the charging current is read from.
+            base_load (dict, optional): Recorded base load in watts per step start; synthetic where missing.
+            seed (int): Random seed.
+        """
+        self.pl = controller
+        self.broker = broker
+        self.zaptec = zaptec
+        self.base_load = base_load or {}
+        self.rng = random.Random(seed)
+        self.tank_deficit = 0.0  # kWh missing from a full tank
+        self.floor_deficits = [0.0] * len(controller.FLOOR_TOPICS)  # kWh each floor is behind its thermostat
+        self.cold_floor_minutes = 0.0
+        self.ev_need = 0.0  # kWh the car still wants
+        self.ev_plugged_at = None
+        self.ev_arrival_hour = self.rng.randint(*EV_ARRIVAL_HOURS)
+        self.ev_unmet_kwh = 0.0
+        self.cold_water_minutes = 0.0
+        self.water_heater_kwh = 0.0
+        self.spike_until = 0
+        self.spike_watts = 0.0
+        self.load = 0.0
+        self.water_heater_power = 0.0
+        self.charger_power = 0.0
+        self.session_energy = 0.0
+
+    def step(self, timestamp, local, step_seconds):
+        """Advance the house by one step and set `load` for the meter."""
+        hours = step_seconds / 3600.0
+        self._ev_schedule(local)
+
+        base = self.base_load.get(timestamp)
+        if base is None:
+            base = self._synthetic_base(timestamp, local)
+
+        winter = (1 + math.cos(2 * math.pi * (local.timetuple().tm_yday - 15) / 365.0)) / 2
+        duty = FLOOR_DUTY_SUMMER + (FLOOR_DUTY_WINTER - FLOOR_DUTY_SUMMER) * winter
+        # Floors: a shed floor falls behind by the heat it needed, and catches up at
+        # full power once it is switched back on
+        floors = 0.0
+        for index, (topic, watts) in enumerate(zip(self.pl.FLOOR_TOPICS, self.pl.FLOOR_WATTAGE)):
+            demand = watts * duty
+            power = 0.0
+            if self.broker.retained.get(topic, 'on') == 'on':
+                power = min(watts, demand + self.floor_deficits[index] * 1000.0 / hours)
+            self.floor_deficits[index] = max(self.floor_deficits[index] + (demand - power) / 1000.0 * hours, 0.0)
+            floors += power
+        if max(self.floor_deficits, default=0.0) > FLOOR_COLD_DEFICIT_KWH:
+            self.cold_floor_minutes += step_seconds / 60.0
+
+        # Water heater: while on, its thermostat tops the tank up at up to full power
+        self.tank_deficit += (HOT_WATER_DRAWS.get(local.hour, 0.0) + TANK_LOSS_KW) * hours
+        heater_on = self.broker.retained.get(self.pl.WATER_HEATER_TOPIC, 'on') == 'on'
+        self.water_heater_power = min(self.pl.WATER_HEATER_WATTAGE, self.tank_deficit * 1000.0 / hours) if heater_on else 0.0
+        self.tank_deficit = max(self.tank_deficit - self.water_heater_power / 1000.0 * hours, 0.0)
+        self.water_heater_kwh += self.water_heater_power / 1000.0 * hours
+        if self.tank_deficit > TANK_CAPACITY_KWH:
+            self.cold_water_minutes += step_seconds / 60.0
+            self.tank_deficit = TANK_CAPACITY_KWH  # Hot water runs out
+
+        # EV: charges at the installation current (the charger's own setting until one is sent) while it needs energy
+        amperage = self.zaptec.amperage if self.zaptec.amperage is not None else self.pl.CAR_CHARGER_POWER // self.pl.NOMINAL_VOLTAGE
+        self.charger_power = amperage * self.pl.NOMINAL_VOLTAGE if self.ev_plugged_at is not None and self.ev_need > 0 else 0.0
+        charged = min(self.charger_power / 1000.0 * hours, self.ev_need)
+        self.ev_need -= charged
+        self.session_energy += charged
+
+        self.load = base + floors + self.water_heater_power + self.charger_power
+
+    def _synthetic_base(self, timestamp, local):
+        hour = local.hour + local.minute / 60.0
+        base = 400 + 1200 * math.exp(-((hour - 7.5) ** 2) / 1.5) + 1800 * math.exp(-((hour - 18.0) ** 2) / 3.0)
+        if timestamp >= self.spike_until and self.rng.random() < 0.004:
+            # Cooking, washing or drying for 10 to 40 minutes
+            self.spike_until = timestamp + self.rng.randint(10, 40) * 60
+            self.spike_watts = self.rng.uniform(2000, 4500)
+        if timestamp < self.spike_until:
+            base += self.spike_watts
+        return base * self.rng.uniform(0.9, 1.1)
+
+    def _ev_schedule(self, local):
+        if self.ev_plugged_at is None and local.hour == self.ev_arrival_hour and local.minute == 0:
+            self.ev_plugged_at = local
+            self.ev_need = self.rng.uniform(*EV_NEED_KWH)
+            self.session_energy = 0.0
+        elif self.ev_plugged_at is not None and local.hour == EV_DEPARTURE_HOUR and local.minute == 0:
+            self.ev_unmet_kwh += self.ev_need
+            self.ev_plugged_at = None
+            self.ev_need = 0.0
+            self.ev_arrival_hour = self.rng.randint(*EV_ARRIVAL_HOURS)
+
+
+def synthetic_prices(start, days, seed=1):
+    """
+    Build hourly day-ahead prices with morning and evening peaks and a winter premium.
+
+    Args:
+        start (datetime): First local day (timezone-aware).
+        days (int): Number of days, plus one for the day-ahead publication.
+        seed (int): Random seed.
+
+    Returns:
+        list: (UTC hour start, price) pairs.
+    """
+    rng = random.Random(seed)
+    first = start.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    items = []
+    level = 80.0
+    for hour in range((days + 1) * 24):
+        when = first + timedelta(hours=hour)
+        local = when.astimezone(LOCAL_TZ)
+        level = max(level + rng.gauss(0, 2.0), 10.0)  # Slowly wandering daily level
+        winter = (1 + math.cos(2 * math.pi * (local.timetuple().tm_yday - 15) / 365.0)) / 2
+        shape = 1 + 0.5 * math.exp(-((local.hour - 8) ** 2) / 2.0) + 0.7 * math.exp(-((local.hour - 18) ** 2) / 3.0) - 0.3 * (local.hour < 5)
+        items.append((when, max(level * (0.6 + 0.8 * winter) * shape * rng.uniform(0.9, 1.1), 0.0)))
+    return items
+
+
+def replay_base_load(root, start_epoch, end_epoch, step_seconds=STEP_SECONDS, series="ams_power"):
+    """
+    Load a recorded meter trace from the time-series store as the base load.
+
+    Args:
+        root (str): Time-series directory written by priceLoad.
+        start_epoch (float): First step.
+        end_epoch (float): End of the run.
+        step_seconds (int): Step length.
+        series (str): Series to replay.
+
+    Returns:
+        dict: Step start epoch -> mean watts.
+    """
+    from timeSeries import TimeSeriesStore
+
+    store = TimeSeriesStore(root, retention_days=None)
+    try:
+        return dict(store.downsample(series, start_epoch, end_epoch, step_seconds))
+    finally:
+        store.close()
+
+
+class Simulation:
+    """
+    Drives priceLoad's control loop in simulated time.
+
+    The controller module is reloaded for every run so no state leaks between
+    runs, then its MQTT client, AMS reader, Zaptec session and time-series store
+    are replaced by local stand-ins and its clock by the simulated one. Each step
+    the house model produces a meter reading that reaches the controller through
+    the AMS client and the MQTT router exactly as live readings do; overload
+    reactions and control cycles then run as in control_loop().
+    """
+
+    def __init__(self, start, days, prices=None, base_load=None, seed=1, control=True, step_seconds=STEP_SECONDS):
+        """
+        Args:
+            start (datetime): Start of the run (timezone-aware).
+            days (float): Length of the run in days.
+            prices (list, optional): (start time, price) pairs; synthetic when omitted.
+            base_load (dict, optional): Recorded base load per step start epoch.
+            seed (int): Random seed for the house and synthetic prices.
+            control (bool): Run the controller; False leaves every device on and the car charging at CAR_CHARGER_POWER.
+            step_seconds (int): Simulated seconds per step.
+        """
+        self.start = start.timestamp()
+        self.end = self.start + days * 86400
+        self.days = days
+        self.prices = prices if prices is not None else synthetic_prices(start, int(math.ceil(days)), seed)
+        self.base_load = base_load
+        self.seed = seed
+        self.control = control
+        self.step_seconds = step_seconds
+
+    def run(self):
+        """
+        Run the simulation.
+
+        Returns:
+            dict: Cost in EUR (prices are EUR/MWh), energy, peak-hour kWh, capacity tariff, overload minutes, water heater energy and comfort figures (cold water and cold floor minutes).
+        """
+        clock = SimClock(self.start)
+        sim_datetime = clocked_datetime(clock)
+        pl = importlib.reload(sys.modules["priceLoad"]) if "priceLoad" in sys.modules else importlib.import_module("priceLoad")
+
+        patched = []
+        for name in CLOCKED_MODULES:
+            module = sys.modules.get(name) or importlib.import_module(name)
+            for attribute, replacement in (("time", clock), ("datetime", sim_datetime)):
+                original = getattr(module, attribute, None)
+                if original is time or original is datetime:
+                    patched.append((module, attribute, original))
+                    setattr(module, attribute, replacement)
+
+        broker = FakeBroker()
+        zaptec = FakeZaptecApi(clock)
+        house = House(pl, broker, zaptec, self.base_load, self.seed)
+        try:
+            self._install(pl, clock, broker, zaptec, house)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                wall_start = time.perf_counter()
+                metrics = asyncio.run(self._loop(pl, clock, broker, house))
+                wall_seconds = time.perf_counter() - wall_start
+        finally:
+            for module, attribute, original in patched:
+                setattr(module, attribute, original)
+
+        metrics.update({
+            "days": self.days,
+            "controlled": self.control,
+            "zaptec_updates": len(zaptec.updates),
+            "zaptec_rate_limit_violations": zaptec.rate_limit_violations,
+            "mqtt_messages": broker.published_count,
+            "ev_unmet_kwh": house.ev_unmet_kwh + house.ev_need,
+            "cold_water_minutes": house.cold_water_minutes,
+            "water_heater_kwh": house.water_heater_kwh,
+            "tank_deficit_kwh": house.tank_deficit,
+            "cold_floor_minutes": house.cold_floor_minutes,
+            "wall_seconds": wall_seconds,
+            "speedup": (self.end - self.start) / wall_seconds if wall_seconds else None,
+        })
+        return metrics
+
+    def _install(self, pl, clock, broker, zaptec, house):
+        from amsReader import AmsClient
+        from capacityTariff import CapacityTariff
+        from priceStore import PriceStore
+
+        pl.client = broker
+        pl.publisher = pl.MqttPublisher(broker)
+        pl.recorder = NullRecorder()
+        pl.zaptec_session = zaptec
+        pl.capacity_tariff = CapacityTariff(pl.LOCAL_TZ, within_step=pl.CAPACITY_WITHIN_STEP, state_path=None)
+        pl.ams_client = AmsClient(sample_interval=self.step_seconds)
+        pl.ams_client.http = FakeAmsHttp(house)
+        pl.ams_client.add_listener(lambda timestamp, watts: pl.handle_meter_reading(watts, timestamp))
+
+        async def run_inline(func, *args):
+            # Stand-ins do not block, so there is no need for a worker thread
+            try:
+                return func(*args)
+            except Exception as e:
+                logging.error(f"{func.__name__} failed: {e}")
+                return None
+        pl.run_blocking = run_inline
+
+        self._all_prices = PriceStore()
+        self._all_prices.update(self.prices)
+        pl.shared_state.update(prices=PriceStore(), last_activity=clock.now, water_heater_power=0.0)
+        self._publish_prices(pl, datetime.fromtimestamp(clock.now, LOCAL_TZ))
+
+    def _publish_prices(self, pl, local):
+        # Day-ahead prices become known for tomorrow at DAY_AHEAD_PUBLISH_HOUR
+        days = 2 if local.hour >= pl.DAY_AHEAD_PUBLISH_HOUR else 1
+        end = (local.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=days)).timestamp()
+        first = self._all_prices.slot_index(local.replace(hour=0, minute=0, second=0, microsecond=0))
+        last = min(self._all_prices.slot_index(datetime.fromtimestamp(end, timezone.utc)), len(self._all_prices))
+        items = [(self._all_prices.slot_start(index), self._all_prices.values[index]) for index in range(max(first, 0), last)]
+        if items:
+            pl.shared_state.modify("prices", lambda store: store.update(items))
+
+    async def _loop(self, pl, clock, broker, house):
+        prices = self._all_prices
+        step_hours = self.step_seconds / 3600.0
+        energy = cost = overload_minutes = 0.0
+        hour_energy = {}  # local (date, hour) -> kWh
+        next_cycle = self.start
+        published_day = None
+        timestamp = self.start
+
+        while timestamp < self.end:
+            clock.now = timestamp
+            local = datetime.fromtimestamp(timestamp, LOCAL_TZ)
+            if self.control and local.hour == pl.DAY_AHEAD_PUBLISH_HOUR and published_day != local.date():
+                published_day = local.date()
+                self._publish_prices(pl, local)
+
+            house.step(timestamp, local, self.step_seconds)
+            if self.control:
+                # Device telemetry through the MQTT router, the meter through the AMS client
+                pl.router.dispatch(b"home/water_heater/power", str(house.water_heater_power).encode())
+                pl.on_charger_states({STATE_TOTAL_CHARGE_POWER: house.charger_power, STATE_SESSION_ENERGY: house.session_energy})
+                pl.ams_client.poll()
+
+                snapshot = pl.shared_state.snapshot()
+                if snapshot.last_consumption >= pl.effective_load_limit(snapshot.last_consumption):
+                    pl.react_to_overload(snapshot)
+                if timestamp >= next_cycle:
+                    await pl.control_cycle()
+                    next_cycle = timestamp + pl.CONTROL_INTERVAL
+                # Let charging current updates complete, then acknowledge published messages
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+                broker.acknowledge()
+
+            kwh = house.load / 1000.0 * step_hours
+            energy += kwh
+            index = int((timestamp - prices.start) // prices.resolution) if prices.start is not None else -1
+            if 0 <= index < len(prices.values) and not math.isnan(prices.values[index]):
+                cost += kwh * prices.values[index] / 1000.0  # Prices are per MWh
+            key = (local.date(), local.hour)
+            hour_energy[key] = hour_energy.get(key, 0.0) + kwh
+            if house.load > pl.MAX_TOTAL_LOAD:
+                overload_minutes += self.step_seconds / 60.0
+            timestamp += self.step_seconds
+
+        if pl.zaptec_timer is not None:
+            pl.zaptec_timer.cancel()
+        return {
+            "energy_kwh": energy,
+            "cost": cost,
+            "peak_hour_kwh": max(hour_energy.values(), default=0.0),
+            "capacity_kw": capacity_average(hour_energy),
+            "overload_minutes": overload_minutes,
+        }
+
+
+def capacity_average(hour_energy, top_days=3):
+    """
+    Average over months of the capacity-tariff figure: the mean of the top days' highest hours.
+
+    Args:
+        hour_energy (dict): (local date, hour) -> kWh.
+        top_days (int): Days averaged per month.
+
+    Returns:
+        float: Average monthly capacity figure in kW.
+    """
+    day_peaks = {}
+    for (day, _), kwh in hour_energy.items():
+        day_peaks[day] = max(day_peaks.get(day, 0.0), kwh)
+    months = {}
+    for day, peak in day_peaks.items():
+        months.setdefault((day.year, day.month), []).append(peak)
+    figures = [sum(sorted(peaks)[-top_days:]) / min(len(peaks), top_days) for peaks in months.values()]
+    return sum(figures) / len(figures) if figures else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run priceLoad against a simulated house in accelerated time.")
+    parser.add_argument("--start", default="2024-01-01", help="First local day, YYYY-MM-DD (default: 2024-01-01).")
+    parser.add_argument("--days", type=float, default=7, help="Days to simulate (default: 7).")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the house and synthetic prices.")
+    parser.add_argument("--prices", help="Price cache file (priceStore format) to replay instead of synthetic prices.")
+    parser.add_argument("--replay-dir", help="Time-series directory whose ams_power series is replayed as the base load.")
+    parser.add_argument("--baseline", action="store_true", help="Also run without the controller for comparison.")
+    parser.add_argument("--log-level", default="ERROR", help="Controller log level during the run (default: ERROR).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    start = LOCAL_TZ.localize(datetime.strptime(args.start, "%Y-%m-%d"))
+    end = start.timestamp() + args.days * 86400
+
+    prices = None
+    if args.prices:
+        from priceStore import PriceStore
+        prices = list(PriceStore.load(args.prices).items())
+    base_load = replay_base_load(args.replay_dir, start.timestamp(), end) if args.replay_dir else None
+
+    runs = {"controlled": True}
+    if args.baseline:
+        runs["baseline"] = False
+    results = {}
+    logging.disable(getattr(logging, args.log_level.upper()) - 1)
+    try:
+        for name, control in runs.items():
+            results[name] = Simulation(start, args.days, prices, base_load, args.seed, control).run()
+    finally:
+        logging.disable(logging.NOTSET)
+
+    for name, result in results.items():
+        print(
+            f"{name:<10} cost {result['cost']:7.2f} EUR  energy {result['energy_kwh']:8.1f} kWh  "
+            f"peak hour {result['peak_hour_kwh']:5.2f} kWh  capacity {result['capacity_kw']:5.2f} kW  "
+            f"overload {result['overload_minutes']:6.0f} min  cold floors {result['cold_floor_minutes']:5.0f} min  "
+            f"({result['speedup']:.0f}x real time)"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
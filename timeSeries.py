@@ -0,0 +1,319 @@
+import calendar
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+TIMESERIES_DIR = os.getenv("TIMESERIES_DIR", "timeseries")
+MAGIC = b"TSD1"
+HEADER = struct.Struct("<4sIII")  # magic, chunk seconds, samples per chunk, chunks per file
+CHUNK_STATS = struct.Struct("<Iffd")  # count, min, max, sum
+OFFSET = struct.Struct("<i")  # milliseconds since the chunk start
+VALUE = struct.Struct("<f")
+FILE_SECONDS = 86400  # One file per series per UTC day
+MAX_OPEN_FILES = 16
+RETENTION_DAYS = 366
+
+
+class _DayFile:
+    """One memory-mapped day of one series: header, chunk statistics, then per-chunk columns."""
+
+    def __init__(self, path, chunk_seconds, capacity, writable):
+        if writable and not os.path.exists(path):
+            chunks = FILE_SECONDS // chunk_seconds
+            size = HEADER.size + chunks * CHUNK_STATS.size + chunks * capacity * 8
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, chunk_seconds, capacity, chunks))
+                f.truncate(size)  # Sparse on most file systems; unused chunks take no space
+
+        with open(path, "r+b" if writable else "rb") as f:
+            magic, self.chunk_seconds, self.capacity, self.chunks = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a time-series file")
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.writable = writable
+        self.data_offset = HEADER.size + self.chunks * CHUNK_STATS.size
+
+    def stats(self, chunk):
+        return CHUNK_STATS.unpack_from(self.mm, HEADER.size + chunk * CHUNK_STATS.size)
+
+    def append(self, chunk, offset_ms, value):
+        count, lo, hi, total = self.stats(chunk)
+        if count >= self.capacity:
+            return False
+        base = self.data_offset + chunk * self.capacity * 8
+        if count and OFFSET.unpack_from(self.mm, base + 4 * (count - 1))[0] >= offset_ms:
+            return False  # Keep each chunk sorted by time
+        OFFSET.pack_into(self.mm, base + 4 * count, offset_ms)
+        VALUE.pack_into(self.mm, base + 4 * self.capacity + 4 * count, value)
+        if count:
+            lo, hi, total = min(lo, value), max(hi, value), total + value
+        else:
+            lo, hi, total = value, value, value
+        CHUNK_STATS.pack_into(self.mm, HEADER.size + chunk * CHUNK_STATS.size, count + 1, lo, hi, total)
+        return True
+
+    def columns(self, chunk, count):
+        base = self.data_offset + chunk * self.capacity * 8
+        offsets, values = array('i'), array('f')
+        offsets.frombytes(self.mm[base:base + 4 * count])
+        values.frombytes(self.mm[base + 4 * self.capacity:base + 4 * self.capacity + 4 * count])
+        return offsets, values
+
+    def close(self):
+        self.mm.close()
+
+
+class TimeSeriesStore:
+    """
+    Local time-series store for meter, device and charger data.
+
+    Each series is a directory of day files. A day is split into chunks
+    (one hour by default); each chunk holds a column of millisecond offsets and a
+    column of float32 values, preceded in the file by the chunk's count, min, max
+    and sum. Files are memory-mapped, so appending a sample is two stores and a
+    stats update, and range or downsample queries use the chunk statistics for
+    whole chunks and only read samples at the edges. At 8 bytes per sample a
+    year of 1 s data is about 250 MB per series.
+    """
+
+    def __init__(self, root=TIMESERIES_DIR, chunk_seconds=3600, max_rate=1.0, retention_days=RETENTION_DAYS):
+        """
+        Args:
+            root (str): Directory holding the series.
+            chunk_seconds (int): Chunk length; must divide a day.
+            max_rate (float): Highest sample rate per series in samples per second; faster samples are dropped.
+            retention_days (int, optional): Delete day files older than this. None keeps everything.
+        """
+        if FILE_SECONDS % chunk_seconds:
+            raise ValueError("chunk_seconds must divide a day")
+        self.root = root
+        self.chunk_seconds = chunk_seconds
+        self.capacity = int(math.ceil(chunk_seconds * max_rate))
+        self.retention_days = retention_days
+        self._files = {}  # (series, day start, writable) -> _DayFile, oldest first
+        self._lock = threading.Lock()
+        self._pruned_day = None
+        self.dropped = 0
+
+    def append(self, series, value, timestamp=None):
+        """
+        Record a sample.
+
+        Args:
+            series (str): Series name, e.g. 'ams_power'.
+            value (float): The value.
+            timestamp (float, optional): UTC epoch seconds. Defaults to now.
+
+        Returns:
+            bool: False if the sample was dropped (too fast, out of order or not writable).
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        day_start = int(timestamp // FILE_SECONDS * FILE_SECONDS)
+        chunk, offset = divmod(timestamp - day_start, self.chunk_seconds)
+        with self._lock:
+            try:
+                day_file = self._open(series, day_start, writable=True)
+                stored = day_file.append(int(chunk), int(offset * 1000), float(value))
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not record {series}: {e}")
+                stored = False
+            if not stored:
+                self.dropped += 1
+            if self.retention_days is not None and self._pruned_day != day_start:
+                self._pruned_day = day_start
+                self._prune(day_start - self.retention_days * FILE_SECONDS)
+        return stored
+
+    def range(self, series, start, end):
+        """
+        Return the samples in [start, end).
+
+        Args:
+            series (str): Series name.
+            start (float): UTC epoch seconds.
+            end (float): UTC epoch seconds.
+
+        Returns:
+            list: (timestamp, value) tuples in time order.
+        """
+        samples = []
+        with self._lock:
+            for day_file, chunk, chunk_start, count in self._chunks(series, start, end):
+                offsets, values = day_file.columns(chunk, count)
+                for offset, value in zip(offsets, values):
+                    timestamp = chunk_start + offset / 1000.0
+                    if start <= timestamp < end:
+                        samples.append((timestamp, value))
+        return samples
+
+    def downsample(self, series, start, end, bucket_seconds, how="mean"):
+        """
+        Aggregate samples in [start, end) into fixed buckets.
+
+        Chunks that lie entirely inside the range and inside one bucket are
+        aggregated from their stored statistics without reading the samples.
+
+        Args:
+            series (str): Series name.
+            start (float): UTC epoch seconds.
+            end (float): UTC epoch seconds.
+            bucket_seconds (float): Bucket length; buckets are aligned to the epoch.
+            how (str): 'mean', 'min', 'max', 'sum' or 'count'.
+
+        Returns:
+            list: (bucket start, value) tuples for buckets with samples, in time order.
+        """
+        buckets = self._aggregate(series, start, end, bucket_seconds)
+        return [(bucket, _pick(buckets[bucket], how)) for bucket in sorted(buckets)]
+
+    def summary(self, series, start, end):
+        """
+        Return count, min, max, mean and sum of the samples in [start, end).
+
+        Args:
+            series (str): Series name.
+            start (float): UTC epoch seconds.
+            end (float): UTC epoch seconds.
+
+        Returns:
+            dict: Aggregates, or None if there are no samples.
+        """
+        buckets = self._aggregate(series, start, end, None)
+        if not buckets:
+            return None
+        count, lo, hi, total = buckets[None]
+        return {"count": count, "min": lo, "max": hi, "mean": total / count, "sum": total}
+
+    def flush(self):
+        """Write modified pages to disk."""
+        with self._lock:
+            for day_file in self._files.values():
+                if day_file.writable:
+                    day_file.mm.flush()
+
+    def close(self):
+        """Flush and unmap all open files."""
+        with self._lock:
+            for day_file in self._files.values():
+                if day_file.writable:
+                    day_file.mm.flush()
+                day_file.close()
+            self._files.clear()
+
+    def _aggregate(self, series, start, end, bucket_seconds):
+        def bucket_of(timestamp):
+            return None if bucket_seconds is None else float(timestamp - timestamp % bucket_seconds)
+
+        buckets = {}
+        with self._lock:
+            for day_file, chunk, chunk_start, count in self._chunks(series, start, end):
+                chunk_end = chunk_start + day_file.chunk_seconds
+                if start <= chunk_start and chunk_end <= end and bucket_of(chunk_start) == bucket_of(chunk_end - 1e-3):
+                    _merge(buckets, bucket_of(chunk_start), day_file.stats(chunk))
+                    continue
+                offsets, values = day_file.columns(chunk, count)
+                for offset, value in zip(offsets, values):
+                    timestamp = chunk_start + offset / 1000.0
+                    if start <= timestamp < end:
+                        _merge(buckets, bucket_of(timestamp), (1, value, value, value))
+        return buckets
+
+    def _chunks(self, series, start, end):
+        # Yield (file, chunk index, chunk start, sample count) for non-empty chunks overlapping [start, end)
+        directory = os.path.dirname(self._path(series, 0))
+        if not os.path.isdir(directory):
+            return
+        days = sorted(name for name in os.listdir(directory) if name.endswith(".tsd"))
+        if not days:
+            return
+        # Only visit days that have files
+        day_start = max(int(start // FILE_SECONDS * FILE_SECONDS), calendar.timegm(time.strptime(days[0], "%Y-%m-%d.tsd")))
+        end = min(end, calendar.timegm(time.strptime(days[-1], "%Y-%m-%d.tsd")) + FILE_SECONDS)
+        while day_start < end:
+            day_file = self._open(series, day_start, writable=False)
+            if day_file is not None:
+                first = max(int((start - day_start) // day_file.chunk_seconds), 0)
+                last = min(int(math.ceil((end - day_start) / day_file.chunk_seconds)), day_file.chunks)
+                for chunk in range(first, last):
+                    count = day_file.stats(chunk)[0]
+                    if count:
+                        yield day_file, chunk, day_start + chunk * day_file.chunk_seconds, count
+            day_start += FILE_SECONDS
+
+    def _path(self, series, day_start):
+        name = series.replace("/", ".").replace(os.sep, ".")
+        return os.path.join(self.root, name, time.strftime("%Y-%m-%d.tsd", time.gmtime(day_start)))
+
+    def _open(self, series, day_start, writable):
+        # A writable mapping serves reads as well
+        for key in ((series, day_start, True), (series, day_start, False)):
+            if key in self._files:
+                if key[2] or not writable:
+                    day_file = self._files.pop(key)
+                    self._files[key] = day_file  # Most recently used last
+                    return day_file
+
+        path = self._path(series, day_start)
+        if writable:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            stale = self._files.pop((series, day_start, False), None)
+            if stale is not None:
+                stale.close()
+            day_file = _DayFile(path, self.chunk_seconds, self.capacity, writable=True)
+        elif os.path.exists(path):
+            day_file = _DayFile(path, self.chunk_seconds, self.capacity, writable=False)
+        else:
+            return None
+
+        self._files[(series, day_start, writable)] = day_file
+        while len(self._files) > MAX_OPEN_FILES:
+            oldest = next(iter(self._files))
+            self._files.pop(oldest).close()
+        return day_file
+
+    def _prune(self, cutoff):
+        cutoff_name = time.strftime("%Y-%m-%d.tsd", time.gmtime(cutoff))
+        if not os.path.isdir(self.root):
+            return
+        for series in os.listdir(self.root):
+            directory = os.path.join(self.root, series)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith(".tsd") and name < cutoff_name:
+                    for key in [key for key in self._files if self._path(key[0], key[1]) == os.path.join(directory, name)]:
+                        self._files.pop(key).close()
+                    os.remove(os.path.join(directory, name))
+                    logging.info(f"Removed expired time-series file {os.path.join(directory, name)}.")
+
+
+def _merge(buckets, bucket, stats):
+    count, lo, hi, total = stats
+    current = buckets.get(bucket)
+    if current is None:
+        buckets[bucket] = [count, lo, hi, total]
+    else:
+        current[0] += count
+        current[1] = min(current[1], lo)
+        current[2] = max(current[2], hi)
+        current[3] += total
+
+
+def _pick(aggregate, how):
+    count, lo, hi, total = aggregate
+    if how == "mean":
+        return total / count
+    if how == "min":
+        return lo
+    if how == "max":
+        return hi
+    if how == "sum":
+        return total
+    if how == "count":
+        return count
+    raise ValueError(f"Unknown aggregate '{how}'")
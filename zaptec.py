@@ -1,21 +1,45 @@
+import contextlib
+import json
+import logging
 import os
+import re
+import threading
+import time
+
 import requests
-import os
 from dotenv import load_dotenv
-import requests
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Access environment variables
-username = os.getenv('ZAPTEC_USER')
-password = os.getenv('ZAPTEC_PASSWORD')
+ZAPTEC_AUTH_URL = "https://api.zaptec.com/oauth/token"
+
+# Service Bus connection details
+service_bus_host = os.getenv('ZAPTEC_SERVICE_BUS_HOST')
+service_bus_username = os.getenv('ZAPTEC_SERVICE_BUS_USERNAME')
+service_bus_password = os.getenv('ZAPTEC_SERVICE_BUS_PASSWORD')
+service_bus_topic = os.getenv('ZAPTEC_SERVICE_BUS_TOPIC')
+service_bus_subscription = os.getenv('ZAPTEC_SERVICE_BUS_SUBSCRIPTION')
 
-# Use the credentials in your application logic
-response = requests.get('https://example.com/api', auth=(username, password))
-# Process the response as needed
+SERVICE_BUS_BATCH_SIZE = 100  # Messages fetched per receive call
+SERVICE_BUS_MAX_WAIT = 5  # Seconds a receive call waits for the batch to fill
+SERVICE_BUS_RETRY_DELAY = 30  # Seconds before reconnecting after an error
+# Opt-in: settle on receipt. Faster, but at-most-once; a crash mid-batch loses the rest of it
+SERVICE_BUS_RECEIVE_AND_DELETE = os.getenv('ZAPTEC_SERVICE_BUS_RECEIVE_AND_DELETE', '').lower() in ('1', 'true', 'yes')
+
+# Zaptec observation ids (StateId) the controller uses
+STATE_CURRENT_PHASE1 = 507  # A
+STATE_CURRENT_PHASE2 = 508  # A
+STATE_CURRENT_PHASE3 = 509  # A
+STATE_TOTAL_CHARGE_POWER = 513  # W
+STATE_SESSION_ENERGY = 553  # kWh charged in the current session
+STATE_CHARGE_CURRENT_SET = 708  # A
+PHASE_CURRENT_STATES = (STATE_CURRENT_PHASE1, STATE_CURRENT_PHASE2, STATE_CURRENT_PHASE3)
+WANTED_STATES = frozenset(PHASE_CURRENT_STATES + (STATE_TOTAL_CHARGE_POWER, STATE_SESSION_ENERGY, STATE_CHARGE_CURRENT_SET))
+
+# Chargers publish dozens of observations; the StateId is read from the raw body before decoding
+STATE_ID_PATTERN = re.compile(rb'"StateId"\s*:\s*(\d+)')
 
-ZAPTEC_AUTH_URL = "https://api.zaptec.com/oauth/token"
 
 def get_access_token():
     # Retrieve credentials from environment variables
@@ -50,81 +74,210 @@ def refresh_access_token(refresh_token):
     response.raise_for_status()
     return response.json()
 
-import os
-import json
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+def service_bus_configured():
+    """Return True if the Service Bus connection details are set."""
+    return all((service_bus_host, service_bus_username, service_bus_password, service_bus_topic, service_bus_subscription))
 
-# Retrieve connection details from environment variables
-service_bus_host = os.getenv('ZAPTEC_SERVICE_BUS_HOST')
-service_bus_username = os.getenv('ZAPTEC_SERVICE_BUS_USERNAME')
-service_bus_password = os.getenv('ZAPTEC_SERVICE_BUS_PASSWORD')
-service_bus_topic = os.getenv('ZAPTEC_SERVICE_BUS_TOPIC')
-service_bus_subscription = os.getenv('ZAPTEC_SERVICE_BUS_SUBSCRIPTION')
 
-# Construct the connection string
-connection_str = (
-    f'Endpoint=sb://{service_bus_host}/;'
-    f'SharedAccessKeyName={service_bus_username};'
-    f'SharedAccessKey={service_bus_password}'
-)
-
-def process_message(message):
-    # Decode the message body
-    message_body = b"".join(message.body)
-    message_content = json.loads(message_body.decode('utf-8'))
-
-    # Extract relevant information
-    charger_id = message_content.get('ChargerId')
-    state_id = message_content.get('StateId')
-    timestamp = message_content.get('Timestamp')
-    value_as_string = message_content.get('ValueAsString')
-
-    # Check if the message corresponds to session energy
-    # Replace 'YOUR_SESSION_ENERGY_STATE_ID' with the actual StateId for session energy
-    if state_id == 'YOUR_SESSION_ENERGY_STATE_ID':
-        session_energy = float(value_as_string)
-        print(f"Charger ID: {charger_id}")
-        print(f"Timestamp: {timestamp}")
-        print(f"Current Session Energy Consumption: {session_energy} kWh")
-
-# Initialize the Service Bus client
-servicebus_client = ServiceBusClient.from_connection_string(conn_str=connection_str, logging_enable=True)
-
-# Function to receive messages
-def receive_messages():
-    with servicebus_client:
-        receiver = servicebus_client.get_subscription_receiver(
+@contextlib.contextmanager
+def service_bus_receiver(receive_and_delete=False, prefetch_count=SERVICE_BUS_BATCH_SIZE):
+    """
+    Open a receiver on the Zaptec Service Bus subscription.
+
+    azure-servicebus is imported here so the controller starts without it.
+
+    Args:
+        receive_and_delete (bool): Settle messages on receipt (at-most-once) instead of peek-lock.
+        prefetch_count (int): Messages the client buffers ahead of receive calls.
+
+    Yields:
+        ServiceBusReceiver: The open receiver.
+    """
+    from azure.servicebus import ServiceBusClient, ServiceBusReceiveMode
+
+    connection_str = (
+        f'Endpoint=sb://{service_bus_host}/;'
+        f'SharedAccessKeyName={service_bus_username};'
+        f'SharedAccessKey={service_bus_password}'
+    )
+    receive_mode = ServiceBusReceiveMode.RECEIVE_AND_DELETE if receive_and_delete else ServiceBusReceiveMode.PEEK_LOCK
+    with ServiceBusClient.from_connection_string(conn_str=connection_str) as client:
+        with client.get_subscription_receiver(
             topic_name=service_bus_topic,
-            subscription_name=service_bus_subscription
-        )
-        with receiver:
-            for message in receiver:
-                process_message(message)
+            subscription_name=service_bus_subscription,
+            receive_mode=receive_mode,
+            prefetch_count=prefetch_count
+        ) as receiver:
+            yield receiver
+
+
+def message_bytes(message):
+    """Return the body of a Service Bus message as bytes."""
+    body = message.body
+    if isinstance(body, (bytes, bytearray)):
+        return body
+    return b"".join(body)
+
+
+def parse_state(body, wanted=WANTED_STATES):
+    """
+    Decode a charger observation if its StateId is wanted.
+
+    Args:
+        body (bytes): Raw message body.
+        wanted (frozenset): StateIds to decode.
+
+    Returns:
+        dict: The decoded message, or None if the StateId is not wanted.
+
+    Raises:
+        ValueError: If a wanted message is not valid JSON.
+    """
+    match = STATE_ID_PATTERN.search(body)
+    if match is None or int(match.group(1)) not in wanted:
+        return None
+    return json.loads(body)
+
+
+class ZaptecConsumer:
+    """
+    Batching consumer for charger observations on the Zaptec Service Bus.
+
+    Messages are received up to `batch_size` at a time. The StateId is read from
+    the raw body, so only the few observations the controller uses are decoded.
+    By default the subscription is read in peek-lock mode: every message in a
+    batch is completed after the batch has been processed, so a crash mid-batch
+    means redelivery rather than loss. The SDK has no bulk settlement and its
+    receivers are not thread-safe, so completions stay one call per message.
+    Receive-and-delete mode (SERVICE_BUS_RECEIVE_AND_DELETE) is an opt-in that
+    skips those round trips at the price of at-most-once delivery.
+    Listeners are called once per batch with the latest value of each StateId.
+    """
+
+    def __init__(self, receiver_factory=service_bus_receiver, batch_size=SERVICE_BUS_BATCH_SIZE, max_wait=SERVICE_BUS_MAX_WAIT,
+                 receive_and_delete=SERVICE_BUS_RECEIVE_AND_DELETE, charger_id=None, wanted=WANTED_STATES):
+        """
+        Args:
+            receiver_factory (callable): Context manager factory called as
+                receiver_factory(receive_and_delete=..., prefetch_count=...) that yields a receiver.
+            batch_size (int): Maximum messages per receive call.
+            max_wait (float): Seconds a receive call waits for the batch to fill.
+            receive_and_delete (bool): Settle on receipt instead of completing each message
+                after its batch; messages in flight are lost if the process dies.
+            charger_id (str, optional): Ignore observations from other chargers.
+            wanted (frozenset): StateIds to decode and report.
+        """
+        self.receiver_factory = receiver_factory
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.receive_and_delete = receive_and_delete
+        self.charger_id = charger_id
+        self.wanted = wanted
+        self.latest = {}  # StateId -> (receive time, value)
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.received_count = 0
+        self.decoded_count = 0
+        self.batch_count = 0
+        self.error_count = 0
+
+    def add_listener(self, callback):
+        """
+        Call `callback(states)` after each batch with the new observations.
+
+        Args:
+            callback (callable): Receives a dict of StateId -> value, latest value per StateId.
+        """
+        self._listeners.append(callback)
+
+    def process_batch(self, receiver, messages, timestamp=None):
+        """
+        Handle one received batch and settle it.
+
+        Args:
+            receiver: The receiver the batch came from.
+            messages (list): Received messages.
+            timestamp (float, optional): Receive time. Defaults to now.
+
+        Returns:
+            dict: StateId -> latest value in the batch.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        states = {}
+        for message in messages:
+            try:
+                content = parse_state(message_bytes(message), self.wanted)
+                if content is None:
+                    continue
+                if self.charger_id and content.get('ChargerId') != self.charger_id:
+                    continue
+                states[content['StateId']] = float(content.get('ValueAsString'))
+                self.decoded_count += 1
+            except (ValueError, TypeError, KeyError) as e:
+                # Completed anyway so a malformed message is not redelivered forever
+                self.error_count += 1
+                logging.warning(f"Invalid Zaptec message: {e}")
+
+        if not self.receive_and_delete:
+            for message in messages:
                 receiver.complete_message(message)
 
-if __name__ == "__main__":
-    receive_messages()
+        self.received_count += len(messages)
+        self.batch_count += 1
+        for state_id, value in states.items():
+            self.latest[state_id] = (timestamp, value)
+        if states:
+            for callback in self._listeners:
+                try:
+                    callback(states)
+                except Exception as e:
+                    logging.error(f"Zaptec state listener failed: {e}")
+        return states
+
+    def run(self):
+        """Receive and process batches until stop() is called, reconnecting after errors."""
+        while not self._stop.is_set():
+            try:
+                with self.receiver_factory(receive_and_delete=self.receive_and_delete, prefetch_count=self.batch_size) as receiver:
+                    logging.info("Connected to the Zaptec Service Bus.")
+                    while not self._stop.is_set():
+                        messages = receiver.receive_messages(max_message_count=self.batch_size, max_wait_time=self.max_wait)
+                        if messages:
+                            self.process_batch(receiver, messages)
+            except Exception as e:
+                self.error_count += 1
+                logging.error(f"Zaptec Service Bus consumer failed: {e}. Reconnecting in {SERVICE_BUS_RETRY_DELAY} seconds.")
+                self._stop.wait(SERVICE_BUS_RETRY_DELAY)
 
+    def start(self):
+        """Start consuming in a background thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="zaptec-consumer", daemon=True)
+        self._thread.start()
 
-exit()
+    def stop(self):
+        """Stop the background consumer after its current receive call."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.max_wait + 5)
 
-# Example usage
-try:
-    # Fetch the initial access token
-    tokens = get_access_token()
-    access_token = tokens["access_token"]
-    refresh_token = tokens["refresh_token"]
 
-    print("Access Token:", access_token)
-    print("Refresh Token:", refresh_token)
+def log_states(states):
+    if STATE_SESSION_ENERGY in states:
+        logging.info(f"Current Session Energy Consumption: {states[STATE_SESSION_ENERGY]} kWh")
+    if STATE_TOTAL_CHARGE_POWER in states:
+        logging.info(f"Charge power: {states[STATE_TOTAL_CHARGE_POWER]} W")
 
-    # Example: Refresh the access token
-    new_tokens = refresh_access_token(refresh_token)
-    print("New Access Token:", new_tokens["access_token"])
 
-except Exception as e:
-    print(f"Error: {e}")
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    consumer = ZaptecConsumer(charger_id=os.getenv("ZAPTEC_CHARGER_ID"))
+    consumer.add_listener(log_states)
+    try:
+        consumer.run()
+    except KeyboardInterrupt:
+        pass